@@ -11,12 +11,136 @@ Flash another microcontroller from CircuitPython. Modeled after the Adafruit_DAP
 * Author(s): Scott Shawcroft
 """
 
-import array
 import time
 
+try:
+    from binascii import crc32 as _std_crc32
+except ImportError:
+    _std_crc32 = None
+
+from micropython import const
+
 __version__ = "0.0.0+auto.0"
 __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
 
+_DHCSR = const(0xE000EDF0)
+_DCRSR = const(0xE000EDF4)
+_DCRDR = const(0xE000EDF8)
+_DEMCR = const(0xE000EDFC)
+_AIRCR = const(0xE000ED0C)
+_DHCSR_S_HALT = const(0x00020000)
+_DHCSR_S_REGRDY = const(0x00010000)
+_DCRSR_REGWNR = const(0x00010000)
+
+# DCRSR register numbers
+REG_SP = const(13)
+REG_PC = const(15)
+REG_XPSR = const(16)
+
+# Attributes that used to live in this module and are now loaded on first use.
+_LAZY_ATTRIBUTES = {
+    "write_bin_file": "bin_file",
+    "write_hex_file": "hex_file",
+    "FlashReport": "report",
+    "MemoryWriter": "memory",
+    "VerifyPolicy": "verify",
+    "CrcVerifier": "verify",
+    "VERIFY_NONE": "verify",
+    "VERIFY_FULL": "verify",
+}
+
+
+def _load(module_name):
+    package = __import__(__name__ + "." + module_name)
+    return getattr(package, module_name)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(_load(_LAZY_ATTRIBUTES[name]), name)
+    raise AttributeError(name)
+
+
+def _device_entry(line):
+    _, name, flash_kib, page_count = line.split(",")
+    return (name, int(flash_kib) * 1024, int(page_count))
+
+
+def find_device(table, device_id):
+    """Look up ``device_id`` in a device table string with one
+    ``id,name,flash KiB,page count`` line per device. Returns a
+    ``(name, flash size, page count)`` tuple or ``None``."""
+    start = table.find("\n%08x," % device_id)
+    if start < 0:
+        return None
+    end = table.find("\n", start + 1)
+    return _device_entry(table[start + 1 : end])
+
+
+def parse_devices(table) -> dict:
+    """Parse a whole device table string (see :func:`find_device`) into a dict
+    of ``device_id: (name, flash size, page count)``."""
+    devices = {}
+    for line in table.strip().split("\n"):
+        devices[int(line[:8], 16)] = _device_entry(line)
+    return devices
+
+
+def crc32(data, crc=0xffffffff) -> int:
+    """Continue a CRC32 from ``crc`` over ``data`` without the final
+    inversion, the same way the SAM DSU computes it."""
+    if _std_crc32 is not None:
+        return _std_crc32(data, crc ^ 0xffffffff) ^ 0xffffffff
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0xedb88320 if crc & 1 else 0)
+    return crc
+
+
+class FlashGeometry:
+    """Flash layout of a selected target, filled in by ``select()``.
+
+    :param int flash_size: Size of the main flash array in bytes
+    :param int page_size: Size of one program operation in bytes
+    :param int erase_size: Size of the smallest erasable unit (row, block,
+      page or largest sector) in bytes
+    :param int region_count: Number of lock regions
+    :param int start: Address of the first byte of flash
+    """
+
+    def __init__(self, flash_size, page_size, erase_size, region_count=1, start=0):
+        self.flash_size = flash_size
+        self.page_size = page_size
+        self.erase_size = erase_size
+        self.region_count = region_count
+        self.start = start
+
+    @property
+    def end(self) -> int:
+        """Address just past the end of flash."""
+        return self.start + self.flash_size
+
+    @property
+    def region_size(self) -> int:
+        """Size of one lock region in bytes."""
+        return self.flash_size // self.region_count
+
+    def check_range(self, addr, size) -> None:
+        """Raise ``ValueError`` if ``[addr, addr + size)`` isn't inside flash."""
+        if addr < self.start or addr + size > self.end:
+            raise ValueError(
+                f"0x{addr:08x}-0x{addr + size:08x} is outside of flash "
+                f"0x{self.start:08x}-0x{self.end:08x}"
+            )
+
+    def __repr__(self):
+        return (
+            f"FlashGeometry({self.flash_size}, {self.page_size}, "
+            f"{self.erase_size}, {self.region_count}, 0x{self.start:x})"
+        )
+
+
 class DapTarget:
     SWD_DP_R_IDCODE = 0x00
     SWD_DP_W_ABORT = 0x00
@@ -40,21 +164,299 @@ class DapTarget:
     # SWD_AP_BASE = 0x08 | DAP_TRANSFER_APnDP, // 0xf8
     # SWD_AP_IDR = 0x0c | DAP_TRANSFER_APnDP,  // 0xfc
 
+    # True when crc32() is computed on the target rather than read back.
+    HARDWARE_CRC = False
+
+    CSW_WORD = 0x23000052 # AP_CSW_ADDRINC_SINGLE = 0x10 | AP_CSW_DEVICEEN = 0x40 | AP_CSW_PROT(0x23) = 0x23000000 | AP_CSW_SIZE_WORD = 0x02
+    CSW_HALFWORD = 0x23000051
+    CSW_BYTE = 0x23000050
+    CSW_WORD_FIXED = 0x23000042 # CSW_WORD without AP_CSW_ADDRINC_SINGLE
+
+    # Probe transfer settings, see configure_transfers().
+    IDLE_CYCLES = 0
+    WAIT_RETRY_COUNT = 128
+    MATCH_RETRY_COUNT = 128
+
     def __init__(self, probe):
         self.probe = probe
+        self.geometry = None
+        # When True, write_word() doesn't read RDBUFF after every write. A
+        # failed write still shows up as a fault on the next read.
+        self.posted_writes = False
+        # Shadow copies of DP SELECT, AP CSW and AP TAR so we can skip writes
+        # that wouldn't change them. None means unknown.
+        self._select = None
+        self._csw = None
+        self._tar = None
+        self._page = None
+        self._verify = None
+        self._erased = None
+        self._views = None
+        # The probe stays connected between hot_attach() calls.
+        self.probe_connected = False
+        # True when hot_attach() found the core halted and left it alone.
+        self.attached = False
+        # A HeapMonitor to measure the heap with, see adafruit_mcu_flasher.heap.
+        self.heap = None
+        # True when the probe polls for wait_for_value() itself.
+        self.value_match = False
+        self.report = _load("report").FlashReport()
+
+    def invalidate_shadow(self):
+        """Forget the shadowed DP and AP registers. Call this after anything
+        that may change them behind our back, such as a line or target reset."""
+        self._select = None
+        self._csw = None
+        self._tar = None
+
+    def write_select(self, value):
+        if self._select != value:
+            self.probe.write_dp(DapTarget.SWD_DP_W_SELECT, value)
+            self._select = value
+
+    def write_csw(self, value):
+        if self._csw != value:
+            self.probe.write_ap(DapTarget.SWD_AP_CSW, value)
+            self._csw = value
+
+    def write_tar(self, addr):
+        if self._tar != addr:
+            self.probe.write_ap(DapTarget.SWD_AP_TAR, addr)
+            self._tar = addr
+
+    def _advance_tar(self, size):
+        # Track TAR auto-increment. Crossing a 1 KiB boundary wraps or not
+        # depending on the implementation so we stop tracking there.
+        tar = self._tar
+        if tar is not None:
+            self._tar = tar + size
+            if (tar ^ self._tar) & ~0x3ff:
+                self._tar = None
 
     def read_word(self, addr) -> int:
-        self.probe.write_ap(DapTarget.SWD_AP_TAR, addr)
+        self.write_csw(DapTarget.CSW_WORD)
+        self.write_tar(addr)
         # Post the read and ignore the result.
         self.probe.read_ap(DapTarget.SWD_AP_DRW)
+        self._advance_tar(4)
         # Read the RDBUFF to get the last word and not initiate another read.
         return self.probe.read_dp(DapTarget.SWD_DP_R_RDBUFF)
 
-    def write_word(self, addr, data) -> None:
-        self.probe.write_ap(DapTarget.SWD_AP_TAR, addr)
+    def write_word(self, addr, data, posted=None) -> None:
+        self.write_csw(DapTarget.CSW_WORD)
+        self.write_tar(addr)
         self.probe.write_ap(DapTarget.SWD_AP_DRW, data)
-        # Read the RDBUFF to verify the write. (The ack won't be ok if it failed.)
-        self.probe.read_dp(DapTarget.SWD_DP_R_RDBUFF)
+        self._advance_tar(4)
+        if posted is None:
+            posted = self.posted_writes
+        if not posted:
+            # Read the RDBUFF to verify the write. (The ack won't be ok if it failed.)
+            self.probe.read_dp(DapTarget.SWD_DP_R_RDBUFF)
+
+    def _read_sized(self, addr, csw, size) -> int:
+        # Byte and halfword accesses use the byte lanes of their address.
+        self.write_csw(csw)
+        self.write_tar(addr)
+        self.probe.read_ap(DapTarget.SWD_AP_DRW)
+        self._advance_tar(size)
+        value = self.probe.read_dp(DapTarget.SWD_DP_R_RDBUFF)
+        return (value >> ((addr & 3) * 8)) & ((1 << (size * 8)) - 1)
+
+    def _write_sized(self, addr, value, csw, size, posted) -> None:
+        self.write_csw(csw)
+        self.write_tar(addr)
+        value &= (1 << (size * 8)) - 1
+        self.probe.write_ap(DapTarget.SWD_AP_DRW, value << ((addr & 3) * 8))
+        self._advance_tar(size)
+        if posted is None:
+            posted = self.posted_writes
+        if not posted:
+            self.probe.read_dp(DapTarget.SWD_DP_R_RDBUFF)
+
+    def read_byte(self, addr) -> int:
+        """Read one byte with a byte sized access."""
+        return self._read_sized(addr, DapTarget.CSW_BYTE, 1)
+
+    def write_byte(self, addr, value, posted=None) -> None:
+        """Write one byte with a byte sized access."""
+        self._write_sized(addr, value, DapTarget.CSW_BYTE, 1, posted)
+
+    def read_halfword(self, addr) -> int:
+        """Read a halfword at an even ``addr`` with a halfword sized access."""
+        if addr & 1:
+            raise ValueError("halfword address must be even")
+        return self._read_sized(addr, DapTarget.CSW_HALFWORD, 2)
+
+    def write_halfword(self, addr, value, posted=None) -> None:
+        """Write a halfword at an even ``addr`` with a halfword sized access."""
+        if addr & 1:
+            raise ValueError("halfword address must be even")
+        self._write_sized(addr, value, DapTarget.CSW_HALFWORD, 2, posted)
+
+    def read_memory_into(self, addr, buf) -> None:
+        """Fill ``buf`` from ``addr``. Neither needs to be word aligned. The
+        words covering the range are read and the extra bytes dropped."""
+        length = len(buf)
+        if not length:
+            return
+        start = addr & ~3
+        end = (addr + length + 3) & ~3
+        if start == addr and end == addr + length:
+            self.read_block_into(addr, buf)
+        elif end - start == 4:
+            word = self.read_word(start).to_bytes(4, "little")
+            buf[:] = word[addr - start : addr - start + length]
+        else:
+            words = bytearray(end - start)
+            self.read_block_into(start, words)
+            buf[:] = memoryview(words)[addr - start : addr - start + length]
+
+    def read_memory(self, addr, size) -> bytearray:
+        """Return ``size`` bytes from ``addr`` at any alignment."""
+        buf = bytearray(size)
+        self.read_memory_into(addr, buf)
+        return buf
+
+    def read_words(self, addresses, max_gap=8) -> dict:
+        """Read the words at ``addresses`` and return a dict of address to
+        value. Words less than ``max_gap`` words apart are read in one block
+        because the extra transfers are cheaper than another block read."""
+        values = {}
+        addresses = sorted(addresses)
+        index = 0
+        while index < len(addresses):
+            start = end = addresses[index]
+            index += 1
+            while index < len(addresses) and addresses[index] - end <= max_gap * 4:
+                end = addresses[index]
+                index += 1
+            if start == end:
+                values[start] = self.read_word(start)
+                continue
+            block = memoryview(self.read_block(start, end + 4 - start)).cast("I")
+            for addr in addresses:
+                if start <= addr <= end:
+                    values[addr] = block[(addr - start) // 4]
+        return values
+
+    def write_memory(self, addr, data, fill=None) -> None:
+        """Write ``data`` to ``addr`` at any alignment as one block of word
+        transfers. The partial words at either end keep their other bytes by
+        reading them first, or with ``fill`` they are padded with that byte
+        instead. Use 0xff for flash, where it leaves the bytes unchanged."""
+        length = len(data)
+        if not length:
+            return
+        start = addr & ~3
+        end = (addr + length + 3) & ~3
+        if start == addr and end == addr + length:
+            self.write_block(addr, data)
+            return
+        words = bytearray(end - start)
+        head = addr - start
+        if head:
+            edge = fill * 0x01010101 if fill is not None else self.read_word(start)
+            words[0:4] = edge.to_bytes(4, "little")
+        if addr + length != end and (end - start > 4 or not head):
+            edge = fill * 0x01010101 if fill is not None else self.read_word(end - 4)
+            words[-4:] = edge.to_bytes(4, "little")
+        words[head : head + length] = data
+        if len(words) == 4:
+            self.write_word(start, int.from_bytes(words, "little"))
+        else:
+            self.write_block(start, words)
+
+    def new_report(self):
+        """Start a new :class:`FlashReport` for the next board."""
+        self.report = _load("report").FlashReport()
+        if self.heap is not None:
+            self.heap.restart()
+            self.report.heap = self.heap
+        return self.report
+
+    def wait_for_value(self, addr, mask, value, timeout=1) -> int:
+        """Poll the word at ``addr`` until ``word & mask == value`` and return
+        the last word read. Raises TimeoutError after ``timeout`` seconds.
+
+        A probe with value match (see :meth:`configure_transfers`) polls by
+        itself. Otherwise polls after the first are a single AP read each."""
+        report = self.report
+        start = report.ticks()
+        limit = timeout * report.TICKS_PER_SECOND
+        probe = self.probe
+        try:
+            if self.value_match:
+                # Stop TAR auto-incrementing so every read is of addr.
+                self.write_csw(DapTarget.CSW_WORD_FIXED)
+                self.write_tar(addr)
+                while True:
+                    word = probe.read_ap_match(DapTarget.SWD_AP_DRW, mask, value)
+                    if word is not None:
+                        return word
+                    if report.since(start) > limit:
+                        break
+            else:
+                word = self.read_word(addr)
+                if word & mask == value:
+                    return word
+                self.write_csw(DapTarget.CSW_WORD_FIXED)
+                self.write_tar(addr)
+                # AP reads are posted, each returns the one before it.
+                probe.read_ap(DapTarget.SWD_AP_DRW)
+                while True:
+                    word = probe.read_ap(DapTarget.SWD_AP_DRW)
+                    if word & mask == value:
+                        return word
+                    if report.since(start) > limit:
+                        break
+            raise TimeoutError(f"0x{addr:08x} & 0x{mask:x} never became 0x{value:x}")
+        finally:
+            report.poll_ticks += report.since(start)
+
+    def is_halted(self) -> bool:
+        return (self.read_word(_DHCSR) & _DHCSR_S_HALT) != 0
+
+    def halt(self, reset=True, timeout=1) -> None:
+        """Stop the core and wait for DHCSR.S_HALT. With ``reset`` the core is
+        also reset through AIRCR and stops on the reset vector."""
+        self.write_word(_DHCSR, 0xa05f0003, posted=True)
+        self.write_word(_DEMCR, 0x00000001, posted=True)
+        if reset:
+            self.write_word(_AIRCR, 0x05fa0004, posted=True)
+        self.wait_for_value(_DHCSR, _DHCSR_S_HALT, _DHCSR_S_HALT, timeout)
+
+    def read_core_reg(self, reg) -> int:
+        """Read core register ``reg`` (0-12, :data:`REG_SP`, :data:`REG_PC` or
+        :data:`REG_XPSR`) of the halted core."""
+        self.write_word(_DCRSR, reg, posted=True)
+        self.wait_for_value(_DHCSR, _DHCSR_S_REGRDY, _DHCSR_S_REGRDY)
+        return self.read_word(_DCRDR)
+
+    def write_core_reg(self, reg, value) -> None:
+        """Write core register ``reg`` of the halted core."""
+        self.write_word(_DCRDR, value, posted=True)
+        self.write_word(_DCRSR, reg | _DCRSR_REGWNR, posted=True)
+        self.wait_for_value(_DHCSR, _DHCSR_S_REGRDY, _DHCSR_S_REGRDY)
+
+    def run_routine(self, addr, sp, args=(), timeout=1) -> int:
+        """Run the Thumb code at ``addr`` on the halted core with ``args`` in
+        r0-r3 and the stack at ``sp`` until it stops on a ``bkpt``, then
+        return r0. Interrupts stay masked. If it doesn't stop within
+        ``timeout`` seconds the core is halted and TimeoutError raised."""
+        for reg, value in enumerate(args):
+            self.write_core_reg(reg, value)
+        self.write_core_reg(REG_SP, sp)
+        self.write_core_reg(REG_PC, addr)
+        self.write_core_reg(REG_XPSR, 0x01000000)  # Thumb state
+        # C_MASKINTS may only change while halted so set it before running.
+        self.write_word(_DHCSR, 0xa05f000b, posted=True)
+        self.write_word(_DHCSR, 0xa05f0009, posted=True)
+        try:
+            self.wait_for_value(_DHCSR, _DHCSR_S_HALT, _DHCSR_S_HALT, timeout)
+        except TimeoutError:
+            self.write_word(_DHCSR, 0xa05f0003)
+            raise
+        return self.read_core_reg(0)
 
     def write_reg(self, reg, data):
         if (req & DAP_TRANSFER_APnDP) == 0:
@@ -63,48 +465,353 @@ class DapTarget:
             self.probe.write_ap(reg, data)
 
     def write_block(self, addr, data) -> None:
-        self.probe.write_ap(DapTarget.SWD_AP_TAR, addr)
         words = memoryview(data).cast("I")
-        self.probe.write_ap_multiple(DapTarget.SWD_AP_DRW, words)
-
-
-    def read_block(self, addr, size) -> bytes:
-        self.probe.write_ap(DapTarget.SWD_AP_TAR, addr)
-
-        # Post the read and ignore the result.
-        self.probe.read_ap(DapTarget.SWD_AP_DRW)
-
-        # We overread by one word because it allows read_ap_multiple to allocate
-        # the whole buffer we want to return. This could cause problems if
-        # reading past the end of a memory region.
-        words = self.probe.read_ap_multiple(DapTarget.SWD_AP_DRW, size // 4)
-        if isinstance(words, list):
-            words = array.array("I", words)
+        self.write_csw(DapTarget.CSW_WORD)
+        start = 0
+        while start < len(words):
+            # TAR only auto-increments within a 1 KiB boundary.
+            count = min(len(words) - start, (0x400 - (addr & 0x3FF)) // 4)
+            self.write_tar(addr)
+            self.probe.write_ap_multiple(DapTarget.SWD_AP_DRW, words[start : start + count])
+            self._advance_tar(count * 4)
+            addr += count * 4
+            start += count
+
+    def read_block(self, addr, size) -> bytearray:
+        buf = bytearray(size)
+        self.read_block_into(addr, buf)
+        return buf
+
+    def read_block_into(self, addr, buf) -> None:
+        """Fill ``buf`` with memory starting at ``addr``. ``buf`` length must be
+        a multiple of four."""
+        words = memoryview(buf).cast("I")
+        read_into = getattr(self.probe, "read_ap_multiple_into", None)
+        self.write_csw(DapTarget.CSW_WORD)
+        start = 0
+        while start < len(words):
+            # TAR only auto-increments within a 1 KiB boundary.
+            count = min(len(words) - start, (0x400 - (addr & 0x3FF)) // 4)
+            self.write_tar(addr)
+
+            # Post the read and ignore the result.
+            self.probe.read_ap(DapTarget.SWD_AP_DRW)
+
+            # We overread by one word because each AP read returns the result
+            # of the previous one. This could cause problems if reading past
+            # the end of a memory region.
+            chunk = words[start : start + count]
+            if read_into is not None:
+                read_into(DapTarget.SWD_AP_DRW, chunk)
+            else:
+                values = self.probe.read_ap_multiple(DapTarget.SWD_AP_DRW, count)
+                if isinstance(values, list):
+                    for i, value in enumerate(values):
+                        chunk[i] = value
+                else:
+                    chunk[:] = memoryview(values).cast("I")
+            # The extra posted read moves TAR one word further.
+            self._advance_tar((count + 1) * 4)
+            addr += count * 4
+            start += count
 
         # Read the RDBUFF to clear the last word
         self.probe.read_dp(DapTarget.SWD_DP_R_RDBUFF)
 
-        return memoryview(words).cast("B")
+    def set_geometry(self, geometry) -> None:
+        """Use ``geometry`` and the program unit that goes with it. Families
+        that program in other units override this."""
+        self.geometry = geometry
+        self.page_size = geometry.page_size
+
+    def erase(self):
+        """Erase the whole flash. Every family implements this."""
+        raise NotImplementedError()
+
+    def program_block(self, addr, buf):
+        """Program ``buf``, whole pages already erased, at ``addr``. Every
+        family implements this."""
+        raise NotImplementedError()
+
+    def program_begin(self) -> None:
+        """Prepare the flash controller for a run of ``program_page()`` calls."""
+
+    def program_end(self) -> None:
+        """Undo ``program_begin()``."""
+
+    def page_buffers(self, size):
+        """Return reusable ``(page, verify, erased)`` buffers of ``size`` bytes.
+        ``page`` holds padded partial pages, ``verify`` receives read backs and
+        ``erased`` is all 0xff. They are only reallocated when ``size``
+        changes so programming doesn't churn the heap."""
+        if self._erased is None or len(self._erased) != size:
+            self._page = bytearray(size)
+            self._verify = bytearray(size)
+            self._erased = memoryview(b"\xff" * size)
+            self._views = None
+        return self._page, self._verify, self._erased
+
+    def _short_views(self, size):
+        # (size, page, verify, erased) views ``size`` bytes long. The views
+        # for the last size are kept, so a run of short pages, such as
+        # buffers smaller than an nRF page, doesn't allocate new ones.
+        views = self._views
+        if views is None or views[0] != size:
+            views = self._views = (
+                size,
+                memoryview(self._page)[:size],
+                memoryview(self._verify)[:size],
+                self._erased[:size],
+            )
+        return views
+
+    def padded_page(self, buf, offset, size, align=None):
+        """Return up to ``size`` bytes of ``buf`` at ``offset``. If ``buf`` ends
+        first and isn't a multiple of ``align`` bytes (``size`` by default)
+        long, the rest is copied into the page buffer and padded with 0xff."""
+        remaining = len(buf) - offset
+        if remaining >= size:
+            return buf[offset : offset + size]
+        if self._page is None or len(self._page) < size:
+            self.page_buffers(size)
+        if align is not None:
+            if not remaining % align:
+                # Nothing to pad, so no copy either.
+                return buf if not offset else buf[offset:]
+            size = min(size, (remaining + align - 1) // align * align)
+        if size == len(self._page):
+            page, erased = self._page, self._erased
+        else:
+            _, page, _, erased = self._short_views(size)
+        page[:remaining] = buf[offset:]
+        page[remaining:] = erased[remaining:]
+        return page
+
+    def is_erased(self, data) -> bool:
+        """Return True if ``data`` is all 0xff. Call :meth:`page_buffers` first
+        with a size at least as large as ``data``."""
+        erased = self._erased
+        if len(data) != len(erased):
+            erased = self._short_views(len(data))[3]
+        return data == erased
+
+    def verify_block(self, addr, data) -> bool:
+        """Read back ``len(data)`` bytes at ``addr`` into the verify buffer and
+        compare them to ``data``."""
+        report = self.report
+        start = report.ticks()
+        verify = self._verify
+        if len(data) != len(verify):
+            verify = self._short_views(len(data))[2]
+        self.read_block_into(addr, verify)
+        report.add_verify(start, len(data))
+        return verify == data
+
+    def blank_check(self, start, length, samples=64) -> bool:
+        """Return True if the ``length`` bytes at ``start`` are all 0xff. A
+        few words spread over the range are read first so programmed parts
+        fail fast, then the whole range is read to be sure."""
+        if (start | length) & 0x3:
+            raise ValueError("blank_check range must be word aligned")
+        end = start + length
+        step = max(4, (length // samples) & ~0x3)
+        for addr in range(start, end, step):
+            if self.read_word(addr) != 0xffffffff:
+                return False
+        _, verify, erased = self.page_buffers(self.page_size)
+        addr = start
+        while addr < end:
+            size = min(len(verify), end - addr)
+            if size < len(verify):
+                _, _, verify, erased = self._short_views(size)
+            self.read_block_into(addr, verify)
+            if verify != erased:
+                return False
+            addr += size
+        return True
+
+    def erase_if_needed(self, start=None, length=None) -> bool:
+        """Erase the chip unless ``[start, start + length)`` (all of flash by
+        default) is already blank. Returns True if it erased."""
+        if start is None:
+            start = self.geometry.start
+            length = self.geometry.flash_size
+        with self.report.phase("blank_check"):
+            blank = self.blank_check(start, length)
+        if blank:
+            self.report.erase_skipped = True
+            return False
+        self.erase()
+        return True
+
+    def verify_policy(self, do_verify, policy):
+        """Return the policy for a ``program_flash()`` call: ``policy`` if
+        given, otherwise full or none from ``do_verify``. Records it in the
+        report."""
+        if policy is None:
+            verify = _load("verify")
+            policy = verify.VERIFY_FULL if do_verify else verify.VERIFY_NONE
+        method = str(policy)
+        if policy.mode == "crc" and not self.HARDWARE_CRC:
+            method = "crc (host)"
+        self.report.verify_method = method
+        return policy
+
+    def crc32(self, start, length) -> int:
+        """Return the CRC32 (see :func:`crc32`) of ``length`` bytes at
+        ``start``. This reads the range back and computes it on the host.
+        Families with a CRC engine override it and set ``HARDWARE_CRC``."""
+        _, verify, _ = self.page_buffers(self.page_size)
+        report = self.report
+        crc = 0xffffffff
+        end = start + length
+        while start < end:
+            read_start = report.ticks()
+            size = min(len(verify), end - start)
+            if size < len(verify):
+                verify = self._short_views(size)[2]
+            self.read_block_into(start, verify)
+            crc = crc32(verify, crc)
+            report.add_verify(read_start, size)
+            start += size
+        return crc
+
+    def verify_crc(self, addr, data) -> bool:
+        """Compare the target's CRC32 of ``data`` padded to a word at ``addr``
+        with the host's."""
+        checker = _load("verify").CrcVerifier(self)
+        checker.add(addr, data)
+        return checker.check()
+
+    def run_steps(self, steps):
+        """Run ``steps``, a generator that yields ``(addr, mask, value,
+        timeout)`` whenever it has to wait on the target, and return what it
+        returns. Each wait is a :meth:`wait_for_value` whose result is sent
+        back into the generator. :class:`FlashScheduler` runs the same
+        generators on several targets at once."""
+        word = None
+        try:
+            while True:
+                word = self.wait_for_value(*steps.send(word))
+        except StopIteration as stop:
+            return stop.value
+
+    def erase_steps(self):
+        """:meth:`erase` as steps for :meth:`run_steps`. Families that can
+        wait for the erase without blocking override this."""
+        self.erase()
+        yield from ()
+
+    def program_steps(self, addr, data):
+        """``program_block()`` as steps for :meth:`run_steps`. Families that
+        can wait for the write without blocking override this."""
+        self.program_block(addr, data)
+        yield from ()
+
+    def program_page(self, addr, data):
+        """Call the family's ``program_block()`` and add it to the report."""
+        report = self.report
+        if report.heap is not None:
+            report.heap.page_start()
+        start = report.ticks()
+        result = self.program_block(addr, data)
+        if report.heap is not None:
+            report.heap.page_end()
+        report.add_program(start, len(data))
+        return result
 
     def reset_link(self):
         self.probe.swj_sequence(51, 0xffffffffffffff)
         self.probe.swj_sequence(16, 0xe79e)
         self.probe.swj_sequence(51, 0xffffffffffffff)
         self.probe.swj_sequence(8, 0x00)
-        self.probe.read_dp(DapTarget.SWD_DP_R_IDCODE)
+        self.invalidate_shadow()
+        return self.probe.read_dp(DapTarget.SWD_DP_R_IDCODE)
+
+    def link_idcode(self):
+        """Reset the SWD line and return the DP IDCODE, or None if no target
+        answers."""
+        try:
+            idcode = self.reset_link()
+        except (OSError, RuntimeError):
+            return None
+        # Bit 0 of a real IDCODE is always set.
+        if idcode == 0xffffffff or not idcode & 1:
+            return None
+        return idcode
+
+    def wait_for_target(self, timeout=None, interval=0.05) -> int:
+        """Poll IDCODE until a target answers and return it. Waits forever
+        when ``timeout`` is None."""
+        start = time.monotonic()
+        while True:
+            idcode = self.link_idcode()
+            if idcode is not None:
+                return idcode
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError("No target found")
+            time.sleep(interval)
+
+    def wait_for_removal(self, interval=0.1) -> None:
+        """Poll IDCODE until the target stops answering."""
+        while self.link_idcode() is not None:
+            time.sleep(interval)
 
     def target_connect(self, swj_clock=5000) -> None:
-        # First disconnect, in case this really is a reconnect
-        self.probe.disconnect()
-        self.probe.connect()
-        self.probe.reset() # Resets the target device.
-        time.sleep(1)
-        # dap_idle_cycles 0
-        # dap_retry_count 128
-        # dap_match_retry_count 128
-
-        self.probe.set_clock(swj_clock)
-        self.reset_link()
+        with self.new_report().phase("connect"):
+            # First disconnect, in case this really is a reconnect
+            self.probe.disconnect()
+            self.probe.connect()
+            self.probe_connected = True
+            self.attached = False
+            self.probe.reset() # Resets the target device.
+            self.configure_transfers()
+
+            self.probe.set_clock(swj_clock)
+            # Wait for the target to come out of reset instead of a fixed delay.
+            self.wait_for_target(timeout=1)
+
+    def hot_attach(self, swj_clock=5000, timeout=None) -> bool:
+        """Fast connect for flashing boards back to back. The probe is only
+        connected the first time. Waits up to ``timeout`` seconds (forever
+        with None) for a target to answer on IDCODE and powers up its debug
+        port. If the target was already powered and halted it is attached
+        without a reset and True is returned. Otherwise returns False and
+        :meth:`select` resets it as usual."""
+        if not self.probe_connected:
+            self.probe.connect()
+            self.configure_transfers()
+            self.probe.set_clock(swj_clock)
+            self.probe_connected = True
+        self.wait_for_target(timeout)
+        self.forget_board()
+        # Start timing once a board is there.
+        with self.new_report().phase("connect"):
+            powered = (self.probe.read_dp(DapTarget.SWD_DP_R_CTRL_STAT) >> 28) == 0xf
+            self.target_prepare()
+            self.attached = powered and self.is_halted()
+        return self.attached
+
+    def forget_board(self) -> None:
+        """Drop what :meth:`select` found out about the previous board so it
+        isn't used for the next one. Families that keep more per-board state
+        extend this."""
+        self.geometry = None
+
+    def configure_transfers(self) -> None:
+        """Set the probe's idle cycles, WAIT retry count and match retry count
+        when it has ``transfer_configure()``, like CMSIS-DAP's
+        DAP_TransferConfigure. Probes that also have
+        ``read_ap_match(addr, mask, value)`` do the polling in
+        :meth:`wait_for_value`. It re-reads an AP register up to the match
+        retry count until ``read & mask == value``, like a CMSIS-DAP value
+        match read, and returns the word in RDBUFF after it or None when
+        the retries ran out."""
+        configure = getattr(self.probe, "transfer_configure", None)
+        self.value_match = False
+        if configure is not None:
+            configure(self.IDLE_CYCLES, self.WAIT_RETRY_COUNT, self.MATCH_RETRY_COUNT)
+            self.value_match = getattr(self.probe, "read_ap_match", None) is not None
 
     def target_prepare(self):
         self.probe.read_dp(DapTarget.SWD_DP_R_IDCODE)
@@ -114,97 +821,10 @@ class DapTarget:
         self.probe.write_dp(DapTarget.SWD_DP_W_ABORT, 0xf << 1) # Clear all errors. Bit 0 is dapabort so shift by one.
         self.probe.write_dp(DapTarget.SWD_DP_W_CTRL_STAT, 0x50000f00) # DP_CST_CDBGPWRUPREQ = 0x10000000 | DP_CST_CSYSPWRUPREQ = 0x40000000| DP_CST_MASKLANE(0xf) = 0x0F00
         
-        self.probe.write_dp(DapTarget.SWD_DP_W_SELECT, 0x00000000) # DP_SELECT_APBANKSEL(0) = 0 | DP_SELECT_APSEL(0) = 0
+        self.invalidate_shadow()
+        self.write_select(0x00000000) # DP_SELECT_APBANKSEL(0) = 0 | DP_SELECT_APSEL(0) = 0
         self.probe.write_dp(DapTarget.SWD_DP_W_CTRL_STAT, 0x50000f00) # DP_CST_CDBGPWRUPREQ = 0x10000000 | DP_CST_CSYSPWRUPREQ = 0x40000000| DP_CST_MASKLANE(0xf) = 0x0F00
         if (self.probe.read_dp(DapTarget.SWD_DP_R_CTRL_STAT) >> 28) != 0xf:
             print(hex(self.probe.read_dp(DapTarget.SWD_DP_R_CTRL_STAT)))
             raise RuntimeError("Failed to start SoC power")
-        self.probe.write_ap(DapTarget.SWD_AP_CSW, 0x23000052) # AP_CSW_ADDRINC_SINGLE = 0x10 | AP_CSW_DEVICEEN = 0x40 | AP_CSW_PROT(0x23) = 0x23000000 | AP_CSW_SIZE_WORD = 0x02
-
-def write_bin_file(target: DapTarget, file, addr, bufsize=1024, verify_only=False):
-    if verify_only:
-        print("Verifying...")
-    else:
-        print("Programming... ")
-
-    charcount = 0
-    to_write = file.read(bufsize)
-    while to_write:
-        if charcount % 64 == 0:
-            if charcount > 0:
-                duration = time.monotonic() - start_time
-                print(f" {duration:.1f}s")
-            print(f"{addr:08x}", end="")
-            start_time = time.monotonic()
-
-        if not target.program_flash(addr, to_write, verify_only=verify_only):
-           print(f"Failed writing at 0x{addr:08x}!")
-           break
-
-        addr += len(to_write)
-        charcount += 1
-        print(".", end="")
-        to_write = file.read(bufsize)
-    print("")
-
-def write_hex_file(target: DapTarget, file, verify_only=False):
-    if verify_only:
-        print("Verifying...")
-    else:
-        print("Programming... ")
-
-    charcount = 0
-    line_buf = bytearray(24)
-    buf = bytearray(BUFSIZE)
-    for i in range(len(buf)):
-        buf[i] = 0xff
-    buf_address = 0
-    last_write_address = None
-    for line in file:
-        if line[0] != ord(b":"):
-            continue
-        for b in range(1, len(line) - 1, 2):
-            line_buf[b // 2] = int(line[b:b+2], 16)
-        record_type = line_buf[3]
-        if record_type == 0:
-            address = base_address | line_buf[1] << 8 | line_buf[2]
-            bytecount = line_buf[0]
-            if address + bytecount > buf_address + len(buf):
-                # if last_write_address is not None:
-                #     print("i", hex(buf_address), hex(last_write_address), (buf_address - last_write_address) // BUFSIZE)
-                if (last_write_address is None or
-                    ((buf_address - last_write_address) // BUFSIZE) >= 64):
-                    if last_write_address is not None:
-                        duration = time.monotonic() - start_time
-                        print(f" {duration:.1f}s")
-                    print(f"{buf_address:08x}", end="")
-                    last_write_address = buf_address
-                    start_time = time.monotonic()
-
-                print(".", end="")
-                if not target.program_flash(buf_address, buf, verify_only=verify_only):
-                   print(f"Failed writing at 0x{buf_address:08x}!")
-                   break
-                buf_address = address
-                for i in range(len(buf)):
-                    buf[i] = 0xff
-            offset = address - buf_address
-            buf[offset:offset+bytecount] = line_buf[4:4+bytecount]
-            # print("write", hex(address))
-            pass # data
-        elif record_type == 3:
-            pass # start of execution
-        elif record_type == 1:
-            # end of file
-            if not target.program_flash(buf_address, buf, verify_only=verify_only):
-               print(f"Failed writing at 0x{buf_address:08x}!")
-               break
-        elif record_type == 4:
-            base_address = line_buf[4] << 24
-            base_address |= line_buf[5] << 16
-        else:
-            print("record type", record_type)
-            print(line_buf)
-
-    duration = time.monotonic() - start_time
-    print(f" {duration:.1f}s")
\ No newline at end of file
+        self.write_csw(DapTarget.CSW_WORD)
@@ -0,0 +1,120 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.bin_file`
+================================================================================
+
+Program a target from a raw binary file.
+"""
+
+import time
+
+from . import DapTarget
+from .verify import VERIFY_NONE, CrcVerifier
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+
+def bin_chunks(file, addr, bufsize=1024):
+    """Yield ``(address, data)`` for each ``bufsize`` block of ``file`` loaded
+    at ``addr``. ``data`` is a view of one reused buffer so use it before
+    getting the next block."""
+    # Read into one buffer for the whole file instead of allocating per chunk.
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    count = file.readinto(buf)
+    while count:
+        # Only the last block is short, so only it needs a new view.
+        yield addr, view if count == bufsize else view[:count]
+        addr += count
+        count = file.readinto(buf)
+
+
+def write_chunks(
+    target: DapTarget, chunks, verify_only=False, policy=None, report_file=None
+):
+    """Program (or verify) ``chunks``, an iterable of ``(address, data)`` such
+    as :func:`bin_chunks`, and return ``target.report``. The report is also
+    appended to ``report_file`` when given. ``policy`` is a
+    :class:`VerifyPolicy`, by default every page is read back. A CRC policy
+    checks each contiguous range with one CRC."""
+    # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+    if verify_only:
+        print("Verifying...")
+    else:
+        print("Programming... ")
+
+    report = target.report
+    crc = None
+    chunk_policy = policy
+    if policy is not None:
+        policy.restart()
+        if policy.mode == "crc":
+            crc = CrcVerifier(target)
+            chunk_policy = VERIFY_NONE
+    line_start = line_end = None
+    start_time = time.monotonic()
+    heap = report.heap
+    counted = False
+    with report.phase("verify" if verify_only else "program"):
+        # Pages include getting the next chunk. The first one allocates the
+        # buffers for the rest so it only counts towards the phase.
+        if heap is not None:
+            heap.page_start()
+        for addr, data in chunks:
+            # A line of progress covers 64 chunks.
+            if line_start is None or not line_start <= addr < line_end:
+                if line_start is not None:
+                    duration = time.monotonic() - start_time
+                    print(f" {duration:.1f}s")
+                print(f"{addr:08x}", end="")
+                line_start = addr
+                line_end = addr + 64 * len(data)
+                start_time = time.monotonic()
+
+            if not target.program_flash(
+                addr, data, verify_only=verify_only, policy=chunk_policy
+            ) or (crc is not None and not crc.add(addr, data)):
+                print(f"Failed writing at 0x{addr:08x}!")
+                report.fail(f"Failed writing at 0x{addr:08x}")
+                break
+
+            print(".", end="")
+            if heap is not None:
+                heap.page_end(counted)
+                heap.page_start()
+                counted = True
+        if heap is not None:
+            heap.page_end(False)
+    duration = time.monotonic() - start_time
+    print(f" {duration:.1f}s")
+    if crc is not None:
+        target.verify_policy(True, policy)
+        if report.ok is None:
+            with report.phase("verify"):
+                if not crc.check():
+                    print(f"CRC mismatch at 0x{crc.failed_address:08x}!")
+                    report.fail(f"CRC mismatch at 0x{crc.failed_address:08x}")
+    if report.ok is None:
+        report.ok = True
+    if report_file is not None:
+        report.write(report_file)
+    return report
+
+
+def write_bin_file(
+    target: DapTarget,
+    file,
+    addr,
+    bufsize=1024,
+    verify_only=False,
+    report_file=None,
+    policy=None,
+):
+    """Program (or verify) ``file`` at ``addr`` and return ``target.report``.
+    See :func:`write_chunks` for ``report_file`` and ``policy``."""
+    return write_chunks(
+        target, bin_chunks(file, addr, bufsize), verify_only, policy, report_file
+    )
@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.crc_stub`
+================================================================================
+
+A CRC32 routine that runs on the target for families without a CRC engine.
+It is loaded into SRAM and run on the halted core, so a verify only moves the
+routine and one result word over SWD instead of the whole image. The result
+matches :func:`adafruit_mcu_flasher.crc32`: seeded with 0xffffffff and not
+inverted at the end.
+
+The routine is Thumb-1 so it runs on every Cortex-M. It must be loaded at a
+word aligned address. On entry ``r0`` is the start address, ``r1`` the length
+in bytes and ``r2`` the CRC to continue from. It returns the CRC in ``r0`` and
+stops on ``bkpt`` at :data:`BKPT_OFFSET`. It uses a 16 entry table, one
+lookup per nibble, and needs no stack.
+"""
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+_CODE = (
+    0xA30A,  # 00      adr   r3, table
+    0x1841,  # 02      adds  r1, r0, r1       @ r1 = end
+    0x4288,  # 04 loop: cmp  r0, r1
+    0xD00F,  # 06      beq   done
+    0x7804,  # 08      ldrb  r4, [r0]
+    0x3001,  # 0a      adds  r0, #1
+    0x4062,  # 0c      eors  r2, r4
+    0x240F,  # 0e      movs  r4, #15
+    0x4014,  # 10      ands  r4, r2
+    0x00A4,  # 12      lsls  r4, r4, #2
+    0x591C,  # 14      ldr   r4, [r3, r4]
+    0x0912,  # 16      lsrs  r2, r2, #4
+    0x4062,  # 18      eors  r2, r4
+    0x240F,  # 1a      movs  r4, #15
+    0x4014,  # 1c      ands  r4, r2
+    0x00A4,  # 1e      lsls  r4, r4, #2
+    0x591C,  # 20      ldr   r4, [r3, r4]
+    0x0912,  # 22      lsrs  r2, r2, #4
+    0x4062,  # 24      eors  r2, r4
+    0xE7ED,  # 26      b     loop
+    0x0010,  # 28 done: movs r0, r2
+    0xBE00,  # 2a      bkpt  #0
+)
+
+BKPT_OFFSET = 0x2A
+
+
+def _stub() -> bytes:
+    code = bytearray()
+    for halfword in _CODE:
+        code += halfword.to_bytes(2, "little")
+    # table: the CRC of each nibble, right after the code at 0x2c.
+    for nibble in range(16):
+        crc = nibble
+        for _ in range(4):
+            crc = (crc >> 1) ^ (0xEDB88320 if crc & 1 else 0)
+        code += crc.to_bytes(4, "little")
+    return bytes(code)
+
+
+CRC32_STUB = _stub()
+
+# Worst case run time per byte: about 25 cycles on a 16 MHz core.
+_SECONDS_PER_BYTE = 2e-6
+
+
+def target_crc32(target, ram, start, length, crc=0xFFFFFFFF) -> int:
+    """Load the routine at ``ram`` on the halted ``target`` and return the
+    CRC32 of ``length`` bytes at ``start``, continued from ``crc``. The
+    routine and its stack use the first 512 bytes at ``ram``."""
+    target.write_block(ram, CRC32_STUB)
+    timeout = 1 + length * _SECONDS_PER_BYTE
+    return target.run_routine(ram, ram + 0x200, (start, length, crc), timeout)
@@ -0,0 +1,248 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.heap`
+================================================================================
+
+Measure heap use while flashing, to find what allocates in the hot path on a
+small CircuitPython host. Give the target a :class:`HeapMonitor` and every
+report it starts records the heap around each phase and each page. A page
+is one buffer of the file writers, from reading it to programming it, or one
+:meth:`DapTarget.program_page` call outside of them. The writers' first
+buffer allocates what the others reuse, so it only counts towards the phase:
+
+.. code-block:: python
+
+    from adafruit_mcu_flasher.heap import HeapMonitor
+
+    target.heap = HeapMonitor()
+    target.target_connect()
+    target.select()
+    report = write_hex_file(target, f)
+    print(report.heap)
+
+On CircuitPython it samples ``gc.mem_alloc()``. The heap only shrinks when
+the garbage collector runs, so the growth over a page is what the page
+allocated and a page where it shrank had a collection. Its pause is
+estimated from how much longer that page took than the others.
+
+On CPython it compares ``tracemalloc`` snapshots filtered to the driver
+modules, so the simulator, the probe tracing and the benchmark aren't
+counted. Only what a page still holds at its end shows up there: CPython
+frees temporaries right away. Collections are timed with ``gc.callbacks``.
+"""
+
+import gc
+import os
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+try:
+    _monotonic_ns = time.monotonic_ns
+except AttributeError:
+
+    def _monotonic_ns():
+        return int(time.monotonic() * 1000000000)
+
+
+class HeapMonitor:
+    """Heap statistics for one report, in bytes and seconds. ``high_water``
+    is the most heap in use seen, ``phases`` the most each phase added over
+    where it started, ``page_bytes`` and ``page_max`` the total and largest
+    allocation of a page and ``collections``, ``gc_time`` and ``gc_max`` the
+    garbage collections seen and their pauses. ``tracing`` is True when
+    ``tracemalloc`` is used. It then counts allocations made by the files
+    of this package except ``exclude``, by default this one."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, exclude=("heap.py",)):
+        self.tracing = tracemalloc is not None and not hasattr(gc, "mem_alloc")
+        self._filters = None
+        if self.tracing:
+            package = os.path.dirname(os.path.abspath(__file__))
+            self._filters = [tracemalloc.Filter(True, os.path.join(package, "*"))]
+            for name in exclude:
+                self._filters.append(
+                    tracemalloc.Filter(False, os.path.join(package, name))
+                )
+        self._started = False
+        self._own_tracing = False
+        self._gc_start = 0
+        self.high_water = 0
+        self.phases = {}
+        self.pages = 0
+        self.page_bytes = 0
+        self.page_max = 0
+        self.collections = 0
+        self.gc_time = 0.0
+        self.gc_max = 0.0
+        self._phase = None
+        self._phase_start = 0
+        self._phase_peak = 0
+        self._snapshot = None
+        self._page_start = 0
+        self._page_time = 0
+        self._page_depth = 0
+        self._quiet_time = 0
+        self._quiet_pages = 0
+
+    def restart(self) -> None:
+        """Clear the statistics for the next report."""
+        self.high_water = 0
+        self.phases = {}
+        self.pages = 0
+        self.page_bytes = 0
+        self.page_max = 0
+        self.collections = 0
+        self.gc_time = 0.0
+        self.gc_max = 0.0
+        self._phase = None
+        self._phase_start = 0
+        self._phase_peak = 0
+        self._snapshot = None
+        self._page_start = 0
+        self._page_time = 0
+        self._page_depth = 0
+        self._quiet_time = 0
+        self._quiet_pages = 0
+
+    def start(self) -> None:
+        """Start tracing on CPython. The hooks start it when needed."""
+        if self.tracing and not self._started:
+            self._own_tracing = not tracemalloc.is_tracing()
+            if self._own_tracing:
+                tracemalloc.start()
+            gc.callbacks.append(self._gc_callback)
+            self._started = True
+
+    def stop(self) -> None:
+        if self._started:
+            gc.callbacks.remove(self._gc_callback)
+            if self._own_tracing:
+                tracemalloc.stop()
+            self._started = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _gc_callback(self, phase, info):  # pylint: disable=unused-argument
+        if phase == "start":
+            self._gc_start = _monotonic_ns()
+        else:
+            self._collected((_monotonic_ns() - self._gc_start) / 1e9)
+
+    def _collected(self, pause) -> None:
+        self.collections += 1
+        self.gc_time += pause
+        self.gc_max = max(self.gc_max, pause)
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(self._filters)
+
+    @staticmethod
+    def _total(snapshot) -> int:
+        return sum(stat.size for stat in snapshot.statistics("filename"))
+
+    def in_use(self) -> int:
+        """Return the bytes of heap in use now, by the driver modules only on
+        CPython."""
+        if self.tracing:
+            return self._total(self._take_snapshot())
+        return gc.mem_alloc()
+
+    def phase_start(self, name) -> None:
+        self.start()
+        self._phase = name
+        self._phase_start = self.in_use()
+        self._phase_peak = self._phase_start
+
+    def phase_end(self) -> None:
+        peak = max(self._phase_peak, self.in_use())
+        self.high_water = max(self.high_water, peak)
+        grew = max(0, peak - self._phase_start)
+        self.phases[self._phase] = max(self.phases.get(self._phase, 0), grew)
+        self._phase = None
+
+    def page_start(self) -> None:
+        """Start a page. Pages inside of a page are part of it."""
+        self._page_depth += 1
+        if self._page_depth > 1:
+            return
+        self.start()
+        if self.tracing:
+            self._snapshot = self._take_snapshot()
+            self._page_start = self._total(self._snapshot)
+        else:
+            self._page_start = gc.mem_alloc()
+        self._phase_peak = max(self._phase_peak, self._page_start)
+        self._page_time = _monotonic_ns()
+
+    def page_end(self, counted=True) -> None:
+        """End the page, leaving it out of the statistics unless ``counted``."""
+        self._page_depth -= 1
+        if self._page_depth or not counted:
+            self._page_depth = max(0, self._page_depth)
+            return
+        elapsed = _monotonic_ns() - self._page_time
+        if self.tracing:
+            # What the driver modules hold now and didn't at the start, per
+            # file so frees in one don't hide allocations in another.
+            diff = self._take_snapshot().compare_to(self._snapshot, "filename")
+            self._snapshot = None
+            allocated = sum(max(0, stat.size_diff) for stat in diff)
+            peak = self._page_start + allocated
+        else:
+            peak = gc.mem_alloc()
+            allocated = peak - self._page_start
+        self.pages += 1
+        self.high_water = max(self.high_water, peak)
+        self._phase_peak = max(self._phase_peak, peak)
+        if not self.tracing and allocated < 0:
+            # The heap shrank so it was collected. What the page allocated
+            # is unknown and its extra time is the pause.
+            average = self._quiet_time / self._quiet_pages if self._quiet_pages else 0
+            self._collected(max(0, elapsed - average) / 1e9)
+            return
+        self._quiet_time += elapsed
+        self._quiet_pages += 1
+        self.page_bytes += allocated
+        self.page_max = max(self.page_max, allocated)
+
+    @property
+    def page_average(self) -> float:
+        """Bytes allocated per page, over the pages without a collection."""
+        return self.page_bytes / self._quiet_pages if self._quiet_pages else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "source": "tracemalloc" if self.tracing else "gc",
+            "high_water": self.high_water,
+            "phases": dict(self.phases),
+            "pages": self.pages,
+            "page_bytes": self.page_bytes,
+            "page_max": self.page_max,
+            "page_average": self.page_average,
+            "collections": self.collections,
+            "gc_time": self.gc_time,
+            "gc_max": self.gc_max,
+        }
+
+    def __str__(self):
+        return (
+            f"heap high water {self.high_water} bytes, {self.page_average:.0f} bytes per page "
+            f"(max {self.page_max}), {self.collections} collections "
+            f"({self.gc_time * 1000:.1f} ms, max {self.gc_max * 1000:.1f} ms)"
+        )
@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.hex_file`
+================================================================================
+
+Program a target from an Intel HEX file.
+"""
+
+from . import DapTarget
+from .bin_file import write_chunks
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+
+def hex_chunks(file, bufsize=1024):
+    """Decode the Intel HEX lines in ``file`` and yield ``(address, buffer)``
+    for each ``bufsize`` aligned block that has data. Gaps are 0xff. The same
+    buffer is reused for every block so use it before getting the next one."""
+    line_buf = bytearray(261)
+    erased = b"\xff" * bufsize
+    buf = bytearray(erased)
+    buf_address = None
+    base_address = 0
+    for line in file:
+        if line[0] != ord(b":"):
+            continue
+        length = (len(line.rstrip()) - 1) // 2
+        for b in range(length):
+            line_buf[b] = int(line[1 + 2 * b : 3 + 2 * b], 16)
+        record_type = line_buf[3]
+        if record_type == 0:
+            address = base_address + (line_buf[1] << 8 | line_buf[2])
+            start = 4
+            end = 4 + line_buf[0]
+            while start < end:
+                if (
+                    buf_address is None
+                    or not buf_address <= address < buf_address + bufsize
+                ):
+                    if buf_address is not None:
+                        yield buf_address, buf
+                        buf[:] = erased
+                    buf_address = address - address % bufsize
+                offset = address - buf_address
+                count = min(end - start, bufsize - offset)
+                buf[offset : offset + count] = line_buf[start : start + count]
+                address += count
+                start += count
+        elif record_type == 1:
+            break  # end of file
+        elif record_type == 2:
+            base_address = (line_buf[4] << 8 | line_buf[5]) << 4
+        elif record_type == 4:
+            base_address = (line_buf[4] << 8 | line_buf[5]) << 16
+        elif record_type not in (3, 5):  # start addresses
+            print("record type", record_type)
+            print(line_buf[:length])
+    if buf_address is not None:
+        yield buf_address, buf
+
+
+def write_hex_file(
+    target: DapTarget,
+    file,
+    verify_only=False,
+    bufsize=1024,
+    report_file=None,
+    policy=None,
+):
+    """Program (or verify) ``file`` and return ``target.report``. See
+    :func:`write_chunks` for ``report_file`` and ``policy``."""
+    return write_chunks(
+        target, hex_chunks(file, bufsize), verify_only, policy, report_file
+    )
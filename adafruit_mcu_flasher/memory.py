@@ -0,0 +1,74 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.memory`
+================================================================================
+
+Batch small target memory writes.
+"""
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+
+class MemoryWriter:
+    """Collects small writes to ``target`` and sends them with as few
+    transfers as possible. Writes that touch or overlap are merged, later
+    ones winning, and each merged run is sent with
+    :meth:`DapTarget.write_memory` using ``fill``. Use it as a context manager
+    to flush on exit:
+
+    .. code-block:: python
+
+        with MemoryWriter(target) as memory:
+            memory.write_byte(0x20000001, 0x12)
+            memory.write_halfword(0x20000002, 0x3456)
+    """
+
+    def __init__(self, target, fill=None):
+        self.target = target
+        self.fill = fill
+        self._writes = []
+
+    def write(self, addr, data) -> None:
+        self._writes.append((addr, bytes(data)))
+
+    def write_byte(self, addr, value) -> None:
+        self.write(addr, bytes((value & 0xFF,)))
+
+    def write_halfword(self, addr, value) -> None:
+        self.write(addr, (value & 0xFFFF).to_bytes(2, "little"))
+
+    def write_word(self, addr, value) -> None:
+        self.write(addr, (value & 0xFFFFFFFF).to_bytes(4, "little"))
+
+    def runs(self) -> list:
+        """Return the merged ``(address, data)`` runs that flush() would write."""
+        spans = []
+        for addr, data in sorted(self._writes, key=lambda write: write[0]):
+            end = addr + len(data)
+            if spans and addr <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([addr, end])
+        runs = [(start, bytearray(end - start)) for start, end in spans]
+        # Copy in the order written so later writes win.
+        for addr, data in self._writes:
+            for start, run in runs:
+                if start <= addr < start + len(run):
+                    run[addr - start : addr - start + len(data)] = data
+                    break
+        return runs
+
+    def flush(self) -> None:
+        for addr, data in self.runs():
+            self.target.write_memory(addr, data, self.fill)
+        self._writes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
@@ -0,0 +1,244 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.multidrop`
+================================================================================
+
+Flash several targets that share one probe on an SWD multi-drop bus. Every
+target on the bus is given a :class:`DropProbe` from a :class:`MultiDropBus`.
+The drop selects its target with DP ``TARGETSEL`` whenever another target
+used the bus last. :class:`FlashScheduler` interleaves the targets' work:
+while one target's flash is busy with an erase or a page write, the bus
+loads the next page into another.
+
+.. code-block:: python
+
+    from adafruit_mcu_flasher import sam
+    from adafruit_mcu_flasher.multidrop import FlashScheduler, MultiDropBus
+    from adafruit_mcu_flasher.planner import FlashPlan
+
+    bus = MultiDropBus(probe)
+    targets = [sam.SAM(bus.drop(0x01002927)), sam.SAM(bus.drop(0x11002927))]
+    scheduler = FlashScheduler()
+    for target in targets:
+        target.target_connect()
+        target.select()
+        scheduler.add(target, FlashPlan(sam.SAM, target.geometry, chunks).steps(target))
+    scheduler.run()
+
+nRESET is shared on most multi-drop boards so connecting or resetting one
+target resets them all. Connect and select every target before running the
+scheduler.
+
+No target drives the ACK of a ``TARGETSEL`` write so the probe can't send it
+as a normal DP write. The bus probe must have ``swd_sequence(sequences)``
+like pyOCD's: each sequence is ``(clock_count, bits)`` to send or
+``(clock_count,)`` to read, and it returns a list of the bits read.
+:class:`adafruit_mcu_flasher.pyocd_probe.PyocdProbe` has it.
+"""
+
+import time
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+_DP_IDCODE = 0x00
+_DP_SELECT = 0x08
+
+# Request for a DP write of TARGETSEL (0x0c): start, DP, write, A[3:2] = 3,
+# parity, stop and park, sent LSB first.
+_TARGETSEL_REQUEST = 0x99
+
+
+class MultiDropBus:
+    """Shares ``probe`` between the targets of a multi-drop bus.
+    :attr:`switches` counts how often the bus changed targets."""
+
+    def __init__(self, probe):
+        if getattr(probe, "swd_sequence", None) is None:
+            raise ValueError("Multi-drop needs a probe with swd_sequence")
+        self.probe = probe
+        self.PinGroup = probe.PinGroup  # pylint: disable=invalid-name
+        self.connected = False
+        self.selected = None
+        self.switches = 0
+
+    def drop(self, targetsel):
+        """Return a :class:`DropProbe` for the target whose TARGETSEL value
+        is ``targetsel``."""
+        return DropProbe(self, targetsel)
+
+    def connect(self):
+        """Connect the probe, once for all the targets."""
+        if not self.connected:
+            self.probe.connect()
+            self.connected = True
+
+    def disconnect(self):
+        """Disconnect the probe from every target."""
+        self.selected = None
+        self.connected = False
+        self.probe.disconnect()
+
+    def select(self, drop):
+        """Make ``drop``'s target the one that answers on the bus."""
+        if self.selected is drop:
+            return
+        probe = self.probe
+        # A line reset deselects every target, then TARGETSEL picks one. The
+        # write isn't acknowledged and must be followed by an IDCODE read.
+        probe.swj_sequence(51, 0xFFFFFFFFFFFFFF)
+        probe.swj_sequence(8, 0x00)
+        targetsel = drop.targetsel
+        parity = bin(targetsel).count("1") & 1
+        probe.swd_sequence(
+            (
+                (8, _TARGETSEL_REQUEST),
+                (5,),  # turnaround, ACK and turnaround, not driven
+                (33, targetsel | parity << 32),
+                (2, 0),
+            )
+        )
+        probe.read_dp(_DP_IDCODE)
+        self.selected = drop
+        self.switches += 1
+        if drop.dp_select is not None:
+            probe.write_dp(_DP_SELECT, drop.dp_select)
+
+
+class DropProbe:
+    """The probe calls :class:`DapTarget` makes, for one target on a
+    :class:`MultiDropBus`. DP SELECT is shadowed per target and restored
+    after the target is selected again."""
+
+    def __init__(self, bus, targetsel):
+        self.bus = bus
+        self.targetsel = targetsel
+        self.PinGroup = bus.PinGroup  # pylint: disable=invalid-name
+        self.dp_select = None
+        # Value match when the bus probe has it. The settings are the probe's
+        # so they aren't restored per target.
+        if getattr(bus.probe, "read_ap_match", None) is not None:
+            self.transfer_configure = getattr(bus.probe, "transfer_configure", None)
+            self.read_ap_match = self._read_ap_match
+
+    def connect(self, protocol=None):  # pylint: disable=unused-argument
+        """Connect the shared probe if it isn't already."""
+        self.bus.connect()
+
+    def disconnect(self):
+        """Release the bus. The other targets still use the probe."""
+        if self.bus.selected is self:
+            self.bus.selected = None
+
+    def reset(self):
+        """Reset the probe, and with a shared nRESET every target."""
+        self.bus.probe.reset()
+
+    def set_clock(self, frequency):
+        """Set the SWD clock of the whole bus."""
+        self.bus.probe.set_clock(frequency)
+
+    def swj_sequence(self, length, bits):
+        """Send a line sequence. Line resets deselect every target."""
+        self.bus.selected = None
+        self.bus.probe.swj_sequence(length, bits)
+
+    def write_pins(self, group, mask, value):
+        """Drive the probe's pins, which every target shares."""
+        self.bus.probe.write_pins(group, mask, value)
+
+    def read_dp(self, addr) -> int:
+        """Read a DP register of this target."""
+        self.bus.select(self)
+        return self.bus.probe.read_dp(addr)
+
+    def write_dp(self, addr, value):
+        """Write a DP register of this target."""
+        self.bus.select(self)
+        if addr == _DP_SELECT:
+            self.dp_select = value
+        self.bus.probe.write_dp(addr, value)
+
+    def read_ap(self, addr) -> int:
+        """Post an AP read on this target."""
+        self.bus.select(self)
+        return self.bus.probe.read_ap(addr)
+
+    def write_ap(self, addr, value):
+        """Write an AP register of this target."""
+        self.bus.select(self)
+        self.bus.probe.write_ap(addr, value)
+
+    def read_ap_multiple(self, addr, count=1) -> list:
+        """Read an AP register of this target ``count`` times."""
+        self.bus.select(self)
+        return self.bus.probe.read_ap_multiple(addr, count)
+
+    def write_ap_multiple(self, addr, values):
+        """Write ``values`` to an AP register of this target."""
+        self.bus.select(self)
+        self.bus.probe.write_ap_multiple(addr, values)
+
+    def _read_ap_match(self, addr, mask, value):
+        self.bus.select(self)
+        return self.bus.probe.read_ap_match(addr, mask, value)
+
+
+class _Job:  # pylint: disable=too-few-public-methods
+    """A target's step generator and the status read it waits on."""
+
+    def __init__(self, target, steps):
+        self.target = target
+        self.steps = steps
+        self.wait = None
+        self.wait_start = 0
+        self.result = None
+
+
+class FlashScheduler:
+    """Runs step generators (see :meth:`DapTarget.run_steps`) on several
+    targets at once. A waiting target gets one status read per turn, then the
+    bus moves on to the next target that has work."""
+
+    def __init__(self):
+        self.jobs = []
+        self.polls = 0
+
+    def add(self, target, steps) -> None:
+        """Run ``steps``, such as :meth:`FlashPlan.steps`, on ``target``."""
+        self.jobs.append(_Job(target, steps))
+
+    def _poll(self, job) -> bool:
+        # Return True when the job's wait is over.
+        addr, mask, value, timeout = job.wait
+        word = job.target.read_word(addr)
+        self.polls += 1
+        if word & mask == value:
+            job.result = word
+            return True
+        if time.monotonic() - job.wait_start > timeout:
+            raise TimeoutError(f"0x{addr:08x} & 0x{mask:x} never became 0x{value:x}")
+        return False
+
+    def run(self) -> list:
+        """Run every job to the end and return the targets' reports. A job
+        that fails has its report failed and the others carry on."""
+        pending = list(self.jobs)
+        while pending:
+            for job in tuple(pending):
+                try:
+                    if job.wait is not None and not self._poll(job):
+                        continue
+                    job.wait = job.steps.send(job.result)
+                    job.wait_start = time.monotonic()
+                    job.result = None
+                except StopIteration:
+                    pending.remove(job)
+                except (OSError, RuntimeError, ValueError) as error:
+                    job.target.report.fail(str(error))
+                    pending.remove(job)
+        jobs = self.jobs
+        self.jobs = []
+        return [job.target.report for job in jobs]
@@ -4,9 +4,10 @@
 """
 """
 
-import time
 
-from . import DapTarget
+from . import DapTarget, FlashGeometry
+from .memory import MemoryWriter
+from .crc_stub import target_crc32
 
 __version__ = "0.0.0+auto.0"
 __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
@@ -26,30 +27,51 @@ NRF5X_FICR_FLASHSIZE = 0x10000110    # Flash Variant
 NRF_NVMC_BASE = 0x4001E000
 NRF_NVMC_READY = NRF_NVMC_BASE + 0x400
 NRF_NVMC_CONFIG = NRF_NVMC_BASE + 0x504
+NRF_NVMC_ERASEPAGE = NRF_NVMC_BASE + 0x508
 NRF_NVMC_ERASEALL = NRF_NVMC_BASE + 0x50c
+NRF_NVMC_ERASEUICR = NRF_NVMC_BASE + 0x514
+
+NRF_UICR_BASE = 0x10001000
+NRF_UICR_SIZE = 0x400
 
 NRF5X_FLASH_START = 0
+NRF5X_RAM_START = 0x20000000
+# Default program size until select() reads the real page size.
 CHUNK_SIZE = 1024
 
 class NRF(DapTarget):
+    # crc32() runs a routine in SRAM.
+    HARDWARE_CRC = True
+
+    def __init__(self, probe):
+        super().__init__(probe)
+        self.page_size = CHUNK_SIZE
+        # NVMC writes single words so only pad the tail to a word.
+        self.write_align = 4
+
     def select(self):
-        self.target_prepare()
-        
-        # Stop the core
-        self.write_word(NRF5X_DHCSR, 0xa05f0003)
-        self.write_word(NRF5X_DEMCR, 0x00000001)
-        self.write_word(NRF5X_AIRCR, 0x05fa0004)
+        with self.report.phase("select"):
+            self.target_prepare()
 
-        # Family ID
-        hwid = self.read_word(NRF5X_FICR_HWID)
+            # Stop the core. A target that hot_attach() found halted isn't reset.
+            self.halt(reset=not self.attached)
 
-        # Variant ID and swap its endian
-        chipvariant = self.read_word(NRF5X_FICR_CHIPVARIANT)
-        variant = chipvariant.to_bytes(4, "big").decode("utf-8")
-        print(f"nRF{hwid:x}_{variant}")
+            # Family ID
+            hwid = self.read_word(NRF5X_FICR_HWID)
 
-        codepagesize = self.read_word(NRF5X_FICR_CODEPAGESIZE)
-        codesize = self.read_word(NRF5X_FICR_CODESIZE)
+            # Variant ID and swap its endian
+            chipvariant = self.read_word(NRF5X_FICR_CHIPVARIANT)
+            variant = chipvariant.to_bytes(4, "big").decode("utf-8")
+            print(f"nRF{hwid:x}_{variant}")
+            self.report.family = "nrf5x"
+            self.report.device_id = hwid
+            self.report.device_name = f"nRF{hwid:x}_{variant}"
+
+            codepagesize = self.read_word(NRF5X_FICR_CODEPAGESIZE)
+            codesize = self.read_word(NRF5X_FICR_CODESIZE)
+            # Every page is individually erasable and there are no lock regions.
+            self.set_geometry(FlashGeometry(codesize * codepagesize, codepagesize, codepagesize,
+                                            1, NRF5X_FLASH_START))
 
     def deselect(self):
         self.write_word(NRF5X_DEMCR, 0x00000000)
@@ -58,77 +80,184 @@ class NRF(DapTarget):
     def flash_ready(self) -> bool:
         return (self.read_word(NRF_NVMC_READY) & 1) != 0
 
-    def flash_wait_ready(self) -> bool:
-        start = time.monotonic()
-        while (time.monotonic() - start) < 1 and not self.flash_ready():
-            pass
-        return self.flash_ready()
+    def flash_wait_ready(self, timeout=1) -> bool:
+        try:
+            self.wait_for_value(NRF_NVMC_READY, 1, 1, timeout)
+        except TimeoutError:
+            return False
+        return True
 
     def erase(self):
-        self.write_word(NRF_NVMC_CONFIG, 2)    # Erase Enable
-        self.write_word(NRF_NVMC_ERASEALL, 1)  # Erase All
+        with self.report.phase("erase"):
+            self.run_steps(self.erase_steps())
 
-        while not self.flash_ready():
-            pass
+    def erase_steps(self):
+        self.write_word(NRF_NVMC_CONFIG, 2, posted=True)    # Erase Enable
+        self.write_word(NRF_NVMC_ERASEALL, 1, posted=True)  # Erase All
 
+        # ERASEALL takes up to 300 ms on the nRF52840.
+        yield (NRF_NVMC_READY, 1, 1, 5)
+
+        self.write_word(NRF_NVMC_CONFIG, 0)  # Disable Erase
+
+    def erase_range(self, addr, size) -> bool:
+        """Erase every page that overlaps ``[addr, addr + size)``."""
+        self.geometry.check_range(addr, size)
+        page_size = self.geometry.page_size
+        addr -= addr % page_size
+        end = addr + size
+
+        self.write_word(NRF_NVMC_CONFIG, 2, posted=True)    # Erase Enable
+        ok = True
+        while addr < end and ok:
+            self.write_word(NRF_NVMC_ERASEPAGE, addr, posted=True)
+            ok = self.flash_wait_ready()
+            addr += page_size
         self.write_word(NRF_NVMC_CONFIG, 0)  # Disable Erase
+        return ok
+
+    def crc32(self, start, length) -> int:
+        """Compute the CRC32 of ``length`` bytes at ``start`` with a routine
+        run from SRAM. The core must be halted, as it is after select()."""
+        return target_crc32(self, NRF5X_RAM_START, start, length)
 
     def program_start(self, *, offset=0, size=0):
         return NRF5X_FLASH_START + offset
 
-    def program_flash(self, addr, buf, do_verify=True) -> bool:
-        # address must be word-aligned
-        if addr & 0x03 != 0:
-            return False
+    def program_begin(self):
+        self.write_word(NRF_NVMC_CONFIG, 1, posted=True) # Write Enable
+
+    def program_end(self):
+        self.write_word(NRF_NVMC_CONFIG, 0) # Write Disable
+
+    def program_block(self, addr, buf) -> bool:
+        """Write ``buf`` with the NVMC write enabled and wait for it."""
+        self.write_block(addr, buf)
+        return self.flash_wait_ready()
+
+    def program_steps(self, addr, data):
+        self.write_block(addr, data)
+        yield (NRF_NVMC_READY, 1, 1, 1)
+
+    def program_flash(self, addr, buf, do_verify=True, verify_only=False, policy=None) -> bool:
+        """Program ``buf`` at ``addr`` skipping erased pages. ``policy`` is a
+        :class:`VerifyPolicy` and defaults to full or no verification from
+        ``do_verify``. With ``verify_only`` nothing is written."""
+        if self.geometry is not None:
+            self.geometry.check_range(addr, len(buf))
 
-        self.write_word(NRF_NVMC_CONFIG, 1) # Write Enable
-
-        offset = 0
-        while offset < len(buf):
-            remaining = len(buf) - offset
-            if remaining >= CHUNK_SIZE:
-                data = memoryview(buf)[offset:offset + CHUNK_SIZE]
-            else:
-                data = bytearray(CHUNK_SIZE)
-                for i in range(CHUNK_SIZE):
-                    if i < remaining:
-                        data[i] = buf[offset+i]
-                    else:
-                        data[i] = 0xff
-
-            hasdata = False
-            for value in data:
-                if value != 0xff:
-                    hasdata = True
-                    break
-
-            if hasdata:
-                self.write_block(addr + offset, data)
-            else:
-                print("no data", addr + offset)
-
-            if not self.flash_wait_ready():
-                # Flash timed out before being ready!
-                return False
-
-            # Optionally verify the written data
-            if hasdata and do_verify:
-                verify_buffer = self.read_block(addr + offset, CHUNK_SIZE)
-                if verify_buffer != data:
+        policy = self.verify_policy(do_verify, policy)
+        if not verify_only:
+            self.program_begin()
+        try:
+            buf = memoryview(buf)
+            head = -addr % 4
+            if head:
+                # The NVMC only writes words. Write the bytes up to the next word
+                # padded with 0xff, which leaves the rest of the word unchanged.
+                head = min(head, len(buf))
+                if not verify_only:
+                    self.write_memory(addr, buf[:head], fill=0xff)
+                    if not self.flash_wait_ready():
+                        return False
+                if policy.mode != "none" and self.read_memory(addr, head) != buf[:head]:
                     return False
-                del verify_buffer
+                addr += head
+                buf = buf[head:]
 
-            offset += len(data)
+            self.page_buffers(self.page_size)
+            offset = 0
+            while offset < len(buf):
+                data = self.padded_page(buf, offset, self.page_size, self.write_align)
+                hasdata = not self.is_erased(data)
 
+                if hasdata and not verify_only:
+                    if not self.program_page(addr + offset, data):
+                        # Flash timed out before being ready!
+                        return False
+                elif not verify_only:
+                    self.report.pages_skipped += 1
 
-        self.write_word(NRF_NVMC_CONFIG, 0) # Write Disable
+                # Optionally verify the written data
+                if hasdata and policy.check_page() and not self.verify_block(addr + offset, data):
+                    return False
+
+                offset += len(data)
+        finally:
+            # Leave the NVMC write disabled whichever way this returns.
+            if not verify_only:
+                self.program_end()
 
+        if policy.mode == "crc" and not self.verify_crc(addr, buf):
+            return False
         return True
 
     def program_uicr(self, addr, value):
-        self.write_word(NRF_NVMC_CONFIG, 1) # Write Enable
-        self.write_word(addr, value);
-        while not self.flash_ready():
-            pass
-        self.write_word(NRF_NVMC_CONFIG, 0) # Write Disable
+        """Program one UICR word. See :meth:`configure_uicr`."""
+        return self.configure_uicr({addr: value})
+
+    def configure_uicr(self, values, erase=False, timeout=1) -> list:
+        """Program the UICR words in ``values``, a dict of address to value,
+        and return the addresses that were written.
+
+        The words are read in blocks of nearby words and the ones that already
+        match are skipped. Flash bits only go from 1 to 0, so a word that
+        needs a 0 bit set back to 1 needs a UICR erase. With ``erase`` the
+        whole UICR is read, erased and written back with the new values.
+        Without it a RuntimeError is raised before anything is written. The
+        rest are written in one write enable window and read back the same
+        way. Changes are recorded in the report as fuse changes.
+        """
+        for addr in values:
+            if addr & 0x3 or not NRF_UICR_BASE <= addr < NRF_UICR_BASE + NRF_UICR_SIZE:
+                raise ValueError(f"0x{addr:08x} is not a UICR word")
+        current = self.read_words(values)
+        writes = {}
+        needs_erase = []
+        for addr in sorted(values):
+            value = values[addr] & 0xffffffff
+            old = current[addr]
+            if old == value:
+                continue
+            if old & value != value:
+                needs_erase.append(addr)
+            writes[addr] = value
+
+        if needs_erase:
+            if not erase:
+                raise RuntimeError("UICR erase needed to program " +
+                                   ", ".join(f"0x{addr:08x}" for addr in needs_erase))
+            # Everything is erased so keep every programmed word.
+            uicr = memoryview(self.read_block(NRF_UICR_BASE, NRF_UICR_SIZE)).cast("I")
+            kept = {}
+            for i, value in enumerate(uicr):
+                if value != 0xffffffff:
+                    kept[NRF_UICR_BASE + 4 * i] = value
+            kept.update(writes)
+            self.write_word(NRF_NVMC_CONFIG, 2, posted=True)    # Erase Enable
+            self.write_word(NRF_NVMC_ERASEUICR, 1, posted=True)
+            if not self.flash_wait_ready(timeout):
+                raise TimeoutError("UICR erase timed out")
+            self.write_word(NRF_NVMC_CONFIG, 0)
+        for addr, value in writes.items():
+            self.report.fuse_change(f"UICR 0x{addr:08x}", current[addr], value)
+        if needs_erase:
+            writes = {addr: value for addr, value in kept.items() if value != 0xffffffff}
+
+        if not writes:
+            return []
+        self.program_begin()
+        with MemoryWriter(self) as memory:
+            for addr, value in writes.items():
+                memory.write_word(addr, value)
+        ready = self.flash_wait_ready(timeout)
+        self.program_end()
+        if not ready:
+            raise TimeoutError("UICR write timed out")
+
+        written = self.read_words(writes)
+        for addr, value in writes.items():
+            if written[addr] != value:
+                raise RuntimeError(f"UICR verify failed at 0x{addr:08x}")
+        return sorted(writes)
  
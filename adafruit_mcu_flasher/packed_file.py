@@ -0,0 +1,299 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.packed_file`
+================================================================================
+
+Program a target from a packed image. Firmware is mostly erased (0xff) space,
+runs of the same byte and repeated pages, so a packed image is usually a
+fraction of the ``.bin`` and much faster to read off a small CIRCUITPY drive.
+It is unpacked one page at a time into two fixed buffers.
+
+Make one on a computer from a ``.bin`` or ``.hex`` file:
+
+.. code-block:: shell
+
+    python -m adafruit_mcu_flasher.packed_file firmware.hex -o firmware.mcup
+
+and program it like any other image:
+
+.. code-block:: python
+
+    with open("firmware.mcup", "rb") as f:
+        write_packed_file(target, f)
+
+The format is little endian. A 12 byte header holds ``b"MCUP"``, the version,
+a reserved byte, the page size (u16) and the CRC32 (see :func:`crc32`) of the
+image data. Records follow, each starting with a tag byte:
+
+* ``SEGMENT`` address (u32) and length (u32): the pages that follow are
+  loaded from ``address``. The last one may be shorter than a page.
+* ``ERASED``: a page of 0xff.
+* ``RAW``: the page's bytes.
+* ``PACKED`` length (u16) and that many bytes: the page as runs. A control
+  byte below 0x80 is followed by that many plus one literal bytes, one of
+  0x80 or more by a byte repeated ``(control & 0x7f) + 3`` times.
+* ``COPY`` offset (u32): the same page as the ``RAW`` or ``PACKED`` record at
+  that file offset. The file must be seekable.
+* ``END``.
+"""
+
+from . import DapTarget, crc32
+from .bin_file import bin_chunks, write_chunks
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+MAGIC = b"MCUP"
+VERSION = 1
+
+TAG_END = 0
+TAG_SEGMENT = 1
+TAG_ERASED = 2
+TAG_RAW = 3
+TAG_PACKED = 4
+TAG_COPY = 5
+
+_MIN_RUN = 3
+_MAX_RUN = 0x7F + _MIN_RUN
+_MAX_LITERAL = 0x80
+
+
+def _pack_page(page) -> bytearray:
+    out = bytearray()
+    literal = 0
+    i = 0
+    size = len(page)
+    while i < size:
+        run = 1
+        while i + run < size and run < _MAX_RUN and page[i + run] == page[i]:
+            run += 1
+        if run >= _MIN_RUN:
+            out.append(0x80 | (run - _MIN_RUN))
+            out.append(page[i])
+            i += run
+            literal = 0
+            continue
+        if literal == 0:
+            control = len(out)
+            out.append(0)
+        else:
+            out[control] += 1
+        out.append(page[i])
+        literal = (literal + 1) % _MAX_LITERAL
+        i += 1
+    return out
+
+
+def pack_chunks(chunks, page_size=1024) -> bytes:
+    """Pack ``chunks``, an iterable of ``(address, data)`` such as
+    :func:`bin_chunks` or :func:`hex_chunks`, into a packed image. A chunk
+    that starts in the last page of the previous one is merged into its
+    segment with any gap left 0xff, so no page is written twice. Segments
+    start on a ``page_size`` boundary."""
+    segments = []
+    for address, data in chunks:
+        if segments:
+            image = segments[-1][1]
+            offset = address - segments[-1][0]
+            if 0 <= offset and (
+                offset <= len(image) or offset < len(image) + -len(image) % page_size
+            ):
+                image.extend(b"\xff" * (offset - len(image)))
+                image[offset : offset + len(data)] = data
+                continue
+        head = address % page_size
+        segments.append([address - head, bytearray(b"\xff" * head) + data])
+
+    out = bytearray(MAGIC)
+    out += bytes((VERSION, 0)) + page_size.to_bytes(2, "little")
+    crc = 0xFFFFFFFF
+    for _, data in segments:
+        crc = crc32(data, crc)
+    out += crc.to_bytes(4, "little")
+
+    erased = b"\xff" * page_size
+    seen = {}
+    for address, data in segments:
+        out.append(TAG_SEGMENT)
+        out += address.to_bytes(4, "little") + len(data).to_bytes(4, "little")
+        for offset in range(0, len(data), page_size):
+            page = bytes(data[offset : offset + page_size])
+            if page == erased[: len(page)]:
+                out.append(TAG_ERASED)
+                continue
+            if page in seen:
+                out.append(TAG_COPY)
+                out += seen[page].to_bytes(4, "little")
+                continue
+            if len(page) == page_size:
+                seen[page] = len(out)
+            packed = _pack_page(page)
+            if len(packed) + 2 < len(page):
+                out.append(TAG_PACKED)
+                out += len(packed).to_bytes(2, "little") + packed
+            else:
+                out.append(TAG_RAW)
+                out += page
+    out.append(TAG_END)
+    return bytes(out)
+
+
+class _Reader:
+    """Unpacks the records of an open packed image into one page buffer."""
+
+    def __init__(self, file):
+        self.file = file
+        self._header = bytearray(12)
+        self._read(self._header)
+        if self._header[:4] != MAGIC or self._header[4] != VERSION:
+            raise ValueError("Not a packed image")
+        self.page_size = self._number(6, 2)
+        self.crc = self._number(8, 4)
+        self.page = bytearray(self.page_size)
+        self._packed = bytearray(self.page_size)
+        self._erased = memoryview(b"\xff" * self.page_size)
+
+    def _read(self, buf) -> None:
+        if self.file.readinto(buf) != len(buf):
+            raise ValueError("Packed image is truncated")
+
+    def _number(self, offset, size) -> int:
+        return int.from_bytes(self._header[offset : offset + size], "little")
+
+    def read_number(self, size) -> int:
+        """Read a little endian number of ``size`` bytes."""
+        view = memoryview(self._header)[:size]
+        self._read(view)
+        return int.from_bytes(view, "little")
+
+    def read_tag(self) -> int:
+        """Read the tag byte that starts a record."""
+        return self.read_number(1)
+
+    def unpack(self, tag, size) -> memoryview:
+        """Fill the page buffer from the record with ``tag`` and return its
+        first ``size`` bytes."""
+        page = memoryview(self.page)[:size]
+        if tag == TAG_ERASED:
+            page[:] = self._erased[:size]
+        elif tag == TAG_RAW:
+            self._read(page)
+        elif tag == TAG_PACKED:
+            packed = memoryview(self._packed)[: self.read_number(2)]
+            self._read(packed)
+            self._unpack_runs(packed, page)
+        elif tag == TAG_COPY:
+            offset = self.read_number(4)
+            resume = self.file.tell()
+            self.file.seek(offset)
+            source = self.read_tag()
+            if source not in (TAG_RAW, TAG_PACKED):
+                raise ValueError(f"Bad copy of offset {offset}")
+            self.unpack(source, size)
+            self.file.seek(resume)
+        else:
+            raise ValueError(f"Unknown record {tag}")
+        return page
+
+    @staticmethod
+    def _unpack_runs(packed, page) -> None:
+        i = 0
+        out = 0
+        while i < len(packed):
+            control = packed[i]
+            if control < 0x80:
+                count = control + 1
+                page[out : out + count] = packed[i + 1 : i + 1 + count]
+                i += 1 + count
+            else:
+                count = (control & 0x7F) + _MIN_RUN
+                page[out] = packed[i + 1]
+                # Double the run each copy instead of storing it byte by byte.
+                done = 1
+                while done < count:
+                    step = min(done, count - done)
+                    page[out + done : out + done + step] = page[out : out + step]
+                    done += step
+                i += 2
+            out += count
+        if out != len(page):
+            raise ValueError("Packed page has the wrong length")
+
+
+def packed_chunks(file, check_crc=True):
+    """Yield ``(address, data)`` for each page of the packed image in
+    ``file``. ``data`` is a view of one reused buffer so use it before
+    getting the next page. Raises ValueError at the end if the image doesn't
+    match its CRC, unless ``check_crc`` is False."""
+    reader = _Reader(file)
+    page_size = reader.page_size
+    crc = 0xFFFFFFFF
+    tag = reader.read_tag()
+    while tag != TAG_END:
+        if tag != TAG_SEGMENT:
+            raise ValueError(f"Expected a segment, found record {tag}")
+        address = reader.read_number(4)
+        end = address + reader.read_number(4)
+        while address < end:
+            size = min(page_size, end - address)
+            data = reader.unpack(reader.read_tag(), size)
+            if check_crc:
+                crc = crc32(data, crc)
+            yield address, data
+            address += size
+        tag = reader.read_tag()
+    if check_crc and crc != reader.crc:
+        raise ValueError("Packed image doesn't match its CRC")
+
+
+def write_packed_file(
+    target: DapTarget, file, verify_only=False, report_file=None, policy=None
+):
+    """Program (or verify) the packed image in ``file`` and return
+    ``target.report``. See :func:`write_chunks` for ``report_file`` and
+    ``policy``."""
+    return write_chunks(target, packed_chunks(file), verify_only, policy, report_file)
+
+
+def main(argv=None) -> int:
+    """Pack the image named on the command line and print how much it shrank."""
+    import argparse  # pylint: disable=import-outside-toplevel
+    from .hex_file import hex_chunks  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        description="Pack a .bin or .hex file for write_packed_file"
+    )
+    parser.add_argument("image", help=".bin or .hex file")
+    parser.add_argument("-o", "--output", required=True, help="packed image to write")
+    parser.add_argument(
+        "--addr", type=lambda x: int(x, 0), default=0, help=".bin load address"
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=1024,
+        help="unpacked page size, a multiple of the target's",
+    )
+    args = parser.parse_args(argv)
+
+    with open(args.image, "rb") as file:
+        if args.image.endswith(".hex"):
+            packed = pack_chunks(hex_chunks(file, args.page_size), args.page_size)
+        else:
+            packed = pack_chunks(
+                bin_chunks(file, args.addr, args.page_size), args.page_size
+            )
+    with open(args.output, "wb") as file:
+        file.write(packed)
+    size = 0
+    with open(args.output, "rb") as file:
+        for _, data in packed_chunks(file):
+            size += len(data)
+    print(f"{size} bytes packed into {len(packed)} ({100 * len(packed) / size:.0f}%)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
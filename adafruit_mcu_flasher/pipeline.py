@@ -0,0 +1,190 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.pipeline`
+================================================================================
+
+Pipelined programming for CPython hosts. A reader thread decodes the image
+into page aligned buffers, pads them and checks them for blank, the calling
+thread keeps the probe busy programming and reading back, and a verifier
+thread compares the read backs. Buffers come from a fixed pool so memory use
+is bounded by ``depth`` no matter how large the image is.
+
+.. code-block:: python
+
+    from adafruit_mcu_flasher.hex_file import hex_chunks
+    from adafruit_mcu_flasher.pipeline import FlashPipeline
+
+    with open("firmware.hex", "rb") as f:
+        ok = FlashPipeline(target).run(hex_chunks(f))
+
+This needs the ``threading`` and ``queue`` modules so it doesn't run on
+CircuitPython. Use :func:`write_bin_file` or :func:`write_hex_file` there.
+"""
+
+import queue
+import threading
+import time
+
+from .bin_file import bin_chunks
+from .hex_file import hex_chunks
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+_DONE = None
+
+
+class _Block:
+    """A pooled image buffer and its read back buffer."""
+
+    def __init__(self, bufsize):
+        self.data = bytearray(bufsize)
+        self.readback = bytearray(bufsize)
+        self.address = 0
+        self.size = 0
+        self.blank = False
+
+
+class FlashPipeline:
+    """Programs ``target`` from an iterator of ``(address, data)`` chunks such
+    as :func:`bin_chunks` or :func:`hex_chunks`. ``bufsize`` is the largest
+    chunk, ``depth`` the number of blocks in flight and ``verify`` enables the
+    read back stage."""
+
+    def __init__(self, target, bufsize=1024, depth=4, verify=True):
+        self.target = target
+        self.bufsize = bufsize
+        self.verify = verify
+        self._erased = b"\xff" * bufsize
+        self._blocks = [_Block(bufsize) for _ in range(depth)]
+        self.failed_address = None
+        self.bytes_written = 0
+        self.duration = 0.0
+
+    def _read(self, chunks, free, ready, stop):
+        try:
+            for address, data in chunks:
+                size = len(data)
+                if size > self.bufsize:
+                    raise ValueError("Chunk at 0x%08x is larger than bufsize" % address)
+                block = free.get()
+                if stop.is_set():
+                    break
+                block.address = address
+                block.data[:size] = data
+                # Pad the tail to a word so it can be read back with block reads.
+                padded = (size + 3) & ~3
+                block.data[size:padded] = self._erased[size:padded]
+                block.size = padded
+                block.blank = block.data[:padded] == self._erased[:padded]
+                ready.put(block)
+            ready.put(_DONE)
+        except Exception as error:  # pylint: disable=broad-except
+            ready.put(error)
+
+    def _check(self, checks, free, stop):
+        while True:
+            block = checks.get()
+            if block is _DONE:
+                return
+            size = block.size
+            if (
+                self.failed_address is None
+                and block.readback[:size] != block.data[:size]
+            ):
+                self.failed_address = block.address
+                stop.set()
+            free.put(block)
+
+    def run(self, chunks, verify_only=False) -> bool:
+        """Program (or with ``verify_only`` just verify) every chunk. Returns
+        False and sets :attr:`failed_address` when a block fails."""
+        self.failed_address = None
+        self.bytes_written = 0
+        report = self.target.report
+        start = time.monotonic()
+        free = queue.Queue()
+        for block in self._blocks:
+            free.put(block)
+        ready = queue.Queue(len(self._blocks))
+        checks = queue.Queue()
+        stop = threading.Event()
+        verify = self.verify or verify_only
+        if verify:
+            report.verify_method = "full"
+        reader = threading.Thread(target=self._read, args=(chunks, free, ready, stop))
+        checker = threading.Thread(target=self._check, args=(checks, free, stop))
+        reader.start()
+        checker.start()
+        target = self.target
+        error = None
+        try:
+            while not stop.is_set():
+                block = ready.get()
+                if block is _DONE:
+                    break
+                if isinstance(block, Exception):
+                    error = block
+                    break
+                if block.blank:
+                    if not verify_only:
+                        report.pages_skipped += 1
+                    free.put(block)
+                    continue
+                data = memoryview(block.data)[: block.size]
+                if not verify_only:
+                    if not target.program_flash(block.address, data, do_verify=False):
+                        self.failed_address = block.address
+                        free.put(block)
+                        break
+                    self.bytes_written += block.size
+                if verify:
+                    read_start = report.ticks()
+                    target.read_block_into(
+                        block.address, memoryview(block.readback)[: block.size]
+                    )
+                    report.add_verify(read_start, block.size)
+                    checks.put(block)
+                else:
+                    free.put(block)
+        finally:
+            stop.set()
+            checks.put(_DONE)
+            checker.join()
+            # Unblock the reader if it is waiting for a buffer or a slot.
+            while reader.is_alive():
+                free.put(self._blocks[0])
+                try:
+                    ready.get_nowait()
+                except queue.Empty:
+                    pass
+                reader.join(0.01)
+            self.duration = time.monotonic() - start
+            phase = "verify" if verify_only else "program"
+            report.phases[phase] = report.phases.get(phase, 0) + self.duration
+        if error is not None:
+            report.fail(str(error))
+            raise error
+        if self.failed_address is not None:
+            report.fail(f"Failed writing at 0x{self.failed_address:08x}")
+        elif report.ok is None:
+            report.ok = True
+        return self.failed_address is None
+
+
+def write_bin_file_pipelined(
+    target, file, addr, bufsize=1024, verify_only=False, depth=4
+):
+    """Pipelined version of :func:`write_bin_file`. Returns ``target.report``."""
+    FlashPipeline(target, bufsize, depth).run(
+        bin_chunks(file, addr, bufsize), verify_only
+    )
+    return target.report
+
+
+def write_hex_file_pipelined(target, file, verify_only=False, bufsize=1024, depth=4):
+    """Pipelined version of :func:`write_hex_file`. Returns ``target.report``."""
+    FlashPipeline(target, bufsize, depth).run(hex_chunks(file, bufsize), verify_only)
+    return target.report
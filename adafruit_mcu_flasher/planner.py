@@ -0,0 +1,581 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.planner`
+================================================================================
+
+Plan a flashing run before there is hardware to run it on. A
+:class:`FlashPlan` turns an image into the exact list of erases, page writes,
+blank skips and verifies that :class:`SAM`, :class:`SAMx5` or :class:`NRF`
+would do for a given :class:`FlashGeometry`. :meth:`FlashPlan.estimate`
+replays it on the matching simulator from :mod:`mcu_flasher_tools` to count
+probe calls and SWD transfers and models the time for a
+:class:`LatencyProfile`. The same plan then
+programs a real board with :meth:`FlashPlan.run`. :meth:`FlashPlan.patch`
+makes per board copies with serial numbers or calibration data patched in.
+
+.. code-block:: python
+
+    from adafruit_mcu_flasher.hex_file import hex_chunks
+    from adafruit_mcu_flasher.planner import FlashPlan
+
+    with open("firmware.hex", "rb") as f:
+        plan = FlashPlan(SAM, target.geometry, hex_chunks(f))
+    plan.estimate("bitbang").report()
+    plan.run(target)
+
+This runs on CPython:
+
+.. code-block:: shell
+
+    python -m adafruit_mcu_flasher.planner firmware.hex --target samd21 --profile bitbang
+"""
+
+from . import FlashGeometry, crc32
+from .verify import VERIFY_FULL, VerifyPolicy
+from .nrf5x import NRF
+from .sam import SAM
+from .samx5 import SAMx5
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+OP_ERASE_CHIP = "erase_chip"
+OP_ERASE = "erase"
+OP_START = "start"
+OP_WRITE = "write"
+OP_SKIP = "skip"
+OP_VERIFY = "verify"
+OP_END = "end"
+OP_CRC = "crc"
+
+OPS = (OP_ERASE_CHIP, OP_ERASE, OP_START, OP_WRITE, OP_SKIP, OP_VERIFY, OP_END, OP_CRC)
+
+# Report phase for each operation. Chip erase times itself.
+_PHASES = {
+    OP_ERASE_CHIP: None,
+    OP_ERASE: "erase",
+    OP_START: "program",
+    OP_WRITE: "program",
+    OP_SKIP: "program",
+    OP_VERIFY: "program",
+    OP_END: "program",
+    OP_CRC: "verify",
+}
+
+# Simulator in mcu_flasher_tools.sim used to cost each family.
+_SIMULATORS = {
+    SAM: "SimSAMD21",
+    SAMx5: "SimSAMD51",
+    NRF: "SimNRF52",
+}
+
+# Rough datasheet flash timings per family: seconds per byte written,
+# seconds per byte erased and seconds for a chip erase. The simulators finish
+# flash operations after a couple of status polls so these are added on top.
+FLASH_TIMES = {
+    SAM: (2.5e-3 / 64, 6e-3 / 256, 0.24),
+    SAMx5: (2.5e-3 / 512, 20e-3 / 8192, 0.5),
+    NRF: (41e-6 / 4, 85e-3 / 4096, 0.17),
+}
+
+# name: (target class, geometry) for the command line.
+TARGETS = {
+    "samd21": (SAM, FlashGeometry(256 * 1024, 64, 256, 16)),
+    "samd51": (SAMx5, FlashGeometry(1024 * 1024, 512, 8192, 32)),
+    "nrf52": (NRF, FlashGeometry(1024 * 1024, 4096, 4096)),
+}
+
+
+def _multmodp(left, right) -> int:
+    # Multiply two reflected CRC32 polynomials modulo the CRC polynomial.
+    bit = 1 << 31
+    product = 0
+    while True:
+        if left & bit:
+            product ^= right
+            if left & (bit - 1) == 0:
+                return product
+        bit >>= 1
+        right = (right >> 1) ^ 0xEDB88320 if right & 1 else right >> 1
+
+
+def _crc32_zeros(crc, count) -> int:
+    """Return ``crc32(bytes(count), crc)`` in O(log count) steps."""
+    power = 1 << 30  # x^1
+    count *= 8
+    shift = 1 << 31  # x^0
+    while count:
+        if count & 1:
+            shift = _multmodp(power, shift)
+        power = _multmodp(power, power)
+        count >>= 1
+    return _multmodp(shift, crc)
+
+
+class _OverlayOps:
+    """The ops of a patched plan: the base plan's with some replaced."""
+
+    def __init__(self, base, overlay):
+        self.base = base
+        # base index: replacement ops
+        self.overlay = overlay
+
+    def __iter__(self):
+        overlay = self.overlay
+        for index, flash_op in enumerate(self.base):
+            if index in overlay:
+                yield from overlay[index]
+            else:
+                yield flash_op
+
+
+class FlashOp:
+    """One step of a :class:`FlashPlan`. ``kind`` is one of :data:`OPS` and
+    ``address`` and ``size`` the flash range it covers. Writes and verifies
+    carry their ``data`` and CRC checks the expected ``crc``."""
+
+    def __init__(self, kind, address=0, size=0, data=None, crc=None):
+        # pylint: disable=too-many-arguments
+        self.kind = kind
+        self.address = address
+        self.size = size
+        self.data = data
+        self.crc = crc
+
+    def __repr__(self):
+        return "FlashOp(%s, 0x%08x, %d)" % (self.kind, self.address, self.size)
+
+
+class FlashPlan:
+    """Plans programming ``chunks``, an iterable of ``(address, data)`` such
+    as :func:`bin_chunks`, :func:`hex_chunks` or the items of a dict, into a
+    ``target_class`` part with ``geometry``. The data is copied so reused
+    buffers are fine.
+
+    ``erase`` is ``"chip"`` to erase everything first, ``"range"`` to erase
+    only the blocks the image touches or None to not erase. ``policy`` is the
+    :class:`VerifyPolicy`, full by default."""
+
+    def __init__(self, target_class, geometry, chunks, erase="chip", policy=None):
+        # pylint: disable=too-many-arguments
+        if erase not in (None, "chip", "range"):
+            raise ValueError(f"Unknown erase mode {erase}")
+        if erase == "range" and not hasattr(target_class, "erase_range"):
+            raise ValueError(f"{target_class.__name__} can only erase the whole chip")
+        self.target_class = target_class
+        self.geometry = geometry
+        self.erase = erase
+        self.policy = policy or VERIFY_FULL
+        # Let the driver pick its program unit so the plan matches a real run.
+        target = target_class(None)
+        target.set_geometry(geometry)
+        self.unit = target.page_size
+        self.write_align = target.write_align
+        self.ops = []
+        self._plan(self._load(chunks))
+        self._base_ops = self.ops
+        self._overlay = {}
+        self._index = None
+
+    def _load(self, chunks) -> dict:
+        # unit address: [unit data, bytes used]
+        units = {}
+        unit_size = self.unit
+        for address, data in chunks:
+            self.geometry.check_range(address, len(data))
+            offset = 0
+            while offset < len(data):
+                unit_address = address + offset
+                start = unit_address % unit_size
+                unit_address -= start
+                count = min(len(data) - offset, unit_size - start)
+                unit = units.get(unit_address)
+                if unit is None:
+                    unit = units[unit_address] = [bytearray(b"\xff" * unit_size), 0]
+                unit[0][start : start + count] = data[offset : offset + count]
+                unit[1] = max(unit[1], start + count)
+                offset += count
+        return units
+
+    def _plan(self, units):
+        # pylint: disable=too-many-locals
+        ops = self.ops
+        geometry = self.geometry
+        align = self.write_align
+        if self.erase == "chip":
+            ops.append(FlashOp(OP_ERASE_CHIP, geometry.start, geometry.flash_size))
+        elif self.erase == "range":
+            erase_size = geometry.erase_size
+            blocks = set()
+            for address, (_, used) in units.items():
+                block = address - address % erase_size
+                while block < address + used:
+                    blocks.add(block)
+                    block += erase_size
+            for block in sorted(blocks):
+                ops.append(FlashOp(OP_ERASE, block, erase_size))
+
+        ops.append(FlashOp(OP_START))
+        policy = self.policy
+        policy.restart()
+        runs = []
+        erased = b"\xff" * self.unit
+        for address in sorted(units):
+            data, used = units[address]
+            data = bytes(data[: -(-used // align) * align])
+            if runs and runs[-1][1] == address:
+                runs[-1][1] += len(data)
+                runs[-1][2] = crc32(data, runs[-1][2])
+            else:
+                runs.append([address, address + len(data), crc32(data)])
+            if data == erased[: len(data)]:
+                ops.append(FlashOp(OP_SKIP, address, len(data)))
+                continue
+            ops.append(FlashOp(OP_WRITE, address, len(data), data))
+            if policy.check_page():
+                ops.append(FlashOp(OP_VERIFY, address, len(data), data))
+        ops.append(FlashOp(OP_END))
+
+        if policy.mode == "crc":
+            for start, end, crc in runs:
+                # Runs are at least word aligned because pages are.
+                ops.append(FlashOp(OP_CRC, start, end - start, crc=crc))
+
+    def _unit_index(self):
+        # unit address: (write or skip index, verify index), plus the CRC op
+        # indexes. Built once and shared with patched copies.
+        if self._index is None:
+            units = {}
+            crcs = []
+            for index, flash_op in enumerate(self._base_ops):
+                if flash_op.kind in (OP_WRITE, OP_SKIP):
+                    units[flash_op.address] = [index, None]
+                elif flash_op.kind == OP_VERIFY:
+                    units[flash_op.address][1] = index
+                elif flash_op.kind == OP_CRC:
+                    crcs.append(index)
+            self._index = (units, crcs)
+        return self._index
+
+    def _current(self, overlay, index) -> FlashOp:
+        # The op at base ``index`` once ``overlay`` is applied.
+        if index in overlay:
+            return overlay[index][0]
+        return self._base_ops[index]
+
+    def patch(self, patches):
+        """Return a copy of the plan with ``patches``, an iterable of
+        ``(address, data)``, written over the image. Only the pages they
+        touch are copied and the CRC checks are updated from the changed
+        bytes, so the cost doesn't depend on the size of the image. Patched
+        pages that were blank are written and, unless the policy is none or
+        crc, read back. Raises ValueError for data outside of the image."""
+        # pylint: disable=too-many-locals
+        units, crcs = self._unit_index()
+        overlay = dict(self._overlay)
+        unit_size = self.unit
+        verify = self.policy.mode not in ("none", "crc")
+        for address, data in patches:
+            offset = 0
+            while offset < len(data):
+                unit_address = address + offset
+                start = unit_address % unit_size
+                unit_address -= start
+                entry = units.get(unit_address)
+                flash_op = (
+                    self._current(overlay, entry[0]) if entry is not None else None
+                )
+                count = min(len(data) - offset, unit_size - start)
+                if flash_op is None or start + count > flash_op.size:
+                    raise ValueError(
+                        f"0x{address + offset:08x} is outside of the image"
+                    )
+                old = (
+                    flash_op.data
+                    if flash_op.kind == OP_WRITE
+                    else b"\xff" * flash_op.size
+                )
+                new = bytearray(old)
+                new[start : start + count] = data[offset : offset + count]
+                new = bytes(new)
+
+                # The CRC is affine in the data: xor in the CRC of the change.
+                delta = bytes(
+                    a ^ b for a, b in zip(old[start : start + count], new[start:])
+                )
+                for index in crcs:
+                    run = self._current(overlay, index)
+                    if run.address <= unit_address < run.address + run.size:
+                        tail = run.address + run.size - (unit_address + start + count)
+                        crc = run.crc ^ _crc32_zeros(crc32(delta, 0), tail)
+                        overlay[index] = [
+                            FlashOp(OP_CRC, run.address, run.size, crc=crc)
+                        ]
+
+                write_index, verify_index = entry
+                ops = [FlashOp(OP_WRITE, unit_address, flash_op.size, new)]
+                check = FlashOp(OP_VERIFY, unit_address, flash_op.size, new)
+                if verify_index is not None:
+                    overlay[verify_index] = [check]
+                elif verify and self._base_ops[write_index].kind == OP_SKIP:
+                    ops.append(check)
+                overlay[write_index] = ops
+                offset += count
+        plan = FlashPlan.__new__(FlashPlan)
+        plan.__dict__.update(
+            self.__dict__, _overlay=overlay, ops=_OverlayOps(self._base_ops, overlay)
+        )
+        return plan
+
+    def counts(self) -> dict:
+        """Return the number of operations of each kind."""
+        counts = {}
+        for flash_op in self.ops:
+            counts[flash_op.kind] = counts.get(flash_op.kind, 0) + 1
+        return counts
+
+    def run(self, target, report_file=None, progress=None):
+        """Carry out the plan on the selected ``target`` and return
+        ``target.report``, which is also appended to ``report_file`` when
+        given. ``progress`` is called with each :class:`FlashOp` once it is
+        done. Stops at the first failure."""
+        if not isinstance(target, self.target_class):
+            raise ValueError(f"Plan is for {self.target_class.__name__} targets")
+        report = target.report
+        target.verify_policy(True, self.policy)
+        ops = list(self.ops)
+        index = 0
+        while index < len(ops) and report.ok is None:
+            phase = _PHASES[ops[index].kind]
+            end = index
+            while end < len(ops) and _PHASES[ops[end].kind] == phase:
+                end += 1
+            if phase is None:
+                self._execute(target, ops[index:end], progress)
+            else:
+                with report.phase(phase):
+                    self._execute(target, ops[index:end], progress)
+            index = end
+        if report.ok is None:
+            report.ok = True
+        if report_file is not None:
+            report.write(report_file)
+        return report
+
+    def steps(self, target):
+        """Carry out the plan on the selected ``target`` as steps for
+        :meth:`DapTarget.run_steps` or a :class:`FlashScheduler`. Erases and
+        page writes yield while the flash is busy."""
+        if not isinstance(target, self.target_class):
+            raise ValueError(f"Plan is for {self.target_class.__name__} targets")
+        report = target.report
+        target.verify_policy(True, self.policy)
+        for flash_op in self.ops:
+            if flash_op.kind == OP_ERASE_CHIP:
+                yield from target.erase_steps()
+            elif flash_op.kind == OP_WRITE:
+                start = report.ticks()
+                yield from target.program_steps(flash_op.address, flash_op.data)
+                report.add_program(start, flash_op.size)
+            else:
+                self._execute(target, (flash_op,), None)
+            if report.ok is False:
+                return
+        report.ok = True
+
+    def _execute(self, target, ops, progress):
+        # pylint: disable=too-many-branches
+        report = target.report
+        for flash_op in ops:
+            kind = flash_op.kind
+            address = flash_op.address
+            if kind == OP_ERASE_CHIP:
+                target.erase()
+            elif kind == OP_ERASE:
+                if target.erase_range(address, flash_op.size) is False:
+                    report.fail(f"Failed erasing at 0x{address:08x}")
+            elif kind == OP_START:
+                target.program_start()
+                target.page_buffers(self.unit)
+                target.program_begin()
+            elif kind == OP_WRITE:
+                if target.program_page(address, flash_op.data) is False:
+                    report.fail(f"Failed writing at 0x{address:08x}")
+            elif kind == OP_SKIP:
+                report.pages_skipped += 1
+            elif kind == OP_VERIFY:
+                if not target.verify_block(address, flash_op.data):
+                    report.fail(f"Failed writing at 0x{address:08x}")
+            elif kind == OP_END:
+                target.program_end()
+            elif kind == OP_CRC:
+                if target.crc32(address, flash_op.size) != flash_op.crc:
+                    report.fail(f"CRC mismatch at 0x{address:08x}")
+            if progress is not None:
+                progress(flash_op)
+            if report.ok is False:
+                return
+
+    def estimate(self, profile="cmsis-dap", flash_times=None):
+        """Run the plan on the family's simulator and return a
+        :class:`PlanEstimate` for ``profile``, a :class:`LatencyProfile` or
+        the name of one. ``flash_times`` overrides :data:`FLASH_TIMES`. This
+        needs :mod:`mcu_flasher_tools` and only runs on CPython."""
+        # pylint: disable=too-many-locals
+        # pylint: disable=import-outside-toplevel
+        import contextlib
+        import io
+
+        from mcu_flasher_tools import sim
+        from mcu_flasher_tools.benchmark import PROFILES
+        from mcu_flasher_tools.trace import ProbeStats, TraceProbe
+
+        if isinstance(profile, str):
+            profile = PROFILES[profile]
+        if flash_times is None:
+            flash_times = FLASH_TIMES[self.target_class]
+        model_class = getattr(sim, _SIMULATORS[self.target_class])
+        model = model_class(flash_kib=-(-self.geometry.end // 1024))
+        probe = TraceProbe(model.probe)
+        target = self.target_class(probe)
+        estimate = PlanEstimate(profile, flash_times, ProbeStats)
+
+        def progress(flash_op):
+            estimate.add(flash_op, probe.stats)
+            probe.stats = ProbeStats()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            probe.connect()
+            target.target_connect()
+            target.select()
+            target.set_geometry(self.geometry)
+            probe.stats.reset()
+            report = self.run(target, progress=progress)
+        if not report.ok:
+            raise RuntimeError(f"Plan failed on the simulator: {report.error}")
+        return estimate
+
+
+class PlanEstimate:
+    """Modeled cost of a :class:`FlashPlan`. ``stats`` holds a
+    :class:`ProbeStats` and ``counts`` the number of operations for each kind
+    of operation. ``flash_seconds`` is the modeled time the flash is busy.
+    ``stats_class`` makes the totals."""
+
+    def __init__(self, profile, flash_times, stats_class):
+        self.profile = profile
+        self.flash_times = flash_times
+        self.stats_class = stats_class
+        self.counts = {}
+        self.stats = {}
+        self.flash_seconds = {}
+
+    def add(self, flash_op, stats):
+        """Add a completed operation and the probe traffic it took."""
+        kind = flash_op.kind
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        total = self.stats.get(kind)
+        if total is None:
+            total = self.stats[kind] = self.stats_class()
+        total.calls += stats.calls
+        total.transfers += stats.transfers
+        total.wire_bits += stats.wire_bits
+        write, erase, chip_erase = self.flash_times
+        busy = 0.0
+        if kind == OP_WRITE:
+            busy = write * flash_op.size
+        elif kind == OP_ERASE:
+            busy = erase * flash_op.size
+        elif kind == OP_ERASE_CHIP:
+            busy = chip_erase
+        self.flash_seconds[kind] = self.flash_seconds.get(kind, 0.0) + busy
+
+    def seconds(self, kind=None) -> float:
+        """Modeled wall time of ``kind`` operations or of the whole plan."""
+        kinds = self.stats if kind is None else (kind,)
+        return sum(
+            self.profile.seconds(self.stats[k]) + self.flash_seconds[k]
+            for k in kinds
+            if k in self.stats
+        )
+
+    @property
+    def calls(self) -> int:
+        """Probe calls over all operations."""
+        return sum(stats.calls for stats in self.stats.values())
+
+    @property
+    def transfers(self) -> int:
+        """SWD transfers over all operations."""
+        return sum(stats.transfers for stats in self.stats.values())
+
+    def report(self):
+        """Print a table of the cost of each kind of operation."""
+        header = "%-12s %6s %8s %9s %10s %9s"
+        row = "%-12s %6s %8d %9d %10.3f %9.3f"
+        print(
+            header % ("operation", "count", "calls", "transfers", "flash s", "total s")
+        )
+        for kind in OPS:
+            if kind not in self.stats:
+                continue
+            stats = self.stats[kind]
+            count = self.counts[kind]
+            flash = self.flash_seconds[kind]
+            total = self.seconds(kind)
+            print(row % (kind, count, stats.calls, stats.transfers, flash, total))
+        flash = sum(self.flash_seconds.values())
+        print(row % ("total", "", self.calls, self.transfers, flash, self.seconds()))
+
+
+def main(argv=None) -> int:
+    """Plan the image named on the command line and print its estimate."""
+    # pylint: disable=import-outside-toplevel
+    import argparse
+
+    from mcu_flasher_tools.benchmark import PROFILES, LatencyProfile
+
+    from .bin_file import bin_chunks
+    from .hex_file import hex_chunks
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("image", help=".bin or .hex file")
+    parser.add_argument("--target", choices=list(TARGETS), default="samd21")
+    parser.add_argument(
+        "--addr", type=lambda x: int(x, 0), default=0, help=".bin load address"
+    )
+    parser.add_argument("--erase", choices=("chip", "range", "none"), default="chip")
+    parser.add_argument("--verify", choices=VerifyPolicy.MODES, default="full")
+    parser.add_argument(
+        "--coverage", type=int, default=100, help="percent of pages sampled"
+    )
+    parser.add_argument("--profile", choices=list(PROFILES), default="cmsis-dap")
+    parser.add_argument(
+        "--clock", type=int, help="SWD clock in Hz instead of the profile's"
+    )
+    args = parser.parse_args(argv)
+
+    target_class, geometry = TARGETS[args.target]
+    with open(args.image, "rb") as file:
+        if args.image.endswith(".hex"):
+            chunks = hex_chunks(file)
+        else:
+            chunks = bin_chunks(file, args.addr)
+        plan = FlashPlan(
+            target_class,
+            geometry,
+            chunks,
+            None if args.erase == "none" else args.erase,
+            VerifyPolicy(args.verify, args.coverage),
+        )
+    profile = PROFILES[args.profile]
+    if args.clock:
+        profile = LatencyProfile(profile.name, args.clock, profile.call_overhead)
+    plan.estimate(profile).report()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.pyocd_probe`
+================================================================================
+
+Use a pyOCD ``DebugProbe`` with the targets in this library. The targets
+drive the wire the way a bit banged probe does: every AP read is posted and
+its value comes back with the next AP read or from RDBUFF. pyOCD probes
+return the value of each read instead. :class:`PyocdProbe` keeps one posted
+read outstanding to bridge the two.
+
+Transfers are queued with ``now=False`` so a CMSIS-DAP probe packs them into
+as few USB packets as it can. The queue is flushed at sync points: when a read
+value is needed and before pin, clock, reset and line sequence changes.
+
+.. code-block:: python
+
+    from pyocd.core.helpers import ConnectHelper
+    from adafruit_mcu_flasher import nrf5x
+    from adafruit_mcu_flasher.pyocd_probe import PyocdProbe
+
+    probe = ConnectHelper.choose_probe()
+    probe.open()
+    target = nrf5x.NRF(PyocdProbe(probe))
+
+This runs on CPython only. pyOCD itself is only needed to create the probe.
+"""
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+_DP_RDBUFF = 0x0C
+
+
+class _PinGroup:
+    PROTOCOL_PINS = 0
+
+
+def _result(value) -> int:
+    # Deferred reads are callables that flush the queue when called.
+    if value is None:
+        return 0
+    if callable(value):
+        return value()
+    return value
+
+
+class PyocdProbe:
+    """Adapts the opened pyOCD ``DebugProbe`` ``probe`` to the probe calls
+    made by :class:`DapTarget`."""
+
+    def __init__(self, probe):
+        self.probe = probe
+        self.PinGroup = getattr(
+            probe, "PinGroup", _PinGroup
+        )  # pylint: disable=invalid-name
+        # The read a real SWD link would have posted, as a deferred result.
+        self._posted = None
+
+    def flush(self) -> None:
+        """Send everything queued and raise any transfer error."""
+        self.probe.flush()
+
+    def connect(self, protocol=None):
+        self.probe.connect(protocol)
+
+    def disconnect(self):
+        self.flush()
+        self._posted = None
+        self.probe.disconnect()
+
+    def reset(self):
+        self.flush()
+        self.probe.reset()
+
+    def set_clock(self, frequency):
+        self.flush()
+        self.probe.set_clock(frequency)
+
+    def swj_sequence(self, length, bits):
+        self.flush()
+        self._posted = None
+        self.probe.swj_sequence(length, bits)
+
+    def swd_sequence(self, sequences) -> list:
+        """Send raw SWD ``sequences`` and return the bits of the ones that
+        read, as :mod:`adafruit_mcu_flasher.multidrop` needs for TARGETSEL."""
+        self.flush()
+        self._posted = None
+        _, results = self.probe.swd_sequence(sequences)
+        return [int.from_bytes(data, "little") for data in results]
+
+    def write_pins(self, group, mask, value):
+        self.flush()
+        self.probe.write_pins(group, mask, value)
+
+    def read_dp(self, addr) -> int:
+        if addr == _DP_RDBUFF and self._posted is not None:
+            # The result of the last posted AP read.
+            value = _result(self._posted)
+            self._posted = None
+            return value
+        return self.probe.read_dp(addr)
+
+    def write_dp(self, addr, value):
+        self.probe.write_dp(addr, value)
+
+    def read_ap(self, addr) -> int:
+        posted = self._posted
+        self._posted = self.probe.read_ap(addr, now=False)
+        return _result(posted)
+
+    def write_ap(self, addr, value):
+        self.probe.write_ap(addr, value)
+
+    def read_ap_multiple(self, addr, count=1) -> list:
+        # Queue the block before resolving the posted read so both come
+        # back with one flush.
+        deferred = self.probe.read_ap_multiple(addr, count, now=False)
+        posted = _result(self._posted)
+        values = deferred()
+        # Keep the last read posted and shift in the one posted before.
+        self._posted = values[-1]
+        return [posted] + list(values[:-1])
+
+    def write_ap_multiple(self, addr, values):
+        self.probe.write_ap_multiple(addr, list(values))
@@ -0,0 +1,189 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.report`
+================================================================================
+
+Per board flashing reports. Loaded with the first target.
+"""
+
+import time
+
+try:
+    from supervisor import ticks_ms as _ticks
+
+    _TICKS_PER_SECOND = 1000
+    # ticks_ms() wraps so it stays a small int that doesn't allocate.
+    _TICKS_MASK = (1 << 29) - 1
+except ImportError:
+
+    def _ticks():
+        return time.monotonic_ns() // 1000
+
+    _TICKS_PER_SECOND = 1000000
+    _TICKS_MASK = (1 << 64) - 1
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+
+class FlashReport:
+    """What happened to one board, filled in as it is flashed. Every target
+    keeps its current report in ``target.report``, the writers return it and
+    :meth:`write` appends it to a JSON lines file.
+
+    Times are in seconds. ``phases`` holds the time spent in each named
+    phase (connect, select, erase, program, verify), ``program_time`` and
+    ``verify_time`` only the time spent moving page data and ``poll_time``
+    the time spent waiting on status registers. ``heap`` is the target's
+    :class:`HeapMonitor`, if it has one.
+
+    The per page times are kept in integer ticks, milliseconds from
+    ``supervisor.ticks_ms()`` on CircuitPython, so adding to them doesn't
+    allocate a float for every page.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    TICKS_PER_SECOND = _TICKS_PER_SECOND
+
+    def __init__(self):
+        self.timestamp = time.time()
+        self.family = None
+        self.device_id = None
+        self.device_name = None
+        self.locked = None
+        self.fuse_changes = []
+        self.bytes_programmed = 0
+        self.pages_programmed = 0
+        self.pages_skipped = 0
+        self.bytes_verified = 0
+        self.verify_method = None
+        self.erase_skipped = False
+        self.phases = {}
+        self.program_ticks = 0
+        self.verify_ticks = 0
+        self.poll_ticks = 0
+        self.ok = None
+        self.error = None
+        self.heap = None
+        self._phase = None
+        self._phase_start = 0
+
+    def phase(self, name):
+        """Time a phase with ``with report.phase("erase"):``. Phases don't
+        nest and repeated phases add up."""
+        self._phase = name
+        return self
+
+    def __enter__(self):
+        if self.heap is not None:
+            self.heap.phase_start(self._phase)
+        self._phase_start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.monotonic() - self._phase_start
+        if self.heap is not None:
+            self.heap.phase_end()
+        self.phases[self._phase] = self.phases.get(self._phase, 0) + elapsed
+        if exc_value is not None:
+            self.ok = False
+            self.error = f"{self._phase}: {exc_value}"
+
+    def fuse_change(self, name, old, new):
+        """Record that fuse ``name`` was changed from ``old`` to ``new``."""
+        self.fuse_changes.append((name, old, new))
+
+    def fail(self, message):
+        self.ok = False
+        self.error = message
+
+    @staticmethod
+    def ticks() -> int:
+        """Return the current time in ticks, to pass to :meth:`since`."""
+        return _ticks()
+
+    @staticmethod
+    def since(start) -> int:
+        """Return the ticks from ``start`` to now."""
+        return (_ticks() - start) & _TICKS_MASK
+
+    def add_program(self, start, size, pages=1) -> None:
+        """Add ``pages`` written from tick ``start`` until now, ``size``
+        bytes in all."""
+        self.program_ticks += (_ticks() - start) & _TICKS_MASK
+        self.bytes_programmed += size
+        self.pages_programmed += pages
+
+    def add_verify(self, start, size) -> None:
+        """Add ``size`` bytes read back for verification from tick ``start``
+        until now."""
+        self.verify_ticks += (_ticks() - start) & _TICKS_MASK
+        self.bytes_verified += size
+
+    @property
+    def program_time(self) -> float:
+        """Seconds spent writing pages."""
+        return self.program_ticks / _TICKS_PER_SECOND
+
+    @property
+    def verify_time(self) -> float:
+        """Seconds spent reading pages back."""
+        return self.verify_ticks / _TICKS_PER_SECOND
+
+    @property
+    def poll_time(self) -> float:
+        """Seconds spent waiting on status registers."""
+        return self.poll_ticks / _TICKS_PER_SECOND
+
+    @property
+    def program_rate(self) -> float:
+        """Programmed bytes per second."""
+        return self.bytes_programmed / self.program_time if self.program_time else 0.0
+
+    @property
+    def verify_rate(self) -> float:
+        """Verified bytes per second."""
+        return self.bytes_verified / self.verify_time if self.verify_time else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "timestamp": self.timestamp,
+            "family": self.family,
+            "device_id": self.device_id,
+            "device_name": self.device_name,
+            "locked": self.locked,
+            "fuse_changes": [
+                {"name": name, "old": old, "new": new}
+                for name, old, new in self.fuse_changes
+            ],
+            "bytes_programmed": self.bytes_programmed,
+            "pages_programmed": self.pages_programmed,
+            "pages_skipped": self.pages_skipped,
+            "bytes_verified": self.bytes_verified,
+            "verify_method": self.verify_method,
+            "erase_skipped": self.erase_skipped,
+            "phases": self.phases,
+            "program_time": self.program_time,
+            "verify_time": self.verify_time,
+            "poll_time": self.poll_time,
+            "program_rate": self.program_rate,
+            "verify_rate": self.verify_rate,
+            "ok": self.ok,
+            "error": self.error,
+            "heap": None if self.heap is None else self.heap.as_dict(),
+        }
+
+    def write(self, file) -> None:
+        """Append the report to ``file`` as one JSON line. ``file`` is an open
+        text file or a path."""
+        if isinstance(file, str):
+            with open(file, "a") as f:
+                self.write(f)
+            return
+        import json  # pylint: disable=import-outside-toplevel
+
+        file.write(json.dumps(self.as_dict()))
+        file.write("\n")
@@ -4,7 +4,7 @@
 """
 """
 
-from . import DapTarget
+from . import DapTarget, FlashGeometry, crc32, find_device, parse_devices
 from micropython import const
 
 IS_CIRCUITPYTHON = False
@@ -37,6 +37,32 @@ _DAP_DSU_STATUSA_DONE    = const(0x00000100)
 _DAP_DSU_STATUSA_CRSTEXT = const(0x00000200)
 _DAP_DSU_STATUSA_BERR    = const(0x00000400)
 
+_DHCSR_S_HALT            = const(0x00020000)
+
+# Seconds to hold nRESET low and to wait for a chip erase.
+_RESET_PULSE             = 0.01
+_CHIP_ERASE_TIMEOUT      = 30
+
+# DSU CRC32 of all 0xff by length, computed when first needed.
+_erased_crcs = {}
+
+
+def erased_crc32(length) -> int:
+    """Return the DSU CRC32 (seeded with 0xffffffff and not inverted) of
+    ``length`` bytes of 0xff."""
+    if length in _erased_crcs:
+        return _erased_crcs[length]
+    block = b"\xff" * min(length, 1024)
+    crc = 0xffffffff
+    remaining = length
+    while remaining:
+        data = block if remaining >= len(block) else block[:remaining]
+        crc = crc32(data, crc)
+        remaining -= len(data)
+    _erased_crcs[length] = crc
+    return crc
+
+
 _NVMCTRL_CTRLA           = const(0x41004000)
 _NVMCTRL_CTRLB           = const(0x41004004)
 _NVMCTRL_PARAM           = const(0x41004008)
@@ -44,6 +70,8 @@ _NVMCTRL_INTFLAG         = const(0x41004014)
 _NVMCTRL_STATUS          = const(0x41004018)
 _NVMCTRL_ADDR            = const(0x4100401c)
 
+_NVMCTRL_CTRLB_MANW      = const(0x00000080)
+
 _USER_ROW_ADDR           = const(0x00804000)
 
 _NVMCTRL_CMD_ER          = const(0xa502)
@@ -55,108 +83,193 @@ _NVMCTRL_CMD_UR          = const(0xa541)
 _NVMCTRL_CMD_PBC         = const(0xa544)
 _NVMCTRL_CMD_SSB         = const(0xa545)
 
-SAMD_DEVICES = {
-#   Device ID    Name           Flash size        Erase size
-    0x10040100: ("SAM D09D14A", 16 * 1024, 256),
-    0x10040107: ("SAM D09C13A", 8 * 1024, 128),
-    0x10020100: ("SAM D10D14AM", 16 * 1024, 256),
-    0x10030100: ("SAM D11D14A", 16 * 1024, 256),
-    0x10030000: ("SAM D11D14AM", 16 * 1024, 256),
-    0x10030003: ("SAM D11D14AS", 16 * 1024, 256),
-    0x10030103: ("SAM D11D14AS (Rev B)", 16 * 1024, 256),
-    0x10030006: ("SAM D11C14A", 16 * 1024, 256),
-    0x10030106: ("SAM D11C14A (Rev B)", 16 * 1024, 256),
-    0x1000120d: ("SAM D20E15A", 32 * 1024, 512),
-    0x1000140a: ("SAM D20E18A", 256 * 1024, 4096),
-    0x10001100: ("SAM D20J18A", 256 * 1024, 4096),
-    0x10001200: ("SAM D20J18A (Rev C)", 256 * 1024, 4096),
-    0x10010100: ("SAM D21J18A", 256 * 1024, 4096),
-    0x10010200: ("SAM D21J18A (Rev C)", 256 * 1024, 4096),
-    0x10010300: ("SAM D21J18A (Rev D)", 256 * 1024, 4096),
-    0x1001020d: ("SAM D21E15A (Rev C)", 32 * 1024, 512),
-    0x1001030a: ("SAM D21E18A", 256 * 1024, 4096),
-    0x10010205: ("SAM D21G18A", 256 * 1024, 4096),
-    0x10010305: ("SAM D21G18A (Rev D)", 256 * 1024, 4096),
-    0x10010019: ("SAM R21G18 ES", 256 * 1024, 4096),
-    0x10010119: ("SAM R21G18", 256 * 1024, 4096),
-    0x10010219: ("SAM R21G18A (Rev C)", 256 * 1024, 4096),
-    0x10010319: ("SAM R21G18A (Rev D)", 256 * 1024, 4096),
-    0x11010100: ("SAM C21J18A ES", 256 * 1024, 4096),
-    0x10810219: ("SAM L21E18B", 256 * 1024, 4096),
-    0x10810000: ("SAM L21J18A", 256 * 1024, 4096),
-    0x1081010f: ("SAM L21J18B (Rev B)", 256 * 1024, 4096),
-    0x1081020f: ("SAM L21J18B (Rev C)", 256 * 1024, 4096),
-    0x1081021e: ("SAM R30G18A", 256 * 1024, 4096),
-    0x1081021f: ("SAM R30E18A", 256 * 1024, 4096),
-}
+# Device ID, name, flash size in KiB, page count. Kept as one string and
+# searched by find_device() so that only the matching entry is ever parsed.
+_SAMD_DEVICES = """
+10040100,SAM D09D14A,16,256
+10040107,SAM D09C13A,8,128
+10020100,SAM D10D14AM,16,256
+10030100,SAM D11D14A,16,256
+10030000,SAM D11D14AM,16,256
+10030003,SAM D11D14AS,16,256
+10030103,SAM D11D14AS (Rev B),16,256
+10030006,SAM D11C14A,16,256
+10030106,SAM D11C14A (Rev B),16,256
+1000120d,SAM D20E15A,32,512
+1000140a,SAM D20E18A,256,4096
+10001100,SAM D20J18A,256,4096
+10001200,SAM D20J18A (Rev C),256,4096
+10010100,SAM D21J18A,256,4096
+10010200,SAM D21J18A (Rev C),256,4096
+10010300,SAM D21J18A (Rev D),256,4096
+1001020d,SAM D21E15A (Rev C),32,512
+1001030a,SAM D21E18A,256,4096
+10010205,SAM D21G18A,256,4096
+10010305,SAM D21G18A (Rev D),256,4096
+10010019,SAM R21G18 ES,256,4096
+10010119,SAM R21G18,256,4096
+10010219,SAM R21G18A (Rev C),256,4096
+10010319,SAM R21G18A (Rev D),256,4096
+11010100,SAM C21J18A ES,256,4096
+10810219,SAM L21E18B,256,4096
+10810000,SAM L21J18A,256,4096
+1081010f,SAM L21J18B (Rev B),256,4096
+1081020f,SAM L21J18B (Rev C),256,4096
+1081021e,SAM R30G18A,256,4096
+1081021f,SAM R30E18A,256,4096
+"""
+
+def __getattr__(name):
+    # The table as the dict it used to be. It's parsed on each use so that
+    # only code that still wants the whole dict pays for it.
+    if name == "SAMD_DEVICES":
+        return parse_devices(_SAMD_DEVICES)
+    raise AttributeError(name)
+
 class SAM(DapTarget):
+    HARDWARE_CRC = True
+
     def __init__(self, probe):
         super().__init__(probe)
         self.locked = None
-        self.page_size = 256 # erase size
+        self.page_size = 256 # row size, the unit we program in
+        # Partial pages are padded to this. Automatic write needs the last
+        # word of each 64 byte page to be written.
+        self.write_align = 64
+        self._unlocked_region = None
 
     def target_connect(self, swj_clock=5000):
-        self.probe.disconnect()
-        self.probe.connect()
-        self.probe.set_clock(swj_clock)
-        self.reset_with_extension()
-        # dap_idle_cycles 0
-        # dap_retry_count 128
-        # dap_match_retry_count 128
+        with self.new_report().phase("connect"):
+            self.probe.disconnect()
+            self.probe.connect()
+            self.probe_connected = True
+            self.configure_transfers()
+            self.probe.set_clock(swj_clock)
+            self.reset_with_extension()
+
+    def forget_board(self):
+        super().forget_board()
+        self.locked = None
+        self._unlocked_region = None
 
     def reset_with_extension(self):
         # bring the CPU out of reset while holding swclk low
         pins = self.probe.PinGroup.PROTOCOL_PINS
         self.probe.write_pins(pins, 0x11, 0x00)
-        time.sleep(0.1)
+        time.sleep(_RESET_PULSE)
         self.probe.write_pins(pins, 0x11, 0x10)
         self.probe.write_pins(pins, 0x11, 0x11)
+        # Reset re-applies the region locks.
+        self._unlocked_region = None
+        self.attached = False
         self.reset_link()
         self.target_prepare()
+        # The DSU flags the extension once the reset has taken.
+        self.wait_for_value(_DAP_DSU_CTRL_STATUS, _DAP_DSU_STATUSA_CRSTEXT,
+                            _DAP_DSU_STATUSA_CRSTEXT, 0.5)
 
     def finish_reset(self):
         # Stop the core
-        self.write_word(_DHCSR, 0xa05f0003)
-        self.write_word(_DEMCR, 0x00000001)
-        self.write_word(_AIRCR, 0x05fa0004)
+        self.write_word(_DHCSR, 0xa05f0003, posted=True)
+        self.write_word(_DEMCR, 0x00000001, posted=True)
+        if not self.attached:
+            self.write_word(_AIRCR, 0x05fa0004, posted=True)
 
         # Release the reset
         self.write_word(_DAP_DSU_CTRL_STATUS, _DAP_DSU_STATUSA_CRSTEXT);
+        self.wait_for_value(_DHCSR, _DHCSR_S_HALT, _DHCSR_S_HALT)
 
     def select(self):
-        self.reset_with_extension()
-
-        device_id = self.read_word(_DAP_DSU_DID)
-        print("device_id", hex(device_id))
-
-        if device_id not in SAMD_DEVICES:
-            return
-        self.device = SAMD_DEVICES[device_id]
-        print("device", self.device[0])
+        with self.report.phase("select"):
+            # hot_attach() leaves an already halted target as it is.
+            if not self.attached:
+                self.reset_with_extension()
+
+            device_id = self.read_word(_DAP_DSU_DID)
+            print("device_id", hex(device_id))
+            self.report.family = "sam"
+            self.report.device_id = device_id
+
+            device = find_device(_SAMD_DEVICES, device_id)
+            if device is None:
+                return
+            self.device = device
+            print("device", self.device[0])
+            self.report.device_name = device[0]
+            self.read_geometry(16, 4)
+
+            self.locked = self.read_word(_DAP_DSU_CTRL_STATUS) & 0x00010000;
+            self.report.locked = bool(self.locked)
+            if self.locked:
+                print("Device is locked, must be unlocked first!")
+            else:
+                print("Device is unlocked")
 
-        self.locked = self.read_word(_DAP_DSU_CTRL_STATUS) & 0x00010000;
-        if self.locked:
-            print("Device is locked, must be unlocked first!")
-        else:
-            print("Device is unlocked")
+            self.finish_reset()
 
-        self.finish_reset()
+    def read_geometry(self, region_count, pages_per_erase):
+        """Fill in ``self.geometry`` from ``NVMCTRL.PARAM``, falling back to
+        the device table if it reads as zero."""
+        param = self.read_word(_NVMCTRL_PARAM)
+        pages = param & 0xffff
+        page_size = 8 << ((param >> 16) & 0x7)
+        if pages == 0:
+            pages = self.device[2]
+            page_size = self.device[1] // pages
+        self.set_geometry(FlashGeometry(pages * page_size, page_size, page_size * pages_per_erase,
+                                        region_count, DAP_FLASH_START))
+
+    def set_geometry(self, geometry):
+        self.geometry = geometry
+        # Automatic write commits each page as its last word arrives so we can
+        # send a whole row at a time.
+        self.page_size = geometry.erase_size
+        self.write_align = geometry.page_size
 
     def deselect(self):
         self.write_word(_DEMCR, 0x00000000)
         self.write_word(_AIRCR, 0x05fa0004)
 
     def erase(self):
-        self.write_word(_DAP_DSU_CTRL_STATUS, 0x00001f00) # Clear flags
+        with self.report.phase("erase"):
+            self.run_steps(self.erase_steps())
+
+    def erase_steps(self):
+        self.write_word(_DAP_DSU_CTRL_STATUS, 0x00001f00, posted=True) # Clear flags
         self.write_word(_DAP_DSU_CTRL_STATUS, 0x00000010) # Chip erase
-        time.sleep(0.1)
-        while (self.read_word(_DAP_DSU_CTRL_STATUS) & 0x00000100) == 0:
-            pass
+        yield (_DAP_DSU_CTRL_STATUS, _DAP_DSU_STATUSA_DONE, _DAP_DSU_STATUSA_DONE,
+               _CHIP_ERASE_TIMEOUT)
 
         if self.locked:
             self.reset_with_extension()
             self.finish_reset()
 
+    def crc32(self, start, length, timeout=1) -> int:
+        """Have the DSU compute the CRC32 of ``length`` bytes at ``start``.
+        The DSU seeds with 0xffffffff and doesn't invert the result."""
+        # Clear DONE and BERR but not CRSTEXT, which would release the CPU.
+        self.write_word(_DAP_DSU_CTRL_STATUS, _DAP_DSU_STATUSA_DONE | _DAP_DSU_STATUSA_BERR,
+                        posted=True)
+        self.write_word(_DAP_DSU_ADDR, start, posted=True)
+        self.write_word(_DAP_DSU_LENGTH, length, posted=True)
+        self.write_word(_DAP_DSU_DATA, 0xffffffff, posted=True)
+        self.write_word(_DAP_DSU_CTRL_STATUS, _DAP_DSU_CTRL_CRC, posted=True)
+        status = self.wait_for_value(_DAP_DSU_CTRL_STATUS, _DAP_DSU_STATUSA_DONE,
+                                     _DAP_DSU_STATUSA_DONE, timeout)
+        if status & _DAP_DSU_STATUSA_BERR:
+            raise RuntimeError(f"DSU CRC bus error at 0x{start:08x}")
+        return self.read_word(_DAP_DSU_DATA)
+
+    def blank_check(self, start, length, samples=0) -> bool:
+        """Return True if the ``length`` bytes at ``start`` are all 0xff by
+        comparing the DSU CRC with the CRC of erased flash. A locked part
+        always needs an erase so it is never blank."""
+        if (start | length) & 0x3:
+            raise ValueError("blank_check range must be word aligned")
+        if self.locked:
+            return False
+        return self.crc32(start, length) == erased_crc32(length)
+
     def fuse_read(self):
         # The user row is the first 8 bytes but we load the whole page. If we
         # don't, our write doesn't trigger the auto-page write with the last
@@ -178,34 +291,42 @@ class SAM(DapTarget):
         # Turn off autoreload because we don't want to erase but not write the user row.
         if IS_CIRCUITPYTHON:
             supervisor.runtime.autoreload = False
-        self.write_word(_NVMCTRL_CTRLB, 0)
-        self.write_word(_NVMCTRL_ADDR, _USER_ROW_ADDR >> 1)
+        self.write_word(_NVMCTRL_CTRLB, 0, posted=True)
+        self.write_word(_NVMCTRL_ADDR, _USER_ROW_ADDR >> 1, posted=True)
         self.write_word(_NVMCTRL_CTRLA, _NVMCTRL_CMD_EAR)
-        while (self.read_word(_NVMCTRL_INTFLAG) & 1) == 0:
-            pass
+        self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
 
         print("write", self._user_row)
         self.write_block(_USER_ROW_ADDR, self._user_row)
         if IS_CIRCUITPYTHON:
             supervisor.runtime.autoreload = True
 
-        # Needs to reset the MCU, for it to reread the fuses
-        time.sleep(1)
+        # Needs to reset the MCU, for it to reread the fuses. Wait for the
+        # automatic page write to finish first.
+        self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
         self.reset_with_extension()
         self.finish_reset()
 
     def reset_protection_fuses(self, reset_bootloader_protection, reset_region_locks):
         do_fuse_write = False
 
+        # Check the 8 fuse bytes alone and only load the row to change it.
+        fuses = self.read_memory(_USER_ROW_ADDR, 8)
+        if ((not reset_bootloader_protection or (fuses[0] & 0x7) == 0x7)
+                and (not reset_region_locks or fuses[6:8] == b"\xff\xff")):
+            return
+
         self.fuse_read()
 
         if reset_bootloader_protection and (self._user_row[0] & 0x7) != 0x7:
             print("Resetting BOOTPROT... ");
+            self.report.fuse_change("BOOTPROT", self._user_row[0] & 0x7, 0x7)
             self._user_row[0] |= 0x7;
             do_fuse_write = True
 
         if reset_region_locks and (self._user_row[6] != 0xff or self._user_row[7] != 0xff):
             print(" Resetting NVM region LOCK... ")
+            self.report.fuse_change("LOCK", self._user_row[6] | self._user_row[7] << 8, 0xffff)
             self._user_row[6] = 0xff
             self._user_row[7] = 0xff
             do_fuse_write = True
@@ -224,47 +345,149 @@ class SAM(DapTarget):
 
         return DAP_FLASH_START + offset
 
-    def program_block(self, addr, buf):
+    def unlock_region(self, addr):
         # Even after a chip erase, unlocking flash regions still might be necessary, since region locks is not cleared by Chip Erase.
-        self.write_word(_NVMCTRL_ADDR, addr >> 1)
-        self.write_word(_NVMCTRL_CTRLA, _NVMCTRL_CMD_UR) # Unlock Region temporary
-        while self.read_word(_NVMCTRL_INTFLAG) & 1 == 0:
-            pass
+        # The unlock lasts until reset so only do it once per region.
+        region = None
+        if self.geometry is not None:
+            region = addr // self.geometry.region_size
+            if region == self._unlocked_region:
+                return
+        self._unlock_region(addr)
+        self._unlocked_region = region
+
+    def _unlock_region(self, addr):
+        self.write_word(_NVMCTRL_ADDR, addr >> 1, posted=True)
+        self.write_word(_NVMCTRL_CTRLA, _NVMCTRL_CMD_UR, posted=True) # Unlock Region temporary
+        self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
 
+    def program_block(self, addr, buf):
+        self.unlock_region(addr)
         self.write_block(addr, buf)
 
-    def program_flash(self, addr, buf, do_verify=True, verify_only=False) -> bool:
+    def program_steps(self, addr, data):
+        # program_block() leaves the last page writing. Wait for it here so a
+        # scheduler can use the bus meanwhile.
+        self.program_block(addr, data)
+        yield (_NVMCTRL_INTFLAG, 1, 1, 1)
+
+    def erase_range(self, addr, size):
+        """Erase every row that overlaps ``[addr, addr + size)``."""
+        self.geometry.check_range(addr, size)
+        row_size = self.geometry.erase_size
+        addr -= addr % row_size
+        end = addr + size
+        while addr < end:
+            self.unlock_region(addr)
+            self.write_word(_NVMCTRL_ADDR, addr >> 1, posted=True)
+            self.write_word(_NVMCTRL_CTRLA, _NVMCTRL_CMD_ER, posted=True)
+            self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
+            addr += row_size
+
+    def _manual_write(self):
+        # Pages are only written by WP so a row can be loaded page by page.
+        self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CTRLB_MANW, posted=True)
+        self.write_word(_NVMCTRL_CTRLA, _NVMCTRL_CMD_PBC, posted=True)
+        self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
+
+    def write_page(self, addr, data):
+        """Load one page into the page buffer and write it with WP. Needs
+        manual write mode. Loading the buffer also sets ADDR."""
+        self.write_block(addr, data)
+        self.write_word(_NVMCTRL_CTRLA, _NVMCTRL_CMD_WP, posted=True)
+        self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
+
+    def update_flash(self, addr, buf, do_verify=True, policy=None) -> bool:
+        """Program ``buf`` at ``addr`` without a chip erase. Each erase row it
+        touches is merged with its current contents, erased once and written
+        back a page at a time. Rows that already hold the data are left alone
+        and erased pages aren't written. ``policy`` works as in
+        :meth:`program_flash` with each row as a page."""
+        self.geometry.check_range(addr, len(buf))
+        row_size = self.geometry.erase_size
+        page_size = self.geometry.page_size
+        policy = self.verify_policy(do_verify, policy)
+        report = self.report
+        self.program_start(addr)
+        self._manual_write()
+
+        buf = memoryview(buf)
+        row_buf, _, erased = self.page_buffers(row_size)
+        row_view = memoryview(row_buf)
+        row = addr - addr % row_size
+        end = addr + len(buf)
+        while row < end:
+            start = max(addr, row)
+            stop = min(end, row + row_size)
+            data = buf[start - addr : stop - addr]
+            if stop - start == row_size:
+                # The whole row is replaced so only its CRC is needed.
+                current = self.crc32(row, row_size)
+                if current == crc32(data):
+                    report.pages_skipped += 1
+                    row += row_size
+                    continue
+                blank = current == erased_crc32(row_size)
+                row_buf[:] = data
+            else:
+                self.read_block_into(row, row_buf)
+                if row_buf[start - row : stop - row] == data:
+                    report.pages_skipped += 1
+                    row += row_size
+                    continue
+                blank = row_buf == erased
+                row_buf[start - row : stop - row] = data
+
+            write_start = report.ticks()
+            # Blank rows skip erase_range() so unlock them here.
+            self.unlock_region(row)
+            if not blank:
+                self.erase_range(row, row_size)
+            pages = 0
+            for page in range(0, row_size, page_size):
+                page_data = row_view[page : page + page_size]
+                if not self.is_erased(page_data):
+                    self.write_page(row + page, page_data)
+                    pages += 1
+            report.add_program(write_start, stop - start, pages)
+
+            if policy.mode == "crc":
+                if not self.verify_crc(row, row_buf):
+                    return False
+            elif policy.check_page() and not self.verify_block(row, row_buf):
+                return False
+            row += row_size
+        return True
+
+    def program_flash(self, addr, buf, do_verify=True, verify_only=False, policy=None) -> bool:
+        """Program ``buf`` at ``addr`` skipping erased pages. ``policy`` is a
+        :class:`VerifyPolicy` and defaults to full or no verification from
+        ``do_verify``. With ``verify_only`` nothing is written."""
+        if self.geometry is not None:
+            self.geometry.check_range(addr, len(buf))
+
         if not verify_only:
             start_addr = self.program_start(addr);
 
+        policy = self.verify_policy(do_verify, policy)
+        buf = memoryview(buf)
+        self.page_buffers(self.page_size)
         offset = 0
         while offset < len(buf):
-            remaining = len(buf) - offset
-            if remaining >= self.page_size:
-                data = memoryview(buf)[offset:offset + self.page_size]
-            else:
-                data = bytearray(self.page_size)
-                for i in range(self.page_size):
-                    if i < remaining:
-                        data[i] = buf[offset+i]
-                    else:
-                        data[i] = 0xff
-
-            hasdata = False
-            for value in data:
-                if value != 0xff:
-                    hasdata = True
-                    break
+            data = self.padded_page(buf, offset, self.page_size, self.write_align)
+            hasdata = not self.is_erased(data)
 
             if hasdata and not verify_only:
-                self.program_block(start_addr + offset, data)
+                self.program_page(start_addr + offset, data)
+            elif not verify_only:
+                self.report.pages_skipped += 1
 
             # Optionally verify the written data
-            if hasdata and do_verify:
-                verify_buffer = self.read_block(addr + offset, self.page_size)
-                if verify_buffer != data:
-                    return False
-                del verify_buffer
+            if hasdata and policy.check_page() and not self.verify_block(addr + offset, data):
+                return False
 
             offset += len(data)
+
+        if policy.mode == "crc" and not self.verify_crc(addr, buf):
+            return False
         return True
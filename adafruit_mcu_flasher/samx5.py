@@ -4,7 +4,7 @@
 """
 """
 
-from . import sam
+from . import find_device, parse_devices, sam
 
 from micropython import const
 
@@ -14,7 +14,6 @@ try:
     IS_CIRCUITPYTHON = True
 except ModuleNotFoundError:
     pass
-import time
 
 __version__ = "0.0.0+auto.0"
 __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
@@ -59,47 +58,92 @@ _NVMCTRL_CMD_CBPDIS      = const(0xa51b) # /* Clears STATUS.BPDIS, Boot loader p
 
 _USER_ROW_ADDR           = const(0x00804000)
 
-SAMDx5_DEVICES = {
-    0x60060000: ("SAMD51P20A", 1024 * 1024, 2048),
-    0x60060300: ("SAMD51P20A", 1024 * 1024, 2048),
-    0x60060001: ("SAMD51P19A", 512 * 1024, 1024),
-    0x60060002: ("SAMD51N20A", 1024 * 1024, 2048),
-    0x60060003: ("SAMD51N19A", 512 * 1024, 1024),
-    0x60060004: ("SAMD51J20A", 1024 * 1024, 2048),
-    0x60060304: ("SAMD51J20A", 1024 * 1024, 2048),
-    0x60060305: ("SAMD51J19A", 512 * 1024, 1024),
-    0x60060005: ("SAMD51J19A", 512 * 1024, 1024),
-    0x60060006: ("SAMD51J18A", 256 * 1024, 512),
-    0x60060007: ("SAMD51G19A", 512 * 1024, 1024),
-    0x60060307: ("SAMD51G19A", 512 * 1024, 1024),
-    0x60060008: ("SAMD51G18A", 256 * 1024, 512),
-    0x61810002: ("SAME51J19A", 512 * 1024, 1024),
-    0x61810302: ("SAME51J19A", 512 * 1024, 1024)
-}
+# Device ID, name, flash size in KiB, page count. Kept as one string and
+# searched by find_device() so that only the matching entry is ever parsed.
+_SAMDx5_DEVICES = """
+60060000,SAMD51P20A,1024,2048
+60060300,SAMD51P20A,1024,2048
+60060001,SAMD51P19A,512,1024
+60060002,SAMD51N20A,1024,2048
+60060003,SAMD51N19A,512,1024
+60060004,SAMD51J20A,1024,2048
+60060304,SAMD51J20A,1024,2048
+60060305,SAMD51J19A,512,1024
+60060005,SAMD51J19A,512,1024
+60060006,SAMD51J18A,256,512
+60060007,SAMD51G19A,512,1024
+60060307,SAMD51G19A,512,1024
+60060008,SAMD51G18A,256,512
+61810002,SAME51J19A,512,1024
+61810302,SAME51J19A,512,1024
+"""
+
+def __getattr__(name):
+    # The table as the dict it used to be. It's parsed on each use so that
+    # only code that still wants the whole dict pays for it.
+    if name == "SAMDx5_DEVICES":
+        return parse_devices(_SAMDx5_DEVICES)
+    raise AttributeError(name)
 
 class SAMx5(sam.SAM):
     def target_connect(self):
-        self.reset_with_extension()
+        with self.new_report().phase("connect"):
+            self.configure_transfers()
+            self.reset_with_extension()
 
     def select(self):
-        device_id = self.read_word(_DAP_DSU_DID)
-        print("device_id", hex(device_id))
-        if device_id not in SAMDx5_DEVICES:
-            return
-
-        self.device = SAMDx5_DEVICES[device_id]
-        print("device", self.device[0])
+        # Unlike the SAMD21 this doesn't reset, so it works the same after
+        # target_connect() and hot_attach().
+        with self.report.phase("select"):
+            device_id = self.read_word(_DAP_DSU_DID)
+            print("device_id", hex(device_id))
+            self.report.family = "samx5"
+            self.report.device_id = device_id
+            device = find_device(_SAMDx5_DEVICES, device_id)
+            if device is None:
+                return
+
+            self.device = device
+            print("device", self.device[0])
+            self.report.device_name = device[0]
+            # 32 lock regions and 8 KiB (16 page) erase blocks
+            self.read_geometry(32, 16)
+
+            self.locked = self.read_word(_DAP_DSU_CTRL_STATUS) & 0x00010000;
+            self.report.locked = bool(self.locked)
+            if self.locked:
+                print("Device is locked, must be unlocked first!")
+            else:
+                print("Device is unlocked")
 
-        locked = self.read_word(_DAP_DSU_CTRL_STATUS) & 0x00010000;
-        if locked:
-            print("Device is locked, must be unlocked first!")
-        else:
-            print("Device is unlocked")
+            self.finish_reset()
 
-        self.finish_reset()
+    def set_geometry(self, geometry):
+        self.geometry = geometry
+        # Manual write mode commits a full page buffer per write page command.
+        self.page_size = geometry.page_size
+        # Pad partial pages fully so no quad word is ever written twice.
+        self.write_align = geometry.page_size
 
     # erase() is the same as SAMD21
 
+    def wait_ready(self):
+        self.wait_for_value(_NVMCTRL_STATUS, 0x10000, 0x10000)
+
+    def erase_range(self, addr, size):
+        """Erase every block that overlaps ``[addr, addr + size)``."""
+        self.geometry.check_range(addr, size)
+        block_size = self.geometry.erase_size
+        addr -= addr % block_size
+        end = addr + size
+        while addr < end:
+            self.unlock_region(addr)
+            self.wait_ready()
+            self.write_word(_NVMCTRL_ADDR, addr, posted=True)
+            self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_EB, posted=True)
+            addr += block_size
+        self.wait_ready()
+
     def fuse_read(self):
         # The user row is the first 32 bytes but we twice that and back up the
         # values to the second 32 bytes if they are empty. The backup won't save
@@ -145,43 +189,50 @@ class SAMx5(sam.SAM):
         if IS_CIRCUITPYTHON:
             supervisor.runtime.autoreload = False
         # Erase the page
-        self.write_word(_NVMCTRL_CTRLA, 0x4)
-        self.write_word(_NVMCTRL_ADDR, _USER_ROW_ADDR)
-        self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_EP)
-        while (self.read_word(_NVMCTRL_INTFLAG) & 1) == 0:
-            pass
-
-        start_time = time.monotonic()
-        while time.monotonic() - start_time < 1 and (self.read_word(_NVMCTRL_STATUS) & 0x10000) == 0:
-            pass
-        if (self.read_word(_NVMCTRL_STATUS) & 0x10000) == 0:
-            raise TimeoutError("Flash not ready")
-
-        for i in range(256 // 16):
+        self.write_word(_NVMCTRL_CTRLA, 0x4, posted=True)
+        self.write_word(_NVMCTRL_ADDR, _USER_ROW_ADDR, posted=True)
+        self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_EP, posted=True)
+        self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
+
+        self.wait_ready()
+
+        # Only write the quad words we hold instead of the whole page.
+        for i in range(len(self._user_row) // 16):
             self.write_block(_USER_ROW_ADDR + 16 * i, memoryview(self._user_row)[16 * i:16 * (i + 1)])
-            self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_WQW)
-            while (self.read_word(_NVMCTRL_INTFLAG) & 1) == 0:
-                pass
+            self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_WQW, posted=True)
+            self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
         if IS_CIRCUITPYTHON:
             supervisor.runtime.autoreload = True
 
-        # Needs to reset the MCU, for it to reread the fuses
-        time.sleep(1)
+        # Needs to reset the MCU, for it to reread the fuses. Wait for the
+        # last write to finish first.
+        self.wait_ready()
         self.reset_with_extension()
         self.finish_reset()
 
     def reset_protection_fuses(self, reset_bootloader_protection, reset_region_locks):
         do_fuse_write = False
 
+        # Check the fuse bytes alone and only load the row to change it. An
+        # erased row takes the full path so it is restored from the backup.
+        fuses = self.read_memory(_USER_ROW_ADDR, 16)
+        if (fuses != b"\xff" * 16
+                and (not reset_bootloader_protection or ((fuses[3] >> 2) & 0x7) == 0x7)
+                and (not reset_region_locks or fuses[9:13] == b"\xff\xff\xff\xff")):
+            return
+
         self.fuse_read()
 
         if reset_bootloader_protection and ((self._user_row[3] >> 2) & 0x7) != 0x7:
             print("Resetting BOOTPROT... ");
+            self.report.fuse_change("BOOTPROT", (self._user_row[3] >> 2) & 0x7, 0x7)
             self._user_row[3] |= 0x7 << 2;
             do_fuse_write = True
 
         if reset_region_locks and self._user_row[9:13] != b"\xff\xff\xff\xff":
             print("Resetting NVM region LOCK... ")
+            self.report.fuse_change("LOCK", int.from_bytes(self._user_row[9:13], "little"),
+                                    0xffffffff)
             self._user_row[9:13] = b"\xff\xff\xff\xff"
             do_fuse_write = True
 
@@ -196,29 +247,34 @@ class SAMx5(sam.SAM):
         self.reset_protection_fuses(True, False)
 
         # Temporarily turn off bootloader protection
-        self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_SBPDIS)
-        while (self.read_word(_NVMCTRL_INTFLAG) & 1) == 0:
-            pass
+        self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_SBPDIS, posted=True)
+        self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
 
         self.write_word(_NVMCTRL_CTRLA, 0x04) # Manual write
 
         return offset
 
+    def _unlock_region(self, addr):
+        self.write_word(_NVMCTRL_ADDR, addr, posted=True)
+        self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_UR, posted=True) # Unlock Region temporary
+        self.wait_for_value(_NVMCTRL_INTFLAG, 1, 1)
+
+    def _manual_write(self):
+        # program_start() already selected manual write.
+        pass
+
+    def write_page(self, addr, data):
+        self.program_block(addr, data)
+
     def program_block(self, addr, buf):
-        # Even after a chip erase, unlocking flash regions still might be necessary, since region locks is not cleared by Chip Erase.
-        self.write_word(_NVMCTRL_ADDR, addr)
-        self.write_word(_NVMCTRL_CTRLA, _NVMCTRL_CMD_UR) # Unlock Region temporary
-        while self.read_word(_NVMCTRL_INTFLAG) & 1 == 0:
-            pass
-
-        self.write_block(addr, buf)
-
-        start_time = time.monotonic()
-        while time.monotonic() - start_time < 1 and (self.read_word(_NVMCTRL_STATUS) & 0x10000) == 0:
-            pass
-        if (self.read_word(_NVMCTRL_STATUS) & 0x10000) == 0:
-            raise TimeoutError("Flash not ready")
-
-        self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_WP) # Write page from the buffer to flash
-        while self.read_word(_NVMCTRL_INTFLAG) & 1 == 0:
-            pass
+        self.run_steps(self.program_steps(addr, buf))
+
+    def program_steps(self, addr, data):
+        self.unlock_region(addr)
+
+        self.write_block(addr, data)
+
+        yield (_NVMCTRL_STATUS, 0x10000, 0x10000, 1) # wait_ready()
+
+        self.write_word(_NVMCTRL_CTRLB, _NVMCTRL_CMD_WP, posted=True) # Write page from the buffer to flash
+        yield (_NVMCTRL_INTFLAG, 1, 1, 1)
@@ -0,0 +1,283 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.service`
+================================================================================
+
+A long running flashing service for production lines. Probes stay connected
+between boards and images stay parsed in memory as :class:`FlashPlan` s, so
+each board only costs its SWD work. Jobs are JSON objects, one per line, read
+from a stream such as stdin or from clients of a Unix socket. Each job gets
+one JSON line back.
+
+.. code-block:: python
+
+    from adafruit_mcu_flasher import sam
+    from adafruit_mcu_flasher.service import FlashService
+
+    service = FlashService({"left": sam.SAM(probe0), "right": sam.SAM(probe1)})
+    service.serve_unix("/tmp/flasher.sock")
+
+A job names the station and the image and may set the load address of a
+``.bin``, the erase mode and the verification:
+
+.. code-block:: json
+
+    {"id": 7, "station": "left", "image": "firmware.hex", "erase": "auto",
+     "verify": "sampled", "coverage": 25}
+
+``patches`` writes per board data such as a serial number over the cached
+image, each one an address and hex data:
+
+.. code-block:: json
+
+    {"id": 8, "station": "left", "image": "firmware.hex",
+     "patches": [{"addr": 16368, "data": "0a000000"}]}
+
+The reply carries the job ``id``, ``ok``, ``error``, whether the image came
+from the cache and the board's :class:`FlashReport` as ``report``. A job with
+``"op": "status"`` returns the stations and cache statistics instead.
+
+This needs ``os``, ``socketserver`` and ``threading`` so it only runs on
+CPython.
+"""
+
+import contextlib
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from .verify import VerifyPolicy
+from .bin_file import bin_chunks
+from .hex_file import hex_chunks
+from .planner import OP_WRITE, FlashPlan
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+ERASE_MODES = ("auto", "chip", "range", "none")
+
+
+def plan_size(plan) -> int:
+    """Return the bytes of image data held by ``plan``."""
+    # Verifies share the data of their write.
+    return sum(op.size for op in plan.ops if op.kind == OP_WRITE)
+
+
+class ImageCache:
+    """Parsed images as :class:`FlashPlan` s, least recently used first. The
+    plans hold at most ``max_bytes`` of image data. An image is reloaded when
+    its file's size or modification time changes."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._plans)
+
+    def plan(self, path, target_class, geometry, addr=0, erase="chip", policy=None):
+        """Return ``(plan, cached)`` for the image at ``path`` with the
+        settings of :class:`FlashPlan`. ``addr`` is the load address of a
+        ``.bin`` file."""
+        stat = os.stat(path)
+        key = (
+            os.path.abspath(path),
+            addr,
+            target_class,
+            repr(geometry),
+            erase,
+            str(policy),
+        )
+        with self._lock:
+            entry = self._plans.get(key)
+            if entry is not None and entry[0] == (stat.st_mtime_ns, stat.st_size):
+                self._plans.move_to_end(key)
+                self.hits += 1
+                return entry[1], True
+        # Parse outside of the lock so other stations keep going.
+        with open(path, "rb") as file:
+            if path.endswith(".hex"):
+                chunks = hex_chunks(file)
+            else:
+                chunks = bin_chunks(file, addr)
+            plan = FlashPlan(target_class, geometry, chunks, erase, policy)
+        with self._lock:
+            self.misses += 1
+            self._discard(key)
+            size = plan_size(plan)
+            if size <= self.max_bytes:
+                self._plans[key] = ((stat.st_mtime_ns, stat.st_size), plan)
+                self.size += size
+                while self.size > self.max_bytes:
+                    self._discard(next(iter(self._plans)))
+                    self.evictions += 1
+        return plan, False
+
+    def _discard(self, key):
+        entry = self._plans.pop(key, None)
+        if entry is not None:
+            self.size -= plan_size(entry[1])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._plans.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "images": len(self._plans),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class FlashService:
+    """Runs flashing jobs on ``stations``, a dict of names to targets whose
+    probes stay open. Jobs for different stations can run at the same time,
+    jobs for one station run in order. ``cache`` is the :class:`ImageCache`
+    to share, a new 16 MiB one by default. ``timeout`` is how long a job
+    waits for a board to answer, forever with None."""
+
+    def __init__(self, stations, cache=None, timeout=10):
+        self.stations = stations
+        self.cache = ImageCache() if cache is None else cache
+        self.timeout = timeout
+        self.jobs = 0
+        self._locks = {name: threading.Lock() for name in stations}
+
+    def handle(self, job) -> dict:
+        """Run one job and return its reply."""
+        self.jobs += 1
+        reply = {"id": job.get("id"), "ok": False, "error": None}
+        try:
+            if job.get("op", "flash") == "status":
+                reply["stations"] = {
+                    name: type(target).__name__
+                    for name, target in self.stations.items()
+                }
+                reply["cache"] = self.cache.stats()
+                reply["jobs"] = self.jobs
+                reply["ok"] = True
+            elif job.get("op", "flash") == "flash":
+                self._flash(job, reply)
+            else:
+                raise ValueError(f"Unknown op {job['op']}")
+        except (KeyError, ValueError, TypeError, OSError, RuntimeError) as error:
+            if isinstance(error, KeyError):
+                error = f"Missing or unknown {error}"
+            reply["ok"] = False
+            reply["error"] = str(error)
+        return reply
+
+    def _flash(self, job, reply):
+        name = job["station"]
+        target = self.stations[name]
+        erase = job.get("erase", "auto")
+        if erase not in ERASE_MODES:
+            raise ValueError(f"Unknown erase mode {erase}")
+        policy = VerifyPolicy(
+            job.get("verify", "full"), job.get("coverage", 100), job.get("seed", 1)
+        )
+        start = time.monotonic()
+        with self._locks[name]:
+            target.hot_attach(timeout=job.get("timeout", self.timeout))
+            report = target.report
+            reply["report"] = report.as_dict()
+            try:
+                target.select()
+                plan, reply["cached"] = self.cache.plan(
+                    job["image"],
+                    type(target),
+                    target.geometry,
+                    job.get("addr", 0),
+                    None if erase in ("auto", "none") else erase,
+                    policy,
+                )
+                if job.get("patches"):
+                    plan = plan.patch(
+                        (patch["addr"], bytes.fromhex(patch["data"]))
+                        for patch in job["patches"]
+                    )
+                if erase == "auto":
+                    target.erase_if_needed()
+                plan.run(target)
+            except (ValueError, OSError, RuntimeError) as error:
+                if report.ok is not False:
+                    report.fail(str(error))
+            finally:
+                target.deselect()
+        reply["ok"] = bool(report.ok)
+        reply["error"] = report.error
+        reply["report"] = report.as_dict()
+        reply["seconds"] = time.monotonic() - start
+
+    def serve(self, infile, outfile) -> None:
+        """Answer the JSON jobs read from ``infile``, one per line, on
+        ``outfile`` until ``infile`` ends."""
+        for line in infile:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("Jobs must be JSON objects")
+            except ValueError as error:
+                reply = {"id": None, "ok": False, "error": f"Bad job: {error}"}
+            else:
+                reply = self.handle(job)
+            outfile.write(json.dumps(reply) + "\n")
+            outfile.flush()
+
+    def serve_stdio(self) -> None:
+        """Serve jobs from stdin. Replies go to stdout and everything the
+        drivers print goes to stderr so the two don't mix."""
+        stdout = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            self.serve(sys.stdin, stdout)
+
+    def serve_unix(self, path) -> None:
+        """Serve jobs from clients of the Unix socket ``path`` until
+        interrupted. Each client is served on its own thread."""
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                writer = _TextWriter(self.wfile)
+                service.serve(self.rfile, writer)
+
+        if os.path.exists(path):
+            os.unlink(path)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+            # Don't wait on idle clients to exit.
+            server.daemon_threads = True
+            try:
+                server.serve_forever()
+            finally:
+                os.unlink(path)
+
+
+class _TextWriter:
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        self.wfile.write(text.encode("utf-8"))
+
+    def flush(self):
+        self.wfile.flush()
@@ -2,35 +2,306 @@
 #
 # SPDX-License-Identifier: MIT
 """
+`adafruit_mcu_flasher.stm32`
+================================================================================
+
+Flash driver for the STM32F4 flash program/erase controller (FPEC).
 """
 
-from . import DapTarget
+
+from micropython import const
+
+from . import DapTarget, FlashGeometry
+from .crc_stub import target_crc32
 
 __version__ = "0.0.0+auto.0"
 __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
 
+_DEMCR = const(0xE000EDFC)
+_AIRCR = const(0xE000ED0C)
+
+_DBGMCU_IDCODE = const(0xE0042000)
+_FLASHSIZE = const(0x1FFF7A20)  # Upper halfword is F_SIZE in KiB
+
+STM32_FLASH_START = const(0x08000000)
+STM32_BANK2_START = const(0x08100000)
+STM32_RAM_START = const(0x20000000)
+
+_FLASH_KEYR = const(0x40023C04)
+_FLASH_OPTKEYR = const(0x40023C08)
+_FLASH_SR = const(0x40023C0C)
+_FLASH_CR = const(0x40023C10)
+_FLASH_OPTCR = const(0x40023C14)
+_FLASH_OPTCR1 = const(0x40023C18)
+
+_FLASH_KEY1 = const(0x45670123)
+_FLASH_KEY2 = const(0xCDEF89AB)
+_FLASH_OPTKEY1 = const(0x08192A3B)
+_FLASH_OPTKEY2 = const(0x4C5D6E7F)
+
+_FLASH_SR_EOP = const(0x00000001)
+_FLASH_SR_BSY = const(0x00010000)
+# OPERR | WRPERR | PGAERR | PGPERR | PGSERR | RDERR
+_FLASH_SR_ERRORS = const(0x000001F2)
+
+_FLASH_CR_PG = const(0x00000001)
+_FLASH_CR_SER = const(0x00000002)
+_FLASH_CR_MER = const(0x00000004)
+_FLASH_CR_PSIZE_X32 = const(0x00000200)
+_FLASH_CR_MER1 = const(0x00008000)
+_FLASH_CR_STRT = const(0x00010000)
+_FLASH_CR_LOCK = const(0x80000000)
+
+_FLASH_OPTCR_OPTLOCK = const(0x00000001)
+_FLASH_OPTCR_OPTSTRT = const(0x00000002)
+_FLASH_OPTCR_RDP_MASK = const(0x0000FF00)
+_FLASH_OPTCR_MASK = const(0x0FFFFFEC)  # nWRP, RDP, user bits and BOR_LEV
+
+_RDP_LEVEL0 = const(0xAA)
+
 STM_DEVICE_NAMES = {
     0x413: "STM32F405xx/07xx and STM32F415xx/17xx",
     0x419: "STM32F42xxx and STM32F43xxx",
     0x431: "STM32F411xC/E",
-    0x441: "STM32F412"
+    0x441: "STM32F412",
 }
 
+# Sector sizes of one F4 flash bank, in order. Banks larger than 1 MiB don't
+# exist so the 128 KiB tail sector count depends on the flash size.
+_BANK_HEAD = (16 * 1024, 16 * 1024, 16 * 1024, 16 * 1024, 64 * 1024)
+_LARGE_SECTOR = const(128 * 1024)
+
+# Only write this much between BSY polls so that a failed write is caught early.
+_CHUNK_SIZE = const(1024)
+
+
+def stm32f4_sectors(flash_size, dual_bank=False):
+    """Return a list of ``(address, size, snb)`` tuples describing the
+    sectors of an STM32F4 with ``flash_size`` bytes of flash. ``snb`` is the
+    value for ``FLASH_CR.SNB``."""
+    sectors = []
+    banks = 2 if dual_bank else 1
+    bank_size = flash_size // banks
+    for bank in range(banks):
+        addr = STM32_BANK2_START if bank else STM32_FLASH_START
+        end = addr + bank_size
+        number = 0
+        while addr < end:
+            if number < len(_BANK_HEAD):
+                size = _BANK_HEAD[number]
+            else:
+                size = _LARGE_SECTOR
+            sectors.append((addr, size, (bank << 4) | number))
+            addr += size
+            number += 1
+    return sectors
+
+
 class STM32(DapTarget):
-    def select(self) -> Optional[int]:
+    # crc32() runs a routine in SRAM.
+    HARDWARE_CRC = True
+
+    def __init__(self, probe):
+        super().__init__(probe)
+        self.mcuid = None
+        self.flash_size = 0
+        self.sectors = []
+        self.page_size = _CHUNK_SIZE
+
+    def forget_board(self):
+        super().forget_board()
+        self.mcuid = None
+        self.flash_size = 0
+        self.sectors = []
+
+    def select(self):
+        with self.report.phase("select"):
+            return self._identify()
+
+    def _identify(self):
         self.target_prepare()
 
-        # Stop the core
-        self.dap.write_word(DHCSR, 0xa05f0003)
-        self.dap.write_word(DEMCR, 0x00000001)
-        self.dap.write_word(AIRCR, 0x05fa0004)
+        # Stop the core. A target that hot_attach() found halted isn't reset.
+        self.halt(reset=not self.attached)
+
+        mcuid = self.read_word(_DBGMCU_IDCODE) & 0xFFF
+        self.report.family = "stm32f4"
+        self.report.device_id = mcuid
+        if mcuid not in STM_DEVICE_NAMES:
+            print("Unknown device", hex(mcuid))
+            return None
+        print(STM_DEVICE_NAMES[mcuid])
+        self.report.device_name = STM_DEVICE_NAMES[mcuid]
+        self.report.locked = self.read_option_bytes() & _FLASH_OPTCR_RDP_MASK != _RDP_LEVEL0 << 8
+        self.mcuid = mcuid
+
+        self.flash_size = (self.read_word(_FLASHSIZE) >> 16) * 1024
+        # 2 MiB F42x/F43x parts are always dual bank. (The 1 MiB ones can be
+        # too through OPTCR.DB1M but we leave those in single bank mode.)
+        dual_bank = mcuid == 0x419 and self.flash_size > 1024 * 1024
+        self.sectors = stm32f4_sectors(self.flash_size, dual_bank)
+        # Sectors are uneven so erase_size is the largest one.
+        self.geometry = FlashGeometry(self.flash_size, _CHUNK_SIZE, _LARGE_SECTOR,
+                                      len(self.sectors), STM32_FLASH_START)
+        print("flash size", self.flash_size // 1024, "KiB", len(self.sectors), "sectors")
+
+        return mcuid
+
+    def deselect(self):
+        self.lock()
+        self.write_word(_DEMCR, 0x00000000)
+        self.write_word(_AIRCR, 0x05FA0004)
+
+    def unlock(self):
+        if self.read_word(_FLASH_CR) & _FLASH_CR_LOCK:
+            self.write_word(_FLASH_KEYR, _FLASH_KEY1, posted=True)
+            self.write_word(_FLASH_KEYR, _FLASH_KEY2, posted=True)
+            if self.read_word(_FLASH_CR) & _FLASH_CR_LOCK:
+                raise RuntimeError("Failed to unlock flash")
+
+    def lock(self):
+        self.write_word(_FLASH_CR, _FLASH_CR_LOCK)
+
+    def flash_wait_ready(self, timeout=1) -> int:
+        """Wait for ``FLASH_SR.BSY`` to clear and return the error flags."""
+        status = self.wait_for_value(_FLASH_SR, _FLASH_SR_BSY, 0, timeout)
+        if status & (_FLASH_SR_ERRORS | _FLASH_SR_EOP):
+            # Flags are write 1 to clear.
+            self.write_word(_FLASH_SR, status & (_FLASH_SR_ERRORS | _FLASH_SR_EOP))
+        return status & _FLASH_SR_ERRORS
+
+    def _erase(self, cr, timeout):
+        self.unlock()
+        self.flash_wait_ready()
+        self.write_word(_FLASH_CR, cr, posted=True)
+        self.write_word(_FLASH_CR, cr | _FLASH_CR_STRT, posted=True)
+        errors = self.flash_wait_ready(timeout)
+        self.write_word(_FLASH_CR, 0)
+        if errors:
+            raise RuntimeError(f"Erase failed, FLASH_SR errors 0x{errors:x}")
+
+    def erase(self):
+        """Mass erase all of flash."""
+        cr = _FLASH_CR_MER | _FLASH_CR_PSIZE_X32
+        if self.sectors and self.sectors[-1][2] & 0x10:
+            cr |= _FLASH_CR_MER1
+        # A 2 MiB mass erase takes up to 32 seconds at x32.
+        with self.report.phase("erase"):
+            self._erase(cr, 40)
+
+    def sectors_in_range(self, addr, size):
+        """Return the sectors overlapping ``[addr, addr + size)``."""
+        end = addr + size
+        return [s for s in self.sectors if s[0] < end and addr < s[0] + s[1]]
+
+    def erase_sector(self, snb):
+        # A 128 KiB sector takes up to 2 seconds.
+        self._erase(_FLASH_CR_SER | (snb << 3) | _FLASH_CR_PSIZE_X32, 4)
+
+    def erase_range(self, addr, size):
+        """Erase every sector that overlaps ``[addr, addr + size)``. Sector
+        boundaries are uneven so this may erase more than asked for."""
+        self.geometry.check_range(addr, size)
+        for sector in self.sectors_in_range(addr, size):
+            self.erase_sector(sector[2])
+
+    def crc32(self, start, length) -> int:
+        """Compute the CRC32 of ``length`` bytes at ``start`` with a routine
+        run from SRAM. The core must be halted, as it is after select()."""
+        return target_crc32(self, STM32_RAM_START, start, length)
+
+    def program_start(self, offset=0, size=0):
+        if self.read_option_bytes() & _FLASH_OPTCR_RDP_MASK != _RDP_LEVEL0 << 8:
+            raise RuntimeError("device is read protected, call unprotect() first")
+        self.unlock()
+        self.flash_wait_ready()
+        return STM32_FLASH_START + offset
+
+    def program_block(self, addr, buf):
+        self.write_word(_FLASH_CR, _FLASH_CR_PG | _FLASH_CR_PSIZE_X32, posted=True)
+        # The AHB stalls while a word is being programmed so a block write
+        # naturally paces itself to the flash.
+        self.write_block(addr, buf)
+        errors = self.flash_wait_ready()
+        self.write_word(_FLASH_CR, 0)
+        if errors:
+            raise RuntimeError(f"Programming failed at 0x{addr:08x}, FLASH_SR errors 0x{errors:x}")
+
+    def program_flash(self, addr, buf, do_verify=True, verify_only=False, policy=None) -> bool:
+        """Program ``buf`` at ``addr`` skipping erased pages. ``policy`` is a
+        :class:`VerifyPolicy` and defaults to full or no verification from
+        ``do_verify``. With ``verify_only`` nothing is written."""
+        # PSIZE x32 needs word alignment.
+        if addr & 0x03 != 0:
+            return False
+        if self.geometry is not None:
+            self.geometry.check_range(addr, len(buf))
+
+        if not verify_only:
+            self.unlock()
+
+        buf = memoryview(buf)
+        policy = self.verify_policy(do_verify, policy)
+        self.page_buffers(_CHUNK_SIZE)
+        offset = 0
+        while offset < len(buf):
+            # Stop chunks at 1 KiB boundaries because TAR only auto-increments
+            # within them. Tails are padded to a whole word.
+            chunk_size = _CHUNK_SIZE - ((addr + offset) % _CHUNK_SIZE)
+            data = self.padded_page(buf, offset, chunk_size, 4)
+            chunk_size = len(data)
+
+            hasdata = not self.is_erased(data)
+
+            if hasdata and not verify_only:
+                self.program_page(addr + offset, data)
+            elif not verify_only:
+                self.report.pages_skipped += 1
+
+            # Optionally verify the written data
+            if hasdata and policy.check_page() and not self.verify_block(addr + offset, data):
+                return False
+
+            offset += chunk_size
+
+        if policy.mode == "crc" and not self.verify_crc(addr, buf):
+            return False
+        return True
+
+    def read_option_bytes(self) -> int:
+        """Return ``FLASH_OPTCR`` which holds RDP, nWRP and the user option bits."""
+        return self.read_word(_FLASH_OPTCR)
 
-        self.flash_size = (self.dap.read_word(STM32_FLASHSIZE) >> 16) * 1024
+    def write_option_bytes(self, optcr, optcr1=None, timeout=40):
+        """Program ``FLASH_OPTCR`` (and ``FLASH_OPTCR1`` on dual bank parts).
+        Dropping RDP from level 1 to level 0 mass erases the device, so this
+        can take as long as :meth:`erase`."""
+        if self.read_word(_FLASH_OPTCR) & _FLASH_OPTCR_OPTLOCK:
+            self.write_word(_FLASH_OPTKEYR, _FLASH_OPTKEY1, posted=True)
+            self.write_word(_FLASH_OPTKEYR, _FLASH_OPTKEY2, posted=True)
+            if self.read_word(_FLASH_OPTCR) & _FLASH_OPTCR_OPTLOCK:
+                raise RuntimeError("Failed to unlock option bytes")
+        self.flash_wait_ready()
 
-        mcuid = (self.dap.read_word(DAP_DBGMCU_IDCODE) & 0xFFF);
-        if mcuid in STM_DEVICE_NAMES:
-            print(STM_DEVICE_NAMES[mcuid])
-            return mcuid
+        if optcr1 is not None:
+            self.write_word(_FLASH_OPTCR1, optcr1, posted=True)
+        optcr &= _FLASH_OPTCR_MASK
+        self.write_word(_FLASH_OPTCR, optcr, posted=True)
+        self.write_word(_FLASH_OPTCR, optcr | _FLASH_OPTCR_OPTSTRT, posted=True)
+        errors = self.flash_wait_ready(timeout)
+        self.write_word(_FLASH_OPTCR, optcr | _FLASH_OPTCR_OPTLOCK)
+        if errors:
+            raise RuntimeError(f"Option byte write failed, FLASH_SR errors 0x{errors:x}")
 
-        return None
- 
+    def unprotect(self):
+        """Reset read protection to level 0 and clear all sector write
+        protection. Flash is mass erased if it was read protected."""
+        optcr = self.read_option_bytes()
+        wanted = (optcr & ~_FLASH_OPTCR_RDP_MASK) | (_RDP_LEVEL0 << 8) | 0x0FFF0000
+        if optcr & _FLASH_OPTCR_MASK == wanted & _FLASH_OPTCR_MASK:
+            return
+        print("Resetting option bytes...")
+        optcr1 = None
+        if self.sectors and self.sectors[-1][2] & 0x10:
+            optcr1 = self.read_word(_FLASH_OPTCR1) | 0x0FFF0000
+        self.write_option_bytes(wanted, optcr1)
@@ -0,0 +1,106 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_mcu_flasher.verify`
+================================================================================
+
+Verify policies and batched CRC checks of programmed data.
+"""
+
+from . import crc32
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+
+class VerifyPolicy:
+    """How programmed data is checked.
+
+    * ``"none"`` doesn't verify.
+    * ``"sampled"`` reads back a repeatable random ``coverage`` percent of the
+      pages, chosen from ``seed``.
+    * ``"crc"`` compares one CRC32 of everything programmed. SAM parts compute
+      it in the DSU, other families read back and compute it on the host.
+    * ``"full"`` reads back and compares every page.
+    """
+
+    MODES = ("none", "sampled", "crc", "full")
+
+    def __init__(self, mode="full", coverage=100, seed=1):
+        if mode not in VerifyPolicy.MODES:
+            raise ValueError(f"Unknown verify mode {mode}")
+        if not 0 < coverage <= 100:
+            raise ValueError("coverage must be a percentage")
+        self.mode = mode
+        self.coverage = coverage
+        self.seed = seed
+        self._state = 0
+        self.restart()
+
+    def restart(self) -> None:
+        """Start the sample sequence over from ``seed``."""
+        # xorshift32 so the same seed picks the same pages on every platform.
+        self._state = (self.seed & 0xFFFFFFFF) or 1
+
+    def check_page(self) -> bool:
+        """Return True if the next page should be read back."""
+        if self.mode == "full":
+            return True
+        if self.mode != "sampled":
+            return False
+        x = self._state
+        x ^= (x << 13) & 0xFFFFFFFF
+        x ^= x >> 17
+        x ^= (x << 5) & 0xFFFFFFFF
+        self._state = x
+        return x % 10000 < self.coverage * 100
+
+    def __str__(self):
+        if self.mode == "sampled":
+            return f"sampled {self.coverage}% seed {self.seed}"
+        return self.mode
+
+
+VERIFY_NONE = VerifyPolicy("none")
+VERIFY_FULL = VerifyPolicy("full")
+
+
+class CrcVerifier:
+    """Checks a whole image with as few target CRCs as possible. Chunks that
+    continue the previous one extend the running host CRC. A gap checks what
+    was collected so far and starts a new run."""
+
+    def __init__(self, target):
+        self.target = target
+        self.start = None
+        self.end = None
+        self.crc = 0xFFFFFFFF
+        self.failed_address = None
+
+    def add(self, addr, data) -> bool:
+        """Add a programmed chunk. Returns False if a finished run failed."""
+        ok = True
+        if self.start is not None and addr != self.end:
+            ok = self.check()
+        if self.start is None:
+            self.start = self.end = addr
+            self.crc = 0xFFFFFFFF
+        self.crc = crc32(data, self.crc)
+        self.end += len(data)
+        return ok
+
+    def check(self) -> bool:
+        """Compare the current run with the target and start over."""
+        if self.start is None:
+            return True
+        length = self.end - self.start
+        pad = -length % 4
+        crc = self.crc
+        if pad:
+            crc = crc32(b"\xff" * pad, crc)
+        ok = self.target.crc32(self.start, length + pad) == crc
+        if not ok:
+            self.failed_address = self.start
+        self.start = self.end = None
+        return ok
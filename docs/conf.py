@@ -27,7 +27,8 @@ extensions = [
 # Uncomment the below if you use native CircuitPython modules such as
 # digitalio, micropython and busio. List the modules you use. Without it, the
 # autodoc module docs will fail to generate with a warning.
-# autodoc_mock_imports = ["digitalio", "busio"]
+# pyocd is only used on CPython and supervisor only on CircuitPython.
+autodoc_mock_imports = ["pyocd", "supervisor"]
 
 autodoc_preserve_defaults = True
 
@@ -21,7 +21,8 @@ target.target_connect()
 target.select()
 
 print("Erasing... ", end="")
-target.erase()
+# Skips the erase when the board is already blank.
+target.erase_if_needed()
 print(" done.")
 
 start = time.monotonic()
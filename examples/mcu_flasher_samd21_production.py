@@ -0,0 +1,33 @@
+"""Flashes SAMD21 boards back to back. The probe stays connected and each new
+board is picked up as soon as it answers on SWD."""
+
+import board
+import digitalio
+import time
+
+from adafruit_debug_probe import bitbang
+import adafruit_mcu_flasher
+from adafruit_mcu_flasher import sam
+
+BASE_ADDR = 0
+FILE_BOOTLOADER = "bootloader-metro_m0-v3.15.0.bin"
+
+probe = bitbang.BitbangProbe(
+    clk=digitalio.DigitalInOut(board.D12),
+    dio=digitalio.DigitalInOut(board.D11),
+    nreset=digitalio.DigitalInOut(board.D10)
+)
+target = sam.SAM(probe)
+
+while True:
+    print("Waiting for a board...")
+    target.hot_attach()
+    start = time.monotonic()
+    target.select()
+    target.erase_if_needed()
+    target.program_start()
+    with open(FILE_BOOTLOADER, "rb") as f:
+        adafruit_mcu_flasher.write_bin_file(target, f, BASE_ADDR)
+    target.deselect()
+    print(f"Done in {time.monotonic()-start:.1f}s, remove the board")
+    target.wait_for_removal()
@@ -1,31 +1,34 @@
-"""This example tries to flash a SAMD51 over a PyOCD probe but doesn't work
-   with a JLink. JLink errors out on writing the TAR register on the AP."""
+"""This example flashes a SAMD51 over a PyOCD probe. Transfers are batched so
+   CMSIS-DAP probes send them in as few USB packets as possible. JLink doesn't
+   work because it errors out on writing the TAR register on the AP."""
 
-import array
 import logging
-import sys
 import time
 
 from pyocd.core.session import Session
 from pyocd.core.helpers import ConnectHelper
 from adafruit_mcu_flasher import samx5
+from adafruit_mcu_flasher.bin_file import write_bin_file
+from adafruit_mcu_flasher.hex_file import write_hex_file
+from adafruit_mcu_flasher.pyocd_probe import PyocdProbe
 
 logging.basicConfig(level=logging.INFO)
 
 BASE_ADDR = 0
+FILE_BOOTLOADER = "bootloader-metro_m4-v3.15.0.bin"
 
 probe = ConnectHelper.choose_probe()
 session = Session(probe=probe, options={"jlink.device": "ATSAMD51J20"})
 probe.open() # Connects to the probe hardware. Reads capabilities
 print(probe)
 
-# probe.connect() # Initializes the probe's pins to the target.
-target = samx5.SAMx5(probe)
+target = samx5.SAMx5(PyocdProbe(probe))
 target.target_connect()
 target.select()
 
 print("Erasing... ", end="")
-target.erase()
+# Skips the erase when the board is already blank.
+target.erase_if_needed()
 print(" done.")
 
 start = time.monotonic()
@@ -40,4 +43,5 @@ with open(FILE_BOOTLOADER, "rb") as f:
 print(f"Done in {time.monotonic()-start:.1f}s")
 
 target.deselect()
-probe.disconnect()
+target.probe.disconnect()
+probe.close()
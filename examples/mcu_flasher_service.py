@@ -0,0 +1,24 @@
+"""Runs a flashing service with one station per connected pyOCD probe. The
+probes stay open and images stay cached between boards. Send it jobs as JSON
+lines, for example:
+
+    echo '{"id": 1, "station": "0", "image": "firmware.hex"}' | socat - UNIX:/tmp/flasher.sock
+"""
+
+import logging
+
+from pyocd.probe.aggregator import DebugProbeAggregator
+from adafruit_mcu_flasher import samx5
+from adafruit_mcu_flasher.pyocd_probe import PyocdProbe
+from adafruit_mcu_flasher.service import FlashService, ImageCache
+
+logging.basicConfig(level=logging.INFO)
+
+stations = {}
+for index, probe in enumerate(DebugProbeAggregator.get_all_connected_probes()):
+    probe.open()
+    stations[str(index)] = samx5.SAMx5(PyocdProbe(probe))
+    print(index, probe)
+
+service = FlashService(stations, ImageCache(64 * 1024 * 1024))
+service.serve_unix("/tmp/flasher.sock")
@@ -0,0 +1,14 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`mcu_flasher_tools`
+================================================================================
+
+Host side tools for developing :mod:`adafruit_mcu_flasher` on CPython:
+simulated probes and targets, probe trace record and replay, and flashing
+benchmarks. They aren't part of the CircuitPython library bundle.
+"""
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
@@ -0,0 +1,326 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`mcu_flasher_tools.benchmark`
+================================================================================
+
+Flashing benchmarks run against the simulated targets in
+:mod:`mcu_flasher_tools.sim` or against recorded traces. Each workload
+reports probe calls, SWD transfers and bytes on the wire plus a modeled time
+per KiB from a :class:`LatencyProfile`, so changes to the drivers can be
+compared without hardware. Results can be saved as a baseline and later runs
+checked against it. With ``--heap`` each workload also records what a page
+allocates (see :mod:`adafruit_mcu_flasher.heap`) and a page allocating more
+than the baseline's fails the check too. This runs on CPython:
+
+.. code-block:: shell
+
+    python -m mcu_flasher_tools.benchmark --heap --save-baseline base.json
+    python -m mcu_flasher_tools.benchmark --heap --baseline base.json
+"""
+
+import contextlib
+import io
+import json
+import os
+import random
+
+from adafruit_mcu_flasher.bin_file import write_bin_file
+from adafruit_mcu_flasher.heap import HeapMonitor
+from adafruit_mcu_flasher.hex_file import write_hex_file
+from adafruit_mcu_flasher.nrf5x import NRF
+from adafruit_mcu_flasher.sam import SAM
+from adafruit_mcu_flasher.samx5 import SAMx5
+
+from . import sim
+from .trace import ReplayProbe, TraceProbe
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+
+class LatencyProfile:
+    """Cost model for a probe. ``clock_hz`` is the SWD clock and
+    ``call_overhead`` the seconds each probe call costs on top of its bits
+    (a USB round trip or the interpreter overhead of a bit banged probe)."""
+
+    def __init__(self, name, clock_hz, call_overhead):
+        self.name = name
+        self.clock_hz = clock_hz
+        self.call_overhead = call_overhead
+
+    def seconds(self, stats) -> float:
+        """Return the modeled time for a :class:`ProbeStats`."""
+        return stats.wire_bits / self.clock_hz + stats.calls * self.call_overhead
+
+
+PROFILES = {
+    "cmsis-dap": LatencyProfile("cmsis-dap", 4000000, 0.000125),
+    "bitbang": LatencyProfile("bitbang", 100000, 0.00005),
+}
+
+# name: (simulated model, target class, flash address)
+TARGETS = {
+    "samd21": (sim.SimSAMD21, SAM, 0),
+    "samd51": (sim.SimSAMD51, SAMx5, 0),
+    "nrf52": (sim.SimNRF52, NRF, 0),
+}
+
+WORKLOADS = ("erase", "write_bin_file", "verify", "write_hex_file")
+
+
+def make_image(size=64 * 1024, seed=1) -> bytes:
+    """Return a repeatable image of ``size`` bytes that looks like firmware:
+    random data with the last eighth left erased."""
+    rand = random.Random(seed)
+    used = size - size // 8
+    return bytes(rand.getrandbits(8) for _ in range(used)) + b"\xff" * (size - used)
+
+
+def intel_hex(image, addr=0) -> list:
+    """Encode ``image`` at ``addr`` as a list of Intel HEX lines."""
+    lines = []
+    base = None
+    for offset in range(0, len(image), 16):
+        address = addr + offset
+        if address >> 16 != base:
+            base = address >> 16
+            lines.append(_hex_record(4, 0, base.to_bytes(2, "big")))
+        lines.append(_hex_record(0, address & 0xFFFF, image[offset : offset + 16]))
+    lines.append(_hex_record(1, 0, b""))
+    return lines
+
+
+def _hex_record(record_type, address, data) -> bytes:
+    record = bytes((len(data), address >> 8, address & 0xFF, record_type)) + bytes(data)
+    checksum = -sum(record) & 0xFF
+    return b":" + (record + bytes((checksum,))).hex().upper().encode() + b"\n"
+
+
+def _workload(name, target, image, addr):
+    if name == "erase":
+        target.erase()
+    elif name == "write_bin_file":
+        target.program_start()
+        write_bin_file(target, io.BytesIO(image), addr)
+    elif name == "verify":
+        if not target.program_flash(addr, image, verify_only=True):
+            raise RuntimeError("Verify failed")
+    elif name == "write_hex_file":
+        target.erase()
+        target.program_start()
+        write_hex_file(target, intel_hex(image, addr))
+    else:
+        raise ValueError("Unknown workload %s" % name)
+
+
+class _NullOutput:
+    # Drops what the writers print. Buffered output would show up as heap
+    # they hold.
+
+    @staticmethod
+    def write(text):
+        return len(text)
+
+    @staticmethod
+    def flush():
+        pass
+
+
+def run_target(
+    name, image, trace_file=None, replay_file=None, workloads=WORKLOADS, heap=False
+) -> dict:
+    """Run ``workloads`` in order on target ``name`` and return a dict of
+    :class:`ProbeStats` dicts keyed by workload. The simulated target is
+    traced to ``trace_file`` when given. With ``replay_file`` the recorded
+    trace answers instead of the simulator. With ``heap`` each result also
+    has the :class:`HeapMonitor` statistics as ``"heap"``."""
+    model_class, target_class, addr = TARGETS[name]
+    model = None
+    if replay_file is not None:
+        probe = ReplayProbe(replay_file)
+    else:
+        model = model_class()
+        probe = TraceProbe(model.probe, trace_file)
+    target = target_class(probe)
+    if heap:
+        target.heap = HeapMonitor()
+    results = {}
+    with contextlib.redirect_stdout(_NullOutput()):
+        target.target_connect()
+        target.select()
+        for workload in workloads:
+            probe.stats.reset()
+            if heap:
+                target.new_report()
+            _workload(workload, target, image, addr)
+            results[workload] = probe.stats.as_dict()
+            results[workload]["bits"] = probe.stats.wire_bits
+            results[workload]["kib"] = len(image) / 1024
+            if heap:
+                results[workload]["heap"] = target.heap.as_dict()
+    if heap:
+        target.heap.stop()
+    if model is not None and bytes(model.flash[: len(image)]) != image:
+        raise RuntimeError("%s image mismatch after benchmark" % name)
+    return results
+
+
+def modeled(result, profile) -> float:
+    """Return modeled milliseconds per KiB for one workload result."""
+    seconds = (
+        result["bits"] / profile.clock_hz + result["calls"] * profile.call_overhead
+    )
+    return seconds * 1000 / result["kib"]
+
+
+def run(
+    targets=None, size=64 * 1024, trace_dir=None, replay_dir=None, heap=False
+) -> dict:
+    """Run every workload on ``targets`` (all by default) and return results
+    keyed by ``"target/workload"``. Traces are written to, or replayed from,
+    ``<dir>/<target>.trace``. ``heap`` records heap use as :func:`run_target`
+    does."""
+    image = make_image(size)
+    results = {}
+    for name in targets or TARGETS:
+        trace_file = replay_file = None
+        try:
+            if trace_dir is not None:
+                trace_file = open(os.path.join(trace_dir, name + ".trace"), "wb")
+            if replay_dir is not None:
+                replay_file = open(os.path.join(replay_dir, name + ".trace"), "rb")
+            target_results = run_target(name, image, trace_file, replay_file, heap=heap)
+        finally:
+            for file in (trace_file, replay_file):
+                if file is not None:
+                    file.close()
+        for workload, result in target_results.items():
+            results[name + "/" + workload] = result
+    return results
+
+
+def compare(results, baseline, profile, tolerance=0.02) -> list:
+    """Return ``(key, baseline ms/KiB, ms/KiB)`` for each workload that got
+    more than ``tolerance`` slower than ``baseline``."""
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        before = modeled(baseline[key], profile)
+        after = modeled(result, profile)
+        if after > before * (1 + tolerance):
+            regressions.append((key, before, after))
+    return regressions
+
+
+def compare_heap(results, baseline, slack=64) -> list:
+    """Return ``(key, baseline bytes, bytes)`` for each workload whose largest
+    page allocation grew by more than ``slack`` bytes over ``baseline``."""
+    regressions = []
+    for key, result in results.items():
+        if "heap" not in result or "heap" not in baseline.get(key, {}):
+            continue
+        before = baseline[key]["heap"]["page_max"]
+        after = result["heap"]["page_max"]
+        if after > before + slack:
+            regressions.append((key, before, after))
+    return regressions
+
+
+def report_heap(results):
+    print(
+        "%-24s %8s %10s %9s %10s %11s"
+        % ("workload", "pages", "bytes/page", "page max", "high water", "collections")
+    )
+    for key, result in results.items():
+        heap = result["heap"]
+        print(
+            "%-24s %8d %10.0f %9d %10d %11d"
+            % (
+                key,
+                heap["pages"],
+                heap["page_average"],
+                heap["page_max"],
+                heap["high_water"],
+                heap["collections"],
+            )
+        )
+
+
+def report(results, profile, baseline=None):
+    print(
+        "%-24s %8s %9s %10s %9s %8s"
+        % ("workload", "calls", "transfers", "wire bytes", "ms/KiB", "change")
+    )
+    for key, result in results.items():
+        ms = modeled(result, profile)
+        change = ""
+        if baseline and key in baseline:
+            before = modeled(baseline[key], profile)
+            change = "%+.1f%%" % ((ms - before) * 100 / before)
+        print(
+            "%-24s %8d %9d %10d %9.2f %8s"
+            % (
+                key,
+                result["calls"],
+                result["transfers"],
+                result["wire_bytes"],
+                ms,
+                change,
+            )
+        )
+
+
+def main(argv=None) -> int:
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "targets", nargs="*", help="one or more of " + ", ".join(TARGETS)
+    )
+    parser.add_argument("--size", type=int, default=64, help="image size in KiB")
+    parser.add_argument("--profile", choices=list(PROFILES), default="cmsis-dap")
+    parser.add_argument("--record", metavar="DIR", help="write probe traces to DIR")
+    parser.add_argument("--replay", metavar="DIR", help="replay probe traces from DIR")
+    parser.add_argument(
+        "--baseline", metavar="FILE", help="compare against a saved baseline"
+    )
+    parser.add_argument(
+        "--save-baseline", metavar="FILE", help="save results as a baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.02)
+    parser.add_argument("--heap", action="store_true", help="measure page allocations")
+    args = parser.parse_args(argv)
+    for name in args.targets:
+        if name not in TARGETS:
+            parser.error("unknown target " + name)
+
+    results = run(args.targets, args.size * 1024, args.record, args.replay, args.heap)
+    profile = PROFILES[args.profile]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+    report(results, profile, baseline)
+    if args.heap:
+        print()
+        report_heap(results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+    if baseline:
+        regressions = compare(results, baseline, profile, args.tolerance)
+        for key, before, after in regressions:
+            print("%s regressed: %.2f -> %.2f ms/KiB" % (key, before, after))
+        heap_regressions = compare_heap(results, baseline)
+        for key, before, after in heap_regressions:
+            print("%s allocates more per page: %d -> %d bytes" % (key, before, after))
+        if regressions or heap_regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
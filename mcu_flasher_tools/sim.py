@@ -0,0 +1,1096 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`mcu_flasher_tools.sim`
+================================================================================
+
+Simulated debug probe and target models for exercising the flash drivers
+without hardware. :class:`SimProbe` implements the probe calls that
+:class:`adafruit_mcu_flasher.DapTarget` makes, with posted AP reads and TAR
+auto-increment like a real MEM-AP, on top of a :class:`SimMemory` map that the
+target models fill with flash and peripheral registers.
+"""
+
+import binascii
+
+from adafruit_mcu_flasher.stm32 import stm32f4_sectors
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+_DP_IDCODE = 0x00
+_DP_CTRL_STAT = 0x04
+_DP_SELECT = 0x08
+_DP_RDBUFF = 0x0C
+
+_AP_CSW = 0x00
+_AP_TAR = 0x04
+_AP_DRW = 0x0C
+
+
+class SimMemory:
+    """Sparse 32-bit address space made of byte regions and word registers."""
+
+    def __init__(self):
+        self._regions = []
+        self._registers = {}
+        self.faults = 0
+
+    def add_region(self, start, size, fill=0xFF, on_write=None):
+        """Map ``size`` bytes at ``start`` and return the backing bytearray.
+        ``on_write(offset, value, size)`` replaces plain stores when given."""
+        data = bytearray([fill]) * size
+        self._regions.append((start, data, on_write))
+        return data
+
+    def add_register(self, addr, value=0, read=None, write=None):
+        """Map a 32-bit register. Without hooks it simply holds its value."""
+        self._registers[addr] = [value, read, write]
+
+    def __getitem__(self, addr):
+        return self.read(addr)
+
+    def __setitem__(self, addr, value):
+        self._registers[addr][0] = value
+
+    def region(self, addr):
+        """Return ``(start, data, on_write)`` of the region holding ``addr``,
+        or None."""
+        for start, data, on_write in self._regions:
+            if start <= addr < start + len(data):
+                return start, data, on_write
+        return None
+
+    def read(self, addr, size=4) -> int:
+        word_addr = addr & ~3
+        if word_addr in self._registers:
+            value, read, _ = self._registers[word_addr]
+            if read is not None:
+                value = read()
+            lane = (addr & 3) * 8
+            return (value >> lane) & ((1 << (size * 8)) - 1)
+        region = self.region(addr)
+        if region is None:
+            self.faults += 1
+            return 0
+        start, data, _ = region
+        offset = addr - start
+        return int.from_bytes(data[offset : offset + size], "little")
+
+    def write(self, addr, value, size=4):
+        word_addr = addr & ~3
+        if word_addr in self._registers:
+            register = self._registers[word_addr]
+            if size != 4:
+                lane = (addr & 3) * 8
+                mask = ((1 << (size * 8)) - 1) << lane
+                value = (register[0] & ~mask) | ((value << lane) & mask)
+            if register[2] is not None:
+                register[2](value)
+            else:
+                register[0] = value
+            return
+        region = self.region(addr)
+        if region is None:
+            self.faults += 1
+            return
+        start, data, on_write = region
+        if on_write is not None:
+            on_write(addr - start, value, size)
+        else:
+            offset = addr - start
+            data[offset : offset + size] = value.to_bytes(size, "little")
+
+    def is_mapped(self, addr) -> bool:
+        """Return True if ``addr`` is in a region."""
+        return self.region(addr) is not None
+
+    def read_bytes(self, addr, size) -> bytes:
+        """Read a range for checking results, bypassing register hooks."""
+        start, data, _ = self.region(addr)
+        return bytes(data[addr - start : addr - start + size])
+
+
+class SimProbe:
+    """Probe that talks to a :class:`SimMemory` instead of a wire. It has
+    CMSIS-DAP style value match. Set ``read_ap_match`` to None to model a
+    probe without it."""
+
+    class PinGroup:
+        PROTOCOL_PINS = 0
+
+    def __init__(self, memory, idcode=0x2BA01477):
+        self.memory = memory
+        self.idcode = idcode
+        self.connected = False
+        # Set to False to model an empty socket. Every transfer then fails.
+        self.present = True
+        self.transfers = 0
+        self.pins = 0xFF
+        # Target model hooks for nRESET and pin writes.
+        self.on_reset = None
+        self.on_pins = None
+        self._ctrl_stat = 0
+        self._select = 0
+        self._csw = 0
+        self._tar = 0
+        self._rdbuff = 0
+        self.match_retry = 0
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def reset(self):
+        if self.on_reset is not None:
+            self.on_reset()
+
+    def set_clock(self, frequency):
+        pass
+
+    def swj_sequence(self, length, bits):
+        pass
+
+    def write_pins(self, group, mask, value):
+        old = self.pins
+        self.pins = (old & ~mask) | (value & mask)
+        if self.on_pins is not None:
+            self.on_pins(old, self.pins)
+
+    def _transfer(self):
+        if not self.present:
+            raise OSError("No ACK from target")
+        self.transfers += 1
+
+    def read_dp(self, addr) -> int:
+        self._transfer()
+        if addr == _DP_IDCODE:
+            return self.idcode
+        if addr == _DP_CTRL_STAT:
+            # Power up requests (bits 30 and 28) are acked immediately.
+            return self._ctrl_stat | ((self._ctrl_stat & 0x50000000) << 1)
+        if addr == _DP_RDBUFF:
+            return self._rdbuff
+        return 0
+
+    def write_dp(self, addr, value):
+        self._transfer()
+        if addr == _DP_CTRL_STAT:
+            self._ctrl_stat = value
+        elif addr == _DP_SELECT:
+            self._select = value
+
+    def _size(self):
+        return 1 << (self._csw & 0x7)
+
+    def _increment(self):
+        if self._csw & 0x30:
+            # TAR only auto-increments within a 1 KiB boundary.
+            self._tar = (self._tar & ~0x3FF) | ((self._tar + self._size()) & 0x3FF)
+
+    def _ap_read(self, addr) -> int:
+        if addr == _AP_CSW:
+            return self._csw
+        if addr == _AP_TAR:
+            return self._tar
+        if addr == _AP_DRW:
+            size = self._size()
+            value = self.memory.read(self._tar, size) << ((self._tar & 3) * 8)
+            self._increment()
+            return value & 0xFFFFFFFF
+        return 0
+
+    def read_ap(self, addr) -> int:
+        # AP reads are posted. The value comes back with the next AP read or
+        # from RDBUFF.
+        self._transfer()
+        value = self._rdbuff
+        self._rdbuff = self._ap_read(addr)
+        return value
+
+    def write_ap(self, addr, value):
+        self._transfer()
+        if addr == _AP_CSW:
+            self._csw = value
+        elif addr == _AP_TAR:
+            self._tar = value
+        elif addr == _AP_DRW:
+            size = self._size()
+            lane = (self._tar & 3) * 8
+            self.memory.write(
+                self._tar, (value >> lane) & ((1 << (size * 8)) - 1), size
+            )
+            self._increment()
+
+    def transfer_configure(self, idle_cycles, wait_retry, match_retry):
+        # pylint: disable=unused-argument
+        self.match_retry = match_retry
+
+    def read_ap_match(self, addr, mask, value):
+        # Like CMSIS-DAP: post the read then read until the posted value
+        # matches, then read RDBUFF in the same request.
+        self.read_ap(addr)
+        for _ in range(self.match_retry + 1):
+            if self.read_ap(addr) & mask == value:
+                return self.read_dp(_DP_RDBUFF)
+        return None
+
+    def read_ap_multiple(self, addr, count=1) -> list:
+        return [self.read_ap(addr) for _ in range(count)]
+
+    def write_ap_multiple(self, addr, values):
+        for value in values:
+            self.write_ap(addr, value)
+
+
+class SimMultiDropBus:
+    """An SWD multi-drop bus of target models. ``targets`` maps each model's
+    TARGETSEL value to the model. :attr:`probe` drives the bus: after a line
+    reset no target answers until a TARGETSEL write selects one. Each model
+    keeps its own DP and AP state. nRESET and the other pins are shared. A
+    TARGETSEL sent as a DP write gets no ACK, like on a real bus."""
+
+    class PinGroup:
+        PROTOCOL_PINS = 0
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.probe = self
+        self.selected = None
+        self.selections = 0
+        self._line_reset = False
+
+    def _probe(self):
+        if self.selected is None:
+            raise OSError("No ACK from target")
+        self._line_reset = False
+        return self.targets[self.selected].probe
+
+    def connect(self):
+        for target in self.targets.values():
+            target.probe.connect()
+
+    def disconnect(self):
+        for target in self.targets.values():
+            target.probe.disconnect()
+
+    def reset(self):
+        for target in self.targets.values():
+            target.probe.reset()
+
+    def set_clock(self, frequency):
+        pass
+
+    def swj_sequence(self, length, bits):
+        if length >= 50 and bits & ((1 << 50) - 1) == (1 << 50) - 1:
+            self.selected = None
+            self._line_reset = True
+
+    def write_pins(self, group, mask, value):
+        for target in self.targets.values():
+            target.probe.write_pins(group, mask, value)
+
+    def read_dp(self, addr) -> int:
+        return self._probe().read_dp(addr)
+
+    def write_dp(self, addr, value):
+        self._probe().write_dp(addr, value)
+
+    def swd_sequence(self, sequences) -> list:
+        """Decode a raw TARGETSEL write. Targets that don't match it stay off
+        the bus. Nothing drives the line when the probe reads, so it reads
+        ones."""
+        sent = [sequence for sequence in sequences if len(sequence) == 2]
+        if self._line_reset and len(sent) >= 2 and sent[0] == (8, 0x99):
+            self._line_reset = False
+            count, bits = sent[1]
+            value = bits & 0xFFFFFFFF
+            parity = bin(value).count("1") & 1
+            if count == 33 and bits >> 32 == parity and value in self.targets:
+                self.selected = value
+                self.selections += 1
+        return [(1 << count) - 1 for count, *bits in sequences if not bits]
+
+    def read_ap(self, addr) -> int:
+        return self._probe().read_ap(addr)
+
+    def write_ap(self, addr, value):
+        self._probe().write_ap(addr, value)
+
+    def read_ap_multiple(self, addr, count=1) -> list:
+        return self._probe().read_ap_multiple(addr, count)
+
+    def write_ap_multiple(self, addr, values):
+        self._probe().write_ap_multiple(addr, values)
+
+    def transfer_configure(self, idle_cycles, wait_retry, match_retry):
+        for target in self.targets.values():
+            target.probe.transfer_configure(idle_cycles, wait_retry, match_retry)
+
+    def read_ap_match(self, addr, mask, value):
+        return self._probe().read_ap_match(addr, mask, value)
+
+
+class SimDebugProbe:
+    """Stand-in for a pyOCD CMSIS-DAP ``DebugProbe`` on top of a
+    :class:`SimProbe`, for use with
+    :class:`adafruit_mcu_flasher.pyocd_probe.PyocdProbe`. AP reads return
+    their own value instead of being posted. Transfers are queued until a read
+    needs its value or :meth:`flush` is called. :attr:`flushes` counts the
+    round trips a USB probe would make."""
+
+    class PinGroup:
+        PROTOCOL_PINS = 0
+
+    def __init__(self, probe):
+        self.sim = probe
+        self.flushes = 0
+        self._queue = []
+
+    def flush(self):
+        if self._queue:
+            self.flushes += 1
+            queue = self._queue
+            self._queue = []
+            for operation in queue:
+                operation()
+
+    def _defer(self, operation, now):
+        result = []
+        self._queue.append(lambda: result.append(operation()))
+
+        def value():
+            if not result:
+                self.flush()
+            return result[0]
+
+        return value() if now else value
+
+    def connect(self, protocol=None):  # pylint: disable=unused-argument
+        self.sim.connect()
+
+    def disconnect(self):
+        self.flush()
+        self.sim.disconnect()
+
+    def reset(self):
+        self.flush()
+        self.sim.reset()
+
+    def set_clock(self, frequency):
+        self.flush()
+        self.sim.set_clock(frequency)
+
+    def swj_sequence(self, length, bits):
+        self.flush()
+        self.sim.swj_sequence(length, bits)
+
+    def write_pins(self, group, mask, value):
+        self.flush()
+        self.sim.write_pins(group, mask, value)
+
+    def read_dp(self, addr, now=True):
+        return self._defer(lambda: self.sim.read_dp(addr), now)
+
+    def write_dp(self, addr, value):
+        self._queue.append(lambda: self.sim.write_dp(addr, value))
+
+    def _read_ap(self, addr, count):
+        # What the probe firmware does: post the reads and collect the last
+        # one from RDBUFF.
+        sim = self.sim
+        sim.read_ap(addr)
+        values = [sim.read_ap(addr) for _ in range(count - 1)]
+        values.append(sim.read_dp(_DP_RDBUFF))
+        return values
+
+    def read_ap(self, addr, now=True):
+        return self._defer(lambda: self._read_ap(addr, 1)[0], now)
+
+    def write_ap(self, addr, value):
+        self._queue.append(lambda: self.sim.write_ap(addr, value))
+
+    def read_ap_multiple(self, addr, count=1, now=True):
+        return self._defer(lambda: self._read_ap(addr, count), now)
+
+    def write_ap_multiple(self, addr, values):
+        values = list(values)
+        self._queue.append(lambda: self.sim.write_ap_multiple(addr, values))
+
+
+class SimTarget:
+    """Base for target models. ``busy_polls`` is how many status reads keep
+    reporting busy after each flash operation."""
+
+    def __init__(self, busy_polls=2, idcode=0x2BA01477):
+        self.memory = SimMemory()
+        self.probe = SimProbe(self.memory, idcode)
+        self.busy_polls = busy_polls
+        self._busy = 0
+        # Core debug state. in_reset models a reset extension that hides the
+        # halt until it is released.
+        self.halted = False
+        self.in_reset = False
+        self._dhcsr = 0
+        self._demcr = 0
+        # r0-r12, sp, lr, pc and xPSR as numbered by DCRSR.
+        self.core = [0] * 17
+        self._dcrdr = 0
+        # DHCSR reads left until a running routine stops, None when idle.
+        self._running = None
+        memory = self.memory
+        memory.add_register(0xE000EDF0, read=self._read_dhcsr, write=self._write_dhcsr)
+        memory.add_register(0xE000EDF4, write=self._write_dcrsr)
+        memory.add_register(
+            0xE000EDF8, read=lambda: self._dcrdr, write=self._write_dcrdr
+        )
+        memory.add_register(
+            0xE000EDFC, read=lambda: self._demcr, write=self._write_demcr
+        )
+        memory.add_register(0xE000ED0C, write=self._write_aircr)
+        self.probe.on_reset = self.reset
+
+    def reset(self):
+        """System reset. The core only stays halted with vector catch set."""
+        self._dhcsr &= ~0x2
+        self.halted = bool(self._demcr & 0x1)
+        self._running = None
+
+    def _read_dhcsr(self):
+        if self._running is not None:
+            if self._running:
+                self._running -= 1
+            else:
+                self._running = None
+                self.halted = True
+        value = self._dhcsr
+        if self.halted and not self.in_reset:
+            value |= 0x30000  # S_HALT | S_REGRDY
+        return value
+
+    def _write_dhcsr(self, value):
+        if value >> 16 == 0xA05F:
+            was_halted = self.halted
+            self._dhcsr = value & 0xF
+            self.halted = bool(value & 0x2)
+            if was_halted and not self.halted and value & 0x1:
+                self._run()
+
+    def _write_dcrsr(self, value):
+        reg = value & 0x1F
+        if reg >= len(self.core):
+            return
+        if value & 0x10000:  # REGWnR
+            self.core[reg] = self._dcrdr
+        else:
+            self._dcrdr = self.core[reg]
+
+    def _write_dcrdr(self, value):
+        self._dcrdr = value
+
+    def _run(self):
+        """Resume the core. A Thumb ``pc`` in RAM or flash executes until it
+        stops on a ``bkpt``, which the core reports as halted a little later.
+        Anything else runs until halted."""
+        core = self.core
+        if not core[16] & 0x01000000 or not self.memory.is_mapped(core[15]):
+            return
+        count = self._execute()
+        if count is not None:
+            # Take longer for longer routines, like the real core.
+            self._running = self.busy_polls + count // 1000000
+
+    def _execute(self, limit=1 << 26):
+        """Interpret Thumb code from ``pc`` until a ``bkpt`` and return the
+        number of instructions run. Only the few instructions that
+        :data:`adafruit_mcu_flasher.crc_stub.CRC32_STUB` uses are decoded.
+        Returns None on anything else, leaving the core running."""
+        # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+        regs = self.core
+        memory = self.memory
+        read = memory.read
+        code = {}
+        zero = False
+        # The region of the last ldrb, read directly for speed.
+        base = end = 0
+        data = b""
+        here = regs[15] & ~1
+        for count in range(limit):
+            insn = code.get(here)
+            if insn is None:
+                if not memory.is_mapped(here):
+                    return None
+                insn = code[here] = read(here, 2)
+            top = insn >> 11
+            if top == 0b00000:  # lsls rd, rm, #imm5
+                value = (regs[(insn >> 3) & 7] << ((insn >> 6) & 0x1F)) & 0xFFFFFFFF
+            elif top == 0b00001:  # lsrs rd, rm, #imm5
+                value = regs[(insn >> 3) & 7] >> (((insn >> 6) & 0x1F) or 32)
+            elif insn >> 9 == 0b0001100:  # adds rd, rn, rm
+                value = (regs[(insn >> 3) & 7] + regs[(insn >> 6) & 7]) & 0xFFFFFFFF
+            elif top == 0b00100:  # movs rd, #imm8
+                regs[(insn >> 8) & 7] = insn & 0xFF
+                zero = not insn & 0xFF
+                here += 2
+                continue
+            elif top == 0b00110:  # adds rd, #imm8
+                dest = (insn >> 8) & 7
+                regs[dest] = (regs[dest] + (insn & 0xFF)) & 0xFFFFFFFF
+                zero = not regs[dest]
+                here += 2
+                continue
+            elif insn >> 6 == 0b0100000000:  # ands rd, rm
+                value = regs[insn & 7] & regs[(insn >> 3) & 7]
+            elif insn >> 6 == 0b0100000001:  # eors rd, rm
+                value = regs[insn & 7] ^ regs[(insn >> 3) & 7]
+            elif insn >> 6 == 0b0100001010:  # cmp rn, rm
+                zero = regs[insn & 7] == regs[(insn >> 3) & 7]
+                here += 2
+                continue
+            elif insn >> 9 == 0b0101100:  # ldr rd, [rn, rm]
+                regs[insn & 7] = read(regs[(insn >> 3) & 7] + regs[(insn >> 6) & 7])
+                here += 2
+                continue
+            elif top == 0b01111:  # ldrb rd, [rn, #imm5]
+                addr = regs[(insn >> 3) & 7] + ((insn >> 6) & 0x1F)
+                if not base <= addr < end:
+                    region = memory.region(addr)
+                    if region is None:
+                        regs[insn & 7] = read(addr, 1)
+                        here += 2
+                        continue
+                    base, data, _ = region
+                    end = base + len(data)
+                regs[insn & 7] = data[addr - base]
+                here += 2
+                continue
+            elif top == 0b10100:  # adr rd, imm8
+                regs[(insn >> 8) & 7] = ((here + 4) & ~3) + (insn & 0xFF) * 4
+                here += 2
+                continue
+            elif insn >> 9 == 0b1101000:  # beq / bne
+                if zero != bool(insn & 0x100):
+                    here += 4 + ((insn & 0xFF) ^ 0x80) * 2 - 0x100
+                else:
+                    here += 2
+                continue
+            elif top == 0b11100:  # b
+                here += 4 + ((insn & 0x7FF) ^ 0x400) * 2 - 0x800
+                continue
+            elif insn >> 8 == 0xBE:  # bkpt
+                regs[15] = here
+                return count
+            else:
+                return None
+            regs[insn & 7] = value
+            zero = not value
+            here += 2
+        return None
+
+    def _write_demcr(self, value):
+        self._demcr = value
+
+    def _write_aircr(self, value):
+        if value == 0x05FA0004:  # SYSRESETREQ
+            self.reset()
+
+    def _start(self):
+        self._busy = self.busy_polls
+
+    def _ready(self) -> bool:
+        if self._busy:
+            self._busy -= 1
+            return False
+        return True
+
+
+def _program(data, offset, value, size):
+    # Flash programming can only clear bits.
+    for i in range(size):
+        data[offset + i] &= (value >> (8 * i)) & 0xFF
+
+
+def _crc32(data, crc=0xFFFFFFFF):
+    """CRC-32 without the final inversion, like the SAM DSU computes it."""
+    return binascii.crc32(data, crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+class _SimDSU:
+    """SAM Device Service Unit with chip erase, CRC32 and the security bit."""
+
+    def __init__(self, target, did):
+        self.target = target
+        self.protected = False
+        self.statusa = 0
+        self.addr = 0
+        self.length = 0
+        self.data = 0
+        memory = target.memory
+        memory.add_register(
+            0x41002100, read=self._read_ctrl_status, write=self._write_ctrl
+        )
+        memory.add_register(0x41002104, write=self._write_addr)
+        memory.add_register(0x41002108, write=self._write_length)
+        memory.add_register(0x4100210C, read=lambda: self.data, write=self._write_data)
+        memory.add_register(0x41002118, did)
+        target.probe.on_pins = self._pins
+
+    def _pins(self, old, new):
+        # Releasing nRESET (0x10) while SWCLK (0x01) is low starts a reset
+        # extension: the CPU stays in reset until CRSTEXT is cleared.
+        if not new & 0x10:
+            self.target.reset()
+        elif not old & 0x10 and not new & 0x01:
+            self.target.in_reset = True
+            self.statusa |= 0x02  # CRSTEXT
+
+    def _read_ctrl_status(self):
+        return (self.statusa << 8) | ((1 if self.protected else 0) << 16)
+
+    def _write_ctrl(self, value):
+        # STATUSA flags are write one to clear.
+        self.statusa &= ~((value >> 8) & 0x1F)
+        if value & 0x200:
+            self.target.in_reset = False
+        if value & 0x10:  # CE
+            self.target.chip_erase()
+            self.protected = False
+            self.statusa |= 0x01  # DONE
+        elif value & 0x04:  # CRC
+            data = self.target.memory.read_bytes(self.addr, self.length)
+            self.data = _crc32(data, self.data)
+            self.statusa |= 0x01
+
+    def _write_addr(self, value):
+        self.addr = value & ~0x3
+
+    def _write_length(self, value):
+        self.length = value & ~0x3
+
+    def _write_data(self, value):
+        self.data = value
+
+
+class SimSAMD21(SimTarget):
+    """SAMD21 model with the NVMCTRL page buffer, automatic and manual page
+    writes, row erase, region locks, the user row and the DSU.
+
+    ``locks`` has a bit set for each of the 16 locked regions. A reset loads
+    it from the user row's LOCK field, UR and LR change it until the next
+    reset. Erasing or writing a locked region sets LOCKE and changes nothing,
+    like the part."""
+
+    PAGE_SIZE = 64
+    ROW_SIZE = 256
+    REGIONS = 16
+
+    def __init__(self, did=0x10010305, flash_kib=256, busy_polls=2):
+        super().__init__(busy_polls)
+        self.flash = self.memory.add_region(
+            0, flash_kib * 1024, on_write=self._flash_write
+        )
+        self.user_row = self.memory.add_region(
+            0x804000, self.ROW_SIZE, on_write=self._user_write
+        )
+        # BOOTPROT off, region locks off.
+        self.user_row[0:8] = b"\xff\xc7\xe0\xd8\x5d\xfc\xff\xff"
+        self.memory.add_region(0x20000000, 32 * 1024, fill=0)
+        self.dsu = _SimDSU(self, did)
+        self.page_buffer = bytearray(b"\xff" * self.PAGE_SIZE)
+        self.commands = []
+        self._ctrlb = 0
+        self._addr = 0
+        self._status = 0
+        self.locks = 0
+        self.reset()
+        pages = flash_kib * 1024 // self.PAGE_SIZE
+        memory = self.memory
+        memory.add_register(0x41004000, write=self._command)
+        memory.add_register(
+            0x41004004, read=lambda: self._ctrlb, write=self._write_ctrlb
+        )
+        memory.add_register(0x41004008, (3 << 16) | pages)
+        memory.add_register(0x41004014, read=lambda: 1 if self._ready() else 0)
+        memory.add_register(0x41004018, read=lambda: self._status)
+        memory.add_register(0x4100401C, read=lambda: self._addr, write=self._write_addr)
+
+    def reset(self):
+        super().reset()
+        # LOCK bits are 1 for unlocked regions.
+        self.locks = ~int.from_bytes(self.user_row[6:8], "little") & 0xFFFF
+
+    def _write_ctrlb(self, value):
+        self._ctrlb = value
+
+    def _write_addr(self, value):
+        self._addr = value
+
+    def _region(self, addr) -> int:
+        return addr // (len(self.flash) // self.REGIONS)
+
+    def _locked(self, addr) -> bool:
+        if self.locks >> self._region(addr) & 1:
+            self._status |= 0x8  # LOCKE
+            return True
+        return False
+
+    def chip_erase(self):
+        self.flash[:] = b"\xff" * len(self.flash)
+
+    def _load(self, data, offset, value, size):
+        page = offset - offset % self.PAGE_SIZE
+        self.page_buffer[offset - page : offset - page + size] = value.to_bytes(
+            size, "little"
+        )
+        self._status |= 0x2  # LOAD
+        # Automatic page write triggers on the last word of the page.
+        if not self._ctrlb & 0x80 and (offset + size) % self.PAGE_SIZE == 0:
+            self._write_page(data, page)
+
+    def _write_page(self, data, page):
+        if data is not self.flash or not self._locked(page):
+            for i in range(self.PAGE_SIZE):
+                data[page + i] &= self.page_buffer[i]
+        self.page_buffer[:] = b"\xff" * self.PAGE_SIZE
+        self._status &= ~0x2
+        self._start()
+
+    def _flash_write(self, offset, value, size):
+        self._addr = offset >> 1
+        self._load(self.flash, offset, value, size)
+
+    def _user_write(self, offset, value, size):
+        self._load(self.user_row, offset, value, size)
+
+    def _command(self, value):
+        if value >> 8 != 0xA5:
+            self._status |= 0x4  # PROGE
+            return
+        command = value & 0x7F
+        self.commands.append(command)
+        addr = self._addr * 2
+        if command == 0x02:  # ER
+            row = addr - addr % self.ROW_SIZE
+            if not self._locked(row):
+                self.flash[row : row + self.ROW_SIZE] = b"\xff" * self.ROW_SIZE
+        elif command == 0x04:  # WP
+            self._write_page(self.flash, addr - addr % self.PAGE_SIZE)
+        elif command == 0x05:  # EAR
+            self.user_row[:] = b"\xff" * len(self.user_row)
+        elif command == 0x06:  # WAP
+            self._write_page(self.user_row, (addr - 0x804000) & ~(self.PAGE_SIZE - 1))
+        elif command == 0x40:  # LR
+            self.locks |= 1 << self._region(addr)
+        elif command == 0x41:  # UR
+            self.locks &= ~(1 << self._region(addr))
+        elif command == 0x44:  # PBC
+            self.page_buffer[:] = b"\xff" * self.PAGE_SIZE
+        self._start()
+
+
+class SimSAMD51(SimTarget):
+    """SAMD51 model with manual page and quad word writes, block erase, the
+    user page and the DSU."""
+
+    PAGE_SIZE = 512
+    BLOCK_SIZE = 8192
+
+    def __init__(self, did=0x60060004, flash_kib=1024, busy_polls=2):
+        super().__init__(busy_polls)
+        self.flash = self.memory.add_region(
+            0, flash_kib * 1024, on_write=self._flash_write
+        )
+        self.user_row = self.memory.add_region(
+            0x804000, self.PAGE_SIZE, on_write=self._user_write
+        )
+        self.user_row[0:8] = b"\x39\x92\x9a\xfe\x80\xff\xec\xae"
+        self.memory.add_region(0x20000000, 192 * 1024, fill=0)
+        self.dsu = _SimDSU(self, did)
+        self.page_buffer = bytearray(b"\xff" * self.PAGE_SIZE)
+        self.commands = []
+        self._ctrla = 0x0004
+        self._addr = 0
+        self._intflag = 0
+        pages = flash_kib * 1024 // self.PAGE_SIZE
+        memory = self.memory
+        memory.add_register(
+            0x41004000, read=lambda: self._ctrla, write=self._write_ctrla
+        )
+        memory.add_register(0x41004004, write=self._command)
+        memory.add_register(0x41004008, (6 << 16) | pages)
+        memory.add_register(
+            0x41004010, read=self._read_intflag_status, write=self._write_intflag
+        )
+        memory.add_register(0x41004014, read=lambda: self._addr, write=self._write_addr)
+        memory.add_register(0x41004018, 0)
+
+    def _write_ctrla(self, value):
+        self._ctrla = value & 0xFFFF
+
+    def _write_addr(self, value):
+        self._addr = value
+
+    def _read_intflag_status(self):
+        ready = 1 if self._ready() else 0
+        return self._intflag | (ready << 16)
+
+    def _write_intflag(self, value):
+        self._intflag &= ~(value & 0xFFFF)
+
+    def chip_erase(self):
+        self.flash[:] = b"\xff" * len(self.flash)
+
+    def _load(self, base, offset, value, size):
+        self._addr = base + offset
+        page_offset = offset % self.PAGE_SIZE
+        self.page_buffer[page_offset : page_offset + size] = value.to_bytes(
+            size, "little"
+        )
+
+    def _flash_write(self, offset, value, size):
+        self._load(0, offset, value, size)
+
+    def _user_write(self, offset, value, size):
+        self._load(0x804000, offset, value, size)
+
+    def _region(self, addr):
+        if addr >= 0x804000:
+            return self.user_row, addr - 0x804000
+        return self.flash, addr
+
+    def _commit(self, addr, size):
+        data, offset = self._region(addr)
+        offset -= offset % size
+        start = offset % self.PAGE_SIZE
+        for i in range(size):
+            data[offset + i] &= self.page_buffer[start + i]
+        self.page_buffer[start : start + size] = b"\xff" * size
+
+    def _command(self, value):
+        if value >> 8 != 0xA5:
+            self._intflag |= 0x4  # PROGE
+            return
+        command = value & 0x7F
+        self.commands.append(command)
+        data, offset = self._region(self._addr)
+        if command == 0x00:  # EP
+            offset -= offset % self.PAGE_SIZE
+            data[offset : offset + self.PAGE_SIZE] = b"\xff" * self.PAGE_SIZE
+        elif command == 0x01:  # EB
+            offset -= offset % self.BLOCK_SIZE
+            data[offset : offset + self.BLOCK_SIZE] = b"\xff" * self.BLOCK_SIZE
+        elif command == 0x03:  # WP
+            self._commit(self._addr, self.PAGE_SIZE)
+        elif command == 0x04:  # WQW
+            self._commit(self._addr, 16)
+        elif command == 0x15:  # PBC
+            self.page_buffer[:] = b"\xff" * self.PAGE_SIZE
+        self._intflag |= 0x1  # DONE
+        self._start()
+
+
+_NRF_NVMC = 0x4001E000
+
+
+class SimNRF52(SimTarget):
+    """nRF52 model with NVMC write/erase enables, page erase, erase all and
+    UICR."""
+
+    def __init__(self, part=0x52840, variant=b"AAD0", flash_kib=1024, busy_polls=2):
+        super().__init__(busy_polls)
+        self.flash = self.memory.add_region(
+            0, flash_kib * 1024, on_write=self._flash_write
+        )
+        self.uicr = self.memory.add_region(0x10001000, 0x400, on_write=self._uicr_write)
+        self.memory.add_region(0x20000000, 256 * 1024, fill=0)
+        self.config = 0
+        memory = self.memory
+        memory.add_register(0x10000010, 4096)
+        memory.add_register(0x10000014, flash_kib // 4)
+        memory.add_register(0x10000100, part)
+        memory.add_register(0x10000104, int.from_bytes(variant, "big"))
+        memory.add_register(0x10000110, flash_kib)
+        memory.add_register(_NRF_NVMC + 0x400, read=lambda: 1 if self._ready() else 0)
+        memory.add_register(_NRF_NVMC + 0x408, read=lambda: 1 if self._ready() else 0)
+        memory.add_register(
+            _NRF_NVMC + 0x504, read=lambda: self.config, write=self._write_config
+        )
+        memory.add_register(_NRF_NVMC + 0x508, write=self._erase_page)
+        memory.add_register(_NRF_NVMC + 0x50C, write=self._erase_all)
+        memory.add_register(_NRF_NVMC + 0x514, write=self._erase_uicr)
+
+    def _write_config(self, value):
+        self.config = value & 0x3
+
+    def _flash_write(self, offset, value, size):
+        if self.config & 0x1:
+            _program(self.flash, offset, value, size)
+            self._start()
+        else:
+            self.memory.faults += 1
+
+    def _uicr_write(self, offset, value, size):
+        if self.config & 0x1:
+            _program(self.uicr, offset, value, size)
+            self._start()
+        else:
+            self.memory.faults += 1
+
+    def _erase_page(self, value):
+        if self.config & 0x2:
+            page = value - value % 4096
+            self.flash[page : page + 4096] = b"\xff" * 4096
+            self._start()
+
+    def _erase_all(self, value):
+        if self.config & 0x2 and value & 1:
+            self.flash[:] = b"\xff" * len(self.flash)
+            self.uicr[:] = b"\xff" * len(self.uicr)
+            self._start()
+
+    def _erase_uicr(self, value):
+        if self.config & 0x2 and value & 1:
+            self.uicr[:] = b"\xff" * len(self.uicr)
+            self._start()
+
+
+_STM32_FLASH_START = 0x08000000
+_STM32_FLASH_REGS = 0x40023C00
+_STM32_KEY1 = 0x45670123
+_STM32_KEY2 = 0xCDEF89AB
+_STM32_OPTKEY1 = 0x08192A3B
+_STM32_OPTKEY2 = 0x4C5D6E7F
+
+
+class SimSTM32F4(SimTarget):
+    """STM32F4 model with an FPEC that enforces the key sequence, PSIZE and
+    program/erase modes."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, mcuid=0x413, flash_kib=1024, busy_polls=2):
+        super().__init__(busy_polls)
+        self.sectors = stm32f4_sectors(
+            flash_kib * 1024, mcuid == 0x419 and flash_kib > 1024
+        )
+        self.flash = self.memory.add_region(
+            _STM32_FLASH_START, flash_kib * 1024, on_write=self._flash_write
+        )
+        self.memory.add_region(0x20000000, 128 * 1024, fill=0)
+
+        self._keys = 0
+        self._optkeys = 0
+        self._cr = 0x80000000
+        self._sr = 0
+        self.optcr = 0x0FFFAAED
+        self.optcr1 = 0x0FFF0000
+
+        memory = self.memory
+        memory.add_register(0xE0042000, 0x10000000 | mcuid)
+        memory.add_register(0x1FFF7A20, flash_kib << 16)
+        memory.add_register(_STM32_FLASH_REGS)
+        memory.add_register(_STM32_FLASH_REGS + 0x04, write=self._write_keyr)
+        memory.add_register(_STM32_FLASH_REGS + 0x08, write=self._write_optkeyr)
+        memory.add_register(
+            _STM32_FLASH_REGS + 0x0C, read=self._read_sr, write=self._write_sr
+        )
+        memory.add_register(
+            _STM32_FLASH_REGS + 0x10, read=lambda: self._cr, write=self._write_cr
+        )
+        memory.add_register(
+            _STM32_FLASH_REGS + 0x14, read=self._read_optcr, write=self._write_optcr
+        )
+        memory.add_register(
+            _STM32_FLASH_REGS + 0x18, read=lambda: self.optcr1, write=self._write_optcr1
+        )
+
+    def _start(self):
+        super()._start()
+        self._sr |= 0x1  # EOP
+
+    def _read_sr(self):
+        if not self._ready():
+            return self._sr | 0x10000
+        return self._sr
+
+    def _write_sr(self, value):
+        self._sr &= ~(value & 0x1F3)
+
+    def _write_keyr(self, value):
+        if self._keys == 0 and value == _STM32_KEY1:
+            self._keys = 1
+        elif self._keys == 1 and value == _STM32_KEY2:
+            self._keys = 0
+            self._cr &= ~0x80000000
+        else:
+            # A wrong key locks the FPEC until reset.
+            self._keys = -1
+
+    def _write_cr(self, value):
+        if self._cr & 0x80000000:
+            return
+        if self._busy:
+            self._sr |= 0x80  # PGSERR
+            return
+        self._cr = value & 0x8101FFFF
+        if value & 0x10000:  # STRT
+            self._cr &= ~0x10000
+            if value & 0x2:  # SER
+                snb = (value >> 3) & 0x1F
+                for addr, size, number in self.sectors:
+                    if number == snb:
+                        self._erase(addr, size)
+            elif value & 0x8004:  # MER / MER1
+                for addr, size, number in self.sectors:
+                    if (value & 0x4 and not number & 0x10) or (
+                        value & 0x8000 and number & 0x10
+                    ):
+                        self._erase(addr, size)
+            else:
+                self._sr |= 0x80
+            self._start()
+
+    def _erase(self, addr, size):
+        offset = addr - _STM32_FLASH_START
+        self.flash[offset : offset + size] = b"\xff" * size
+
+    def _flash_write(self, offset, value, size):
+        if self._cr & 0x80000001 != 0x1:
+            self._sr |= 0x80  # PGSERR
+            return
+        if size != 1 << ((self._cr >> 8) & 0x3):
+            self._sr |= 0x40  # PGPERR
+            return
+        for i in range(size):
+            self.flash[offset + i] &= (value >> (8 * i)) & 0xFF
+        self._start()
+
+    def _write_optkeyr(self, value):
+        if self._optkeys == 0 and value == _STM32_OPTKEY1:
+            self._optkeys = 1
+        elif self._optkeys == 1 and value == _STM32_OPTKEY2:
+            self._optkeys = 2
+        else:
+            self._optkeys = -1
+
+    def _read_optcr(self):
+        return (self.optcr & ~0x3) | (0 if self._optkeys == 2 else 0x1)
+
+    def _write_optcr(self, value):
+        if self._optkeys != 2:
+            return
+        if value & 0x2:  # OPTSTRT
+            was_protected = (self.optcr >> 8) & 0xFF != 0xAA
+            self.optcr = value & 0x0FFFFFEC
+            if was_protected and (value >> 8) & 0xFF == 0xAA:
+                self.flash[:] = b"\xff" * len(self.flash)
+            self._start()
+        if value & 0x1:
+            self._optkeys = 0
+
+    def _write_optcr1(self, value):
+        if self._optkeys == 2:
+            self.optcr1 = value & 0x0FFF0000
@@ -0,0 +1,416 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`mcu_flasher_tools.trace`
+================================================================================
+
+Record and replay probe traffic. :class:`TraceProbe` wraps any probe and logs
+every call with its arguments, results and duration to a compact binary file.
+:class:`ReplayProbe` plays such a file back in place of a probe. Both keep
+:class:`ProbeStats` so flashing runs can be compared.
+
+The file starts with ``MCUT`` and a version byte, followed by one record per
+call: a ``<BBII`` header of operation, register, count and duration in
+microseconds, then ``count`` little endian words of data (values written or
+results read). ``swj_sequence`` stores its bits as one 64-bit word and
+``write_pins`` stores the mask and value, ``transfer_configure`` its three
+settings and ``read_ap_match`` the mask, value, whether it matched and the
+word it returned. ``swd_sequence`` stores three words per sequence: the
+clock count, with bit 31 set for reads, and the low and high halves of the
+bits sent or read.
+"""
+
+import struct
+import time
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MCU_Flasher.git"
+
+_MAGIC = b"MCUT\x01"
+_HEADER = "<BBII"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+OP_CONNECT = 0
+OP_DISCONNECT = 1
+OP_RESET = 2
+OP_SET_CLOCK = 3
+OP_SWJ_SEQUENCE = 4
+OP_WRITE_PINS = 5
+OP_READ_DP = 6
+OP_WRITE_DP = 7
+OP_READ_AP = 8
+OP_WRITE_AP = 9
+OP_READ_AP_MULTIPLE = 10
+OP_WRITE_AP_MULTIPLE = 11
+OP_SWD_SEQUENCE = 12
+OP_TRANSFER_CONFIGURE = 13
+OP_READ_AP_MATCH = 14
+
+OP_NAMES = (
+    "connect",
+    "disconnect",
+    "reset",
+    "set_clock",
+    "swj_sequence",
+    "write_pins",
+    "read_dp",
+    "write_dp",
+    "read_ap",
+    "write_ap",
+    "read_ap_multiple",
+    "write_ap_multiple",
+    "swd_sequence",
+    "transfer_configure",
+    "read_ap_match",
+)
+
+# Bits on the wire for one SWD transfer: 8 bit request, turnaround, 3 bit
+# ack, turnaround, 32 data bits, parity and two idle cycles.
+TRANSFER_BITS = 48
+
+try:
+    _monotonic_ns = time.monotonic_ns
+except AttributeError:
+
+    def _monotonic_ns():
+        return int(time.monotonic() * 1000000000)
+
+
+class ProbeStats:
+    """Counts of probe traffic. ``calls`` is the number of probe method calls
+    (round trips on a USB probe), ``transfers`` the number of SWD register
+    transfers, ``wire_bits`` the modeled SWD bits and ``elapsed`` the measured
+    seconds spent in the probe. A value match read counts as one transfer,
+    its retries inside the probe aren't seen."""
+
+    def __init__(self):
+        self.calls = 0
+        self.transfers = 0
+        self.wire_bits = 0
+        self.elapsed = 0.0
+
+    def reset(self):
+        self.__init__()
+
+    def add(self, op, count, elapsed):
+        self.calls += 1
+        self.elapsed += elapsed
+        if op in (OP_SWJ_SEQUENCE, OP_SWD_SEQUENCE):
+            self.wire_bits += count
+        elif op == OP_READ_AP_MATCH:
+            self.transfers += 1
+            self.wire_bits += TRANSFER_BITS
+        elif OP_READ_DP <= op <= OP_WRITE_AP_MULTIPLE:
+            self.transfers += count
+            self.wire_bits += count * TRANSFER_BITS
+
+    @property
+    def wire_bytes(self) -> int:
+        return self.wire_bits // 8
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "transfers": self.transfers,
+            "wire_bytes": self.wire_bytes,
+            "elapsed": self.elapsed,
+        }
+
+
+def _pin_group(group):
+    return getattr(group, "value", group)
+
+
+def _sequence_words(sequences, results) -> tuple:
+    # Three words per sequence, see the module docs.
+    words = []
+    results = iter(results)
+    for sequence in sequences:
+        count = sequence[0]
+        if len(sequence) == 2:
+            bits = sequence[1]
+        else:
+            bits = next(results)
+            count |= 0x80000000
+        words.extend((count, bits & 0xFFFFFFFF, bits >> 32))
+    return tuple(words)
+
+
+def _sequence_clocks(words) -> int:
+    return sum(count & 0x7FFFFFFF for count in words[::3])
+
+
+def _clocks(op, words) -> int:
+    # What ProbeStats.add() counts for a record.
+    if op == OP_SWJ_SEQUENCE:
+        return words[0] if words else 0
+    if op == OP_SWD_SEQUENCE:
+        return _sequence_clocks(words)
+    return len(words)
+
+
+class TraceProbe:
+    """Wraps ``probe``, passing every call through and recording it. ``file``
+    is an optional binary file to write the trace to. Without one only
+    :attr:`stats` are kept."""
+
+    def __init__(self, probe, file=None):
+        self.probe = probe
+        self.file = file
+        self.stats = ProbeStats()
+        if file is not None:
+            file.write(_MAGIC)
+
+    def __getattr__(self, name):
+        # PinGroup and anything else the target looks up on the probe. Hide
+        # read_ap_multiple_into so block reads go through the traced
+        # read_ap_multiple. It is the same single call on the wire.
+        if name == "read_ap_multiple_into":
+            raise AttributeError(name)
+        # Trace the optional calls when the probe has them.
+        if name in ("transfer_configure", "read_ap_match", "swd_sequence"):
+            if getattr(self.probe, name, None) is None:
+                raise AttributeError(name)
+            return getattr(self, "_" + name)
+        return getattr(self.probe, name)
+
+    def _record(self, op, register, start, words=(), wide=False):
+        elapsed = _monotonic_ns() - start
+        count = len(words)
+        self.stats.add(op, _clocks(op, words), elapsed / 1e9)
+        if self.file is None:
+            return
+        if wide:
+            payload = struct.pack("<Q", words[1])
+            count = 1
+        else:
+            payload = struct.pack("<%dI" % count, *words)
+        self.file.write(struct.pack(_HEADER, op, register, count, elapsed // 1000))
+        self.file.write(payload)
+
+    def connect(self, *args, **kwargs):
+        start = _monotonic_ns()
+        result = self.probe.connect(*args, **kwargs)
+        self._record(OP_CONNECT, 0, start)
+        return result
+
+    def disconnect(self):
+        start = _monotonic_ns()
+        self.probe.disconnect()
+        self._record(OP_DISCONNECT, 0, start)
+
+    def reset(self):
+        start = _monotonic_ns()
+        self.probe.reset()
+        self._record(OP_RESET, 0, start)
+
+    def set_clock(self, frequency):
+        start = _monotonic_ns()
+        self.probe.set_clock(frequency)
+        self._record(OP_SET_CLOCK, 0, start, (frequency,))
+
+    def swj_sequence(self, length, bits):
+        start = _monotonic_ns()
+        self.probe.swj_sequence(length, bits)
+        self._record(OP_SWJ_SEQUENCE, 0, start, (length, bits), wide=True)
+
+    def write_pins(self, group, mask, value):
+        start = _monotonic_ns()
+        self.probe.write_pins(group, mask, value)
+        self._record(OP_WRITE_PINS, _pin_group(group), start, (mask, value))
+
+    def read_dp(self, addr):
+        start = _monotonic_ns()
+        value = self.probe.read_dp(addr)
+        self._record(OP_READ_DP, addr, start, (value,))
+        return value
+
+    def write_dp(self, addr, value):
+        start = _monotonic_ns()
+        self.probe.write_dp(addr, value)
+        self._record(OP_WRITE_DP, addr, start, (value,))
+
+    def read_ap(self, addr):
+        start = _monotonic_ns()
+        value = self.probe.read_ap(addr)
+        self._record(OP_READ_AP, addr, start, (value,))
+        return value
+
+    def write_ap(self, addr, value):
+        start = _monotonic_ns()
+        self.probe.write_ap(addr, value)
+        self._record(OP_WRITE_AP, addr, start, (value,))
+
+    def read_ap_multiple(self, addr, count=1):
+        start = _monotonic_ns()
+        values = self.probe.read_ap_multiple(addr, count)
+        self._record(OP_READ_AP_MULTIPLE, addr, start, tuple(values))
+        return values
+
+    def write_ap_multiple(self, addr, values):
+        start = _monotonic_ns()
+        self.probe.write_ap_multiple(addr, values)
+        self._record(OP_WRITE_AP_MULTIPLE, addr, start, tuple(values))
+
+    def _transfer_configure(self, idle_cycles, wait_retry, match_retry):
+        start = _monotonic_ns()
+        self.probe.transfer_configure(idle_cycles, wait_retry, match_retry)
+        self._record(
+            OP_TRANSFER_CONFIGURE, 0, start, (idle_cycles, wait_retry, match_retry)
+        )
+
+    def _read_ap_match(self, addr, mask, value):
+        start = _monotonic_ns()
+        word = self.probe.read_ap_match(addr, mask, value)
+        matched = word is not None
+        self._record(OP_READ_AP_MATCH, addr, start, (mask, value, matched, word or 0))
+        return word
+
+    def _swd_sequence(self, sequences):
+        start = _monotonic_ns()
+        results = self.probe.swd_sequence(sequences)
+        words = _sequence_words(sequences, results)
+        self._record(OP_SWD_SEQUENCE, 0, start, words)
+        return results
+
+
+def read_trace(file):
+    """Yield ``(op, register, words, microseconds)`` for each record in a
+    trace file. For ``swj_sequence`` the words are ``(bits,)``."""
+    if file.read(len(_MAGIC)) != _MAGIC:
+        raise ValueError("Not a probe trace")
+    while True:
+        header = file.read(_HEADER_SIZE)
+        if len(header) < _HEADER_SIZE:
+            return
+        op, register, count, duration = struct.unpack(_HEADER, header)
+        if op == OP_SWJ_SEQUENCE:
+            words = struct.unpack("<Q", file.read(8))
+        else:
+            words = struct.unpack("<%dI" % count, file.read(4 * count))
+        yield op, register, words, duration
+
+
+class ReplayProbe:
+    """Probe that answers from a recorded trace. Every call must match the
+    next record. With ``strict`` the written values must match too. Recorded
+    durations are added to :attr:`stats` instead of real time. It has value
+    match when the recorded probe configured it."""
+
+    class PinGroup:
+        PROTOCOL_PINS = 0
+
+    def __init__(self, file, strict=True):
+        self._records = read_trace(file)
+        self._peeked = None
+        self.strict = strict
+        self.stats = ProbeStats()
+
+    def __getattr__(self, name):
+        # The target only calls transfer_configure() on probes that have it,
+        # so the recorded probe had it if that is the next record.
+        if name == "transfer_configure":
+            if self._peeked is None:
+                self._peeked = next(self._records, None)
+            if self._peeked is not None and self._peeked[0] == OP_TRANSFER_CONFIGURE:
+                return self._transfer_configure
+        raise AttributeError(name)
+
+    def _next(self, op, register=None, words=None):
+        record = self._peeked
+        self._peeked = None
+        if record is None:
+            record = next(self._records, None)
+        if record is None:
+            raise RuntimeError("Trace ended before %s" % OP_NAMES[op])
+        recorded_op, recorded_register, recorded_words, duration = record
+        if recorded_op != op or (
+            register is not None and recorded_register != register
+        ):
+            raise RuntimeError(
+                "Trace expected %s(0x%x) but got %s(0x%x)"
+                % (
+                    OP_NAMES[recorded_op],
+                    recorded_register,
+                    OP_NAMES[op],
+                    register or 0,
+                )
+            )
+        if self.strict and words is not None and tuple(words) != recorded_words:
+            raise RuntimeError(
+                "%s(0x%x) values differ from trace" % (OP_NAMES[op], register or 0)
+            )
+        count = len(recorded_words)
+        if op == OP_SWJ_SEQUENCE:
+            count = words[0] if words else 0
+        elif op == OP_SWD_SEQUENCE:
+            count = _sequence_clocks(recorded_words)
+        self.stats.add(op, count, duration / 1e6)
+        return recorded_words
+
+    def connect(self, *args, **kwargs):  # pylint: disable=unused-argument
+        self._next(OP_CONNECT)
+
+    def disconnect(self):
+        self._next(OP_DISCONNECT)
+
+    def reset(self):
+        self._next(OP_RESET)
+
+    def set_clock(self, frequency):
+        self._next(OP_SET_CLOCK, 0, (frequency,))
+
+    def swj_sequence(self, length, bits):
+        # Only the bits are recorded so compare the ones sent.
+        recorded = self._next(OP_SWJ_SEQUENCE, 0, None)[0]
+        if self.strict and (recorded ^ bits) & ((1 << min(length, 64)) - 1):
+            raise RuntimeError("swj_sequence(%d) bits differ from trace" % length)
+        self.stats.wire_bits += length
+
+    def write_pins(self, group, mask, value):  # pylint: disable=unused-argument
+        self._next(OP_WRITE_PINS, None, (mask, value))
+
+    def read_dp(self, addr):
+        return self._next(OP_READ_DP, addr)[0]
+
+    def write_dp(self, addr, value):
+        self._next(OP_WRITE_DP, addr, (value,))
+
+    def read_ap(self, addr):
+        return self._next(OP_READ_AP, addr)[0]
+
+    def write_ap(self, addr, value):
+        self._next(OP_WRITE_AP, addr, (value,))
+
+    def read_ap_multiple(self, addr, count=1):
+        values = self._next(OP_READ_AP_MULTIPLE, addr)
+        if len(values) != count:
+            raise RuntimeError("read_ap_multiple count differs from trace")
+        return list(values)
+
+    def write_ap_multiple(self, addr, values):
+        self._next(OP_WRITE_AP_MULTIPLE, addr, values)
+
+    def _transfer_configure(self, idle_cycles, wait_retry, match_retry):
+        self._next(OP_TRANSFER_CONFIGURE, 0, (idle_cycles, wait_retry, match_retry))
+
+    def read_ap_match(self, addr, mask, value):
+        words = self._next(OP_READ_AP_MATCH, addr)
+        if self.strict and words[:2] != (mask, value):
+            raise RuntimeError("read_ap_match(0x%x) values differ from trace" % addr)
+        return words[3] if words[2] else None
+
+    def swd_sequence(self, sequences):
+        recorded = self._next(OP_SWD_SEQUENCE, 0)
+        results = []
+        sent = []
+        for i in range(0, len(recorded), 3):
+            count, low, high = recorded[i : i + 3]
+            if count & 0x80000000:
+                results.append(low | high << 32)
+            else:
+                sent.append((count, low | high << 32))
+        if self.strict and sent != [tuple(s) for s in sequences if len(s) == 2]:
+            raise RuntimeError("swd_sequence bits differ from trace")
+        return results
@@ -0,0 +1,84 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+import binascii
+import os
+
+import pytest
+
+from adafruit_mcu_flasher import crc32, nrf5x, stm32
+from adafruit_mcu_flasher.crc_stub import BKPT_OFFSET, CRC32_STUB, target_crc32
+from mcu_flasher_tools import sim
+
+RAM = nrf5x.NRF5X_RAM_START
+
+
+def expected(data, crc=0xFFFFFFFF):
+    return binascii.crc32(data, crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+def nrf52(image):
+    model = sim.SimNRF52()
+    target = nrf5x.NRF(model.probe)
+    target.target_connect()
+    target.select()
+    model.flash[: len(image)] = image
+    return model, target
+
+
+def test_crc32_check_value():
+    assert crc32(b"123456789") ^ 0xFFFFFFFF == 0xCBF43926
+    data = os.urandom(1000)
+    assert crc32(data[500:], crc32(data[:500])) == expected(data)
+
+
+@pytest.mark.parametrize("length", [0, 1, 2, 3, 4, 5, 255, 1024, 4099])
+def test_stub_runs(length):
+    image = os.urandom(4100)
+    model, target = nrf52(image)
+    assert target_crc32(target, RAM, 1, length) == expected(image[1 : 1 + length])
+    assert target.read_core_reg(15) == RAM + BKPT_OFFSET
+    # The stub is loaded as is and the flash isn't touched.
+    assert model.memory.read_bytes(RAM, len(CRC32_STUB)) == CRC32_STUB
+    assert model.memory.read_bytes(0, len(image)) == image
+
+
+def test_stub_continues_crc():
+    image = os.urandom(2048)
+    _, target = nrf52(image)
+    first = target_crc32(target, RAM, 0, 1000)
+    assert target_crc32(target, RAM, 1000, 1048, first) == expected(image)
+
+
+def test_stub_is_executed():
+    # Patch the table so the stub computes something else. A model that only
+    # recognises the stub would still return the right CRC.
+    _, target = nrf52(b"\x01")
+    stub = bytearray(CRC32_STUB)
+    for i in range(BKPT_OFFSET + 2, len(stub)):
+        stub[i] ^= 0xFF
+    target.write_block(RAM, stub)
+    result = target.run_routine(RAM, RAM + 0x200, (0, 1, 0xFFFFFFFF))
+    assert result != expected(b"\x01")
+
+
+def test_nrf_crc32():
+    image = os.urandom(16 * 1024)
+    model, target = nrf52(image)
+    assert target.crc32(0, len(image)) == expected(image)
+    assert target.crc32(4096, 3) == expected(image[4096:4099])
+    model.flash[5000] ^= 0x01
+    assert target.crc32(0, len(image)) != expected(image)
+
+
+def test_stm32_crc32():
+    model = sim.SimSTM32F4()
+    target = stm32.STM32(model.probe)
+    target.target_connect()
+    target.select()
+    image = os.urandom(16 * 1024)
+    start = stm32.STM32_FLASH_START
+    model.flash[: len(image)] = image
+    assert target.crc32(start, len(image)) == expected(image)
+    assert target.crc32(start + 7, 9) == expected(image[7:16])
@@ -0,0 +1,61 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+import contextlib
+import io
+
+import pytest
+
+from adafruit_mcu_flasher import nrf5x, sam, samx5
+from adafruit_mcu_flasher.bin_file import write_bin_file
+from adafruit_mcu_flasher.heap import HeapMonitor
+from adafruit_mcu_flasher.hex_file import write_hex_file
+from mcu_flasher_tools import benchmark, sim
+
+# What a page may still hold once the buffers are allocated. The drivers
+# don't keep anything per page, this leaves room for interpreter caches.
+PAGE_BOUND = 256
+
+TARGETS = {
+    "samd21": (sim.SimSAMD21, sam.SAM),
+    "samd51": (sim.SimSAMD51, samx5.SAMx5),
+    "nrf52": (sim.SimNRF52, nrf5x.NRF),
+}
+
+
+class Discard:
+    # Buffered output would count as heap the writers hold.
+
+    @staticmethod
+    def write(text):
+        return len(text)
+
+    @staticmethod
+    def flush():
+        pass
+
+
+@pytest.mark.parametrize("name", TARGETS)
+@pytest.mark.parametrize("writer", ["bin", "hex"])
+def test_steady_state_pages(name, writer):
+    model_class, target_class = TARGETS[name]
+    target = target_class(model_class().probe)
+    image = benchmark.make_image(32 * 1024)
+    with HeapMonitor() as heap, contextlib.redirect_stdout(Discard()):
+        target.heap = heap
+        target.target_connect()
+        target.select()
+        target.erase()
+        target.program_start()
+        if writer == "bin":
+            report = write_bin_file(target, io.BytesIO(image), 0)
+        else:
+            report = write_hex_file(target, benchmark.intel_hex(image))
+    assert report.ok
+    assert target.read_memory(0, len(image)) == image
+    assert heap.tracing
+    # 1 KiB buffers, less the first one that allocates the buffers.
+    assert heap.pages == 31
+    assert heap.page_max <= PAGE_BOUND
+    assert heap.page_bytes <= heap.pages * PAGE_BOUND // 4
@@ -0,0 +1,54 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+import contextlib
+import io
+import os
+
+import pytest
+
+from adafruit_mcu_flasher import nrf5x, sam, samx5, stm32
+from mcu_flasher_tools import sim
+
+TARGETS = {
+    "samd21": (sim.SimSAMD21, sam.SAM, 0),
+    "samd51": (sim.SimSAMD51, samx5.SAMx5, 0),
+    "nrf52": (sim.SimNRF52, nrf5x.NRF, 0),
+    "stm32f4": (sim.SimSTM32F4, stm32.STM32, stm32.STM32_FLASH_START),
+}
+
+
+@pytest.mark.parametrize("name", TARGETS)
+def test_next_board_is_selected(name):
+    model_class, target_class, start = TARGETS[name]
+    model = model_class()
+    target = target_class(model.probe)
+    image = os.urandom(8 * 1024)
+    with contextlib.redirect_stdout(io.StringIO()):
+        target.target_connect()
+        target.select()
+        target.erase()
+        target.program_start()
+        assert target.program_flash(start, image)
+        geometry = target.geometry
+
+        # The next board is plugged in already halted, so it isn't reset.
+        model.probe.present = False
+        if name == "samd21":
+            # With its flash regions locked.
+            model.locks = 0xFFFF
+        model.probe.present = True
+        assert target.hot_attach(timeout=1)
+        assert target.geometry is None
+        if isinstance(target, sam.SAM):
+            assert target.locked is None
+        if isinstance(target, stm32.STM32):
+            assert target.mcuid is None and not target.sectors
+
+        target.select()
+        assert repr(target.geometry) == repr(geometry)
+        target.erase()
+        target.program_start()
+        assert target.program_flash(start, image[::-1])
+    assert model.memory.read_bytes(start, len(image)) == image[::-1]
@@ -0,0 +1,90 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+import io
+import os
+
+import pytest
+
+from adafruit_mcu_flasher import sam
+from adafruit_mcu_flasher.multidrop import FlashScheduler, MultiDropBus
+from adafruit_mcu_flasher.planner import FlashPlan
+from mcu_flasher_tools import sim
+from mcu_flasher_tools.trace import OP_SWD_SEQUENCE, TraceProbe, read_trace
+
+TARGETSELS = (0x01002927, 0x11002927)
+
+
+def flash_both(probe, images):
+    bus = MultiDropBus(probe)
+    targets = [sam.SAM(bus.drop(targetsel)) for targetsel in TARGETSELS]
+    scheduler = FlashScheduler()
+    for target, image in zip(targets, images):
+        target.target_connect()
+        target.select()
+        plan = FlashPlan(sam.SAM, target.geometry, [(0, image)])
+        scheduler.add(target, plan.steps(target))
+    switches = bus.switches
+    reports = scheduler.run()
+    return bus.switches - switches, scheduler.polls, reports
+
+
+def test_two_samd21():
+    models = {targetsel: sim.SimSAMD21() for targetsel in TARGETSELS}
+    bus = sim.SimMultiDropBus(models)
+    images = [os.urandom(20000), os.urandom(9000)]
+    switches, polls, reports = flash_both(bus.probe, images)
+    assert all(report.ok for report in reports)
+    for targetsel, image in zip(TARGETSELS, images):
+        assert models[targetsel].memory.read_bytes(0, len(image)) == image
+    # The bus changes targets while one waits on its flash, instead of only
+    # once when the first target is done.
+    pages = (len(images[0]) + 255) // 256
+    assert switches > pages
+    # Every switch is a TARGETSEL the models saw.
+    assert bus.selections >= switches
+    # Each turn a waiting target gets one status read.
+    assert pages <= polls <= 2 * switches + 4
+
+
+def test_targetsel_dp_write():
+    models = {TARGETSELS[0]: sim.SimSAMD21()}
+    bus = sim.SimMultiDropBus(models)
+    bus.swj_sequence(51, 0xFFFFFFFFFFFFFF)
+    with pytest.raises(OSError):
+        bus.write_dp(0x0C, TARGETSELS[0])
+    target = sam.SAM(MultiDropBus(bus).drop(TARGETSELS[0]))
+    assert target.probe.read_dp(0x00) == models[TARGETSELS[0]].probe.idcode
+    assert bus.selected == TARGETSELS[0]
+
+
+def test_absent_target():
+    bus = sim.SimMultiDropBus({TARGETSELS[0]: sim.SimSAMD21()})
+    target = sam.SAM(MultiDropBus(bus).drop(0x7))
+    with pytest.raises(OSError):
+        target.read_word(0)
+
+
+def test_probe_needs_swd_sequence():
+    with pytest.raises(ValueError):
+        MultiDropBus(sim.SimSAMD21().probe)
+
+
+def test_trace():
+    models = {targetsel: sim.SimSAMD21() for targetsel in TARGETSELS}
+    trace = io.BytesIO()
+    probe = TraceProbe(sim.SimMultiDropBus(models).probe, trace)
+    switches, _, reports = flash_both(probe, [os.urandom(2000), os.urandom(1000)])
+    assert all(report.ok for report in reports)
+    trace.seek(0)
+    selected = []
+    for kind, _, words, _ in read_trace(trace):
+        if kind == OP_SWD_SEQUENCE:
+            # Request, ACK that was read, data with parity and idle.
+            assert words[:3] == (8, 0x99, 0)
+            assert words[3] == 0x80000005
+            assert words[6] == 33
+            selected.append(words[7])
+    assert len(selected) >= switches
+    assert set(selected) == set(TARGETSELS)
@@ -0,0 +1,37 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+import contextlib
+import io
+import os
+
+from adafruit_mcu_flasher import nrf5x
+from mcu_flasher_tools import sim
+
+
+def connect():
+    model = sim.SimNRF52()
+    target = nrf5x.NRF(model.probe)
+    with contextlib.redirect_stdout(io.StringIO()):
+        target.target_connect()
+        target.select()
+    return model, target
+
+
+def test_program_flash():
+    model, target = connect()
+    image = os.urandom(10000)
+    assert target.program_flash(3, image)
+    assert model.memory.read_bytes(3, len(image)) == image
+    assert model.config == 0
+
+
+def test_failed_write_disables():
+    # Flash that wasn't erased can't take the new bits, so verify fails.
+    model, target = connect()
+    model.flash[:8192] = bytes(8192)
+    assert not target.program_flash(0, os.urandom(8192))
+    assert model.config == 0
+    assert not target.program_flash(1, os.urandom(8192))
+    assert model.config == 0
@@ -0,0 +1,70 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+import io
+import os
+
+from adafruit_mcu_flasher import sam
+from adafruit_mcu_flasher.packed_file import (
+    pack_chunks,
+    packed_chunks,
+    write_packed_file,
+)
+from mcu_flasher_tools import sim
+
+
+def program(packed):
+    model = sim.SimSAMD21()
+    target = sam.SAM(model.probe)
+    target.target_connect()
+    target.select()
+    target.erase()
+    target.program_start()
+    report = write_packed_file(target, io.BytesIO(packed))
+    return model, report
+
+
+def unpacked(packed):
+    return [
+        (address, bytes(data)) for address, data in packed_chunks(io.BytesIO(packed))
+    ]
+
+
+def test_round_trip():
+    image = os.urandom(3000) + b"\xff" * 2048 + os.urandom(100) * 20
+    packed = pack_chunks([(0, image)], 1024)
+    assert len(packed) < len(image)
+    assert b"".join(data for _, data in unpacked(packed)) == image
+    model, report = program(packed)
+    assert report.ok
+    assert model.memory.read_bytes(0, len(image)) == image
+
+
+def test_gap_in_one_page():
+    image = os.urandom(3000)
+    packed = pack_chunks([(0, image[:100]), (200, image[200:3000])], 1024)
+    expected = image[:100] + b"\xff" * 100 + image[200:]
+    # One segment, so page 0 is written once with both chunks in it.
+    assert unpacked(packed) == [
+        (0, expected[:1024]),
+        (1024, expected[1024:2048]),
+        (2048, expected[2048:]),
+    ]
+    model, report = program(packed)
+    assert report.ok
+    assert model.memory.read_bytes(0, len(expected)) == expected
+
+
+def test_separate_pages():
+    first = os.urandom(300)
+    second = os.urandom(500)
+    packed = pack_chunks([(100, first), (4096 + 20, second)], 1024)
+    assert unpacked(packed) == [
+        (0, b"\xff" * 100 + first),
+        (4096, b"\xff" * 20 + second),
+    ]
+    model, report = program(packed)
+    assert report.ok
+    assert model.memory.read_bytes(100, len(first)) == first
+    assert model.memory.read_bytes(4096 + 20, len(second)) == second
@@ -0,0 +1,185 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+import binascii
+import os
+
+import pytest
+
+from adafruit_mcu_flasher import stm32
+from mcu_flasher_tools import sim
+
+FLASH = stm32.STM32_FLASH_START
+BANK2 = stm32.STM32_BANK2_START
+
+
+def connect(mcuid=0x413, flash_kib=1024):
+    model = sim.SimSTM32F4(mcuid=mcuid, flash_kib=flash_kib)
+    target = stm32.STM32(model.probe)
+    target.target_connect()
+    return model, target
+
+
+def test_select():
+    model, target = connect()
+    assert target.select() == 0x413
+    assert target.report.device_name == stm32.STM_DEVICE_NAMES[0x413]
+    assert not target.report.locked
+    assert target.geometry.flash_size == 1024 * 1024
+    assert target.geometry.start == FLASH
+    # 4 x 16 KiB, 64 KiB and 7 x 128 KiB
+    assert len(target.sectors) == 12
+    assert target.sectors[4] == (FLASH + 0x10000, 64 * 1024, 4)
+    assert target.sectors[-1] == (FLASH + 0xE0000, 128 * 1024, 11)
+    assert model.memory.faults == 0
+
+
+def test_select_unknown_device():
+    _, target = connect(mcuid=0x123)
+    assert target.select() is None
+
+
+def test_program_x32():
+    model, target = connect()
+    target.select()
+    target.erase()
+    target.program_start()
+    image = os.urandom(70000) + b"\xff" * 3000 + os.urandom(10)
+    assert target.program_flash(FLASH, image)
+    # The 10 byte tail is padded to whole words.
+    assert model.memory.read_bytes(FLASH, len(image) + 2) == image + b"\xff\xff"
+    assert target.program_flash(FLASH, image, verify_only=True)
+    # The erased kilobytes in the middle aren't written.
+    assert target.report.pages_skipped == 2
+
+
+def test_program_unaligned():
+    _, target = connect()
+    target.select()
+    target.erase()
+    target.program_start()
+    assert not target.program_flash(FLASH + 2, b"ab")
+
+
+def test_program_fails_verify():
+    model, target = connect()
+    target.select()
+    target.erase()
+    target.program_start()
+    image = os.urandom(4096)
+    assert target.program_flash(FLASH, image)
+    model.flash[100] ^= 0xFF
+    assert not target.program_flash(FLASH, image, verify_only=True)
+
+
+def test_sector_erase():
+    model, target = connect()
+    target.select()
+    target.erase()
+    target.program_start()
+    image = os.urandom(0x30000)
+    assert target.program_flash(FLASH, image)
+    # 0x08010000 is the 64 KiB sector 4, the rest stays.
+    assert target.sectors_in_range(FLASH + 0x10000, 10) == [
+        (FLASH + 0x10000, 0x10000, 4)
+    ]
+    target.erase_range(FLASH + 0x10000, 10)
+    assert model.memory.read_bytes(FLASH, 0x10000) == image[:0x10000]
+    assert model.memory.read_bytes(FLASH + 0x10000, 0x10000) == b"\xff" * 0x10000
+    assert model.memory.read_bytes(FLASH + 0x20000, 0x10000) == image[0x20000:]
+
+
+def test_erase_outside_flash():
+    _, target = connect()
+    target.select()
+    with pytest.raises(ValueError):
+        target.erase_range(FLASH + 1024 * 1024, 4)
+
+
+def test_mass_erase():
+    model, target = connect()
+    target.select()
+    model.flash[:] = bytes(len(model.flash))
+    target.erase()
+    assert model.flash == b"\xff" * len(model.flash)
+    assert "erase" in target.report.phases
+
+
+def test_unprotect():
+    model, target = connect()
+    # Read protection level 1 and all sectors write protected.
+    model.optcr = 0x000055ED
+    model.flash[:16] = bytes(16)
+    target.select()
+    assert target.report.locked
+    with pytest.raises(RuntimeError):
+        target.program_start()
+    target.unprotect()
+    assert (model.optcr >> 8) & 0xFF == 0xAA
+    assert model.optcr & 0x0FFF0000 == 0x0FFF0000
+    # Leaving level 1 mass erases the flash.
+    assert model.memory.read_bytes(FLASH, 16) == b"\xff" * 16
+    # The option bytes are locked again afterwards.
+    assert target.read_option_bytes() & 0x1
+    target.program_start()
+
+
+def test_unprotect_unlocked():
+    model, target = connect()
+    target.select()
+    model.flash[:4] = bytes(4)
+    target.unprotect()
+    assert model.flash[:4] == bytes(4)
+
+
+def test_crc32():
+    model, target = connect()
+    target.select()
+    target.erase()
+    target.program_start()
+    image = os.urandom(64 * 1024)
+    assert target.program_flash(FLASH, image)
+    # The driver's CRC32 is binascii's without the final inversion.
+    expected = binascii.crc32(image) ^ 0xFFFFFFFF
+    assert target.crc32(FLASH, len(image)) == expected
+    assert target.crc32(FLASH + 4, 100) == binascii.crc32(image[4:104]) ^ 0xFFFFFFFF
+    model.flash[1000] ^= 0xFF
+    assert target.crc32(FLASH, len(image)) != expected
+
+
+def test_dual_bank_sectors():
+    sectors = stm32.stm32f4_sectors(2 * 1024 * 1024, dual_bank=True)
+    assert len(sectors) == 24
+    assert sectors[11] == (FLASH + 0xE0000, 128 * 1024, 11)
+    # FLASH_CR.SNB is (bank << 4) | sector in bank.
+    assert sectors[12] == (BANK2, 16 * 1024, 0x10)
+    assert sectors[16] == (BANK2 + 0x10000, 64 * 1024, 0x14)
+    assert sectors[23] == (BANK2 + 0xE0000, 128 * 1024, 0x1B)
+
+
+def test_dual_bank_erase():
+    model, target = connect(mcuid=0x419, flash_kib=2048)
+    target.select()
+    assert len(target.sectors) == 24
+    model.flash[:] = bytes(len(model.flash))
+    # Sector 1 of bank 2 only.
+    target.erase_range(BANK2 + 0x4000, 4)
+    assert model.memory.read_bytes(FLASH + 0x4000, 4) == bytes(4)
+    assert model.memory.read_bytes(BANK2, 4) == bytes(4)
+    assert model.memory.read_bytes(BANK2 + 0x4000, 0x4000) == b"\xff" * 0x4000
+    assert model.memory.read_bytes(BANK2 + 0x8000, 4) == bytes(4)
+    # Mass erase covers both banks.
+    target.erase()
+    assert model.flash == b"\xff" * len(model.flash)
+
+
+def test_dual_bank_program():
+    model, target = connect(mcuid=0x419, flash_kib=2048)
+    target.select()
+    target.erase()
+    target.program_start()
+    image = os.urandom(8192)
+    # Straddle the bank boundary.
+    assert target.program_flash(BANK2 - 4096, image)
+    assert model.memory.read_bytes(BANK2 - 4096, len(image)) == image